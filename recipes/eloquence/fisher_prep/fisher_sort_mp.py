@@ -1,101 +1,132 @@
 import argparse
-from datasets import load_from_disk, Dataset, concatenate_datasets, Audio
-from datasets.utils.logging import disable_progress_bar, enable_progress_bar, set_verbosity_error
+from datasets import load_from_disk, Dataset, Audio, Features, Sequence, Value
+from datasets.utils.logging import disable_progress_bar, set_verbosity_error
 from tqdm import tqdm
-from random import uniform
-from copy import deepcopy
+from random import Random
 import numpy as np
 import multiprocessing as mp
 import os
+import shutil
 from preprocess_fisher import clean_fisher
 
-def get_start_time(example):
+SAMPLING_RATE = 16000
+
+# output format, contexts hold only the text related columns of the previous concatenated utterances
+CONTEXT_FEATURES = {
+    'labels': Sequence(Value('string')),
+    'turn_index': Sequence(Value('int64')),
+    'speakers': Sequence(Value('string')),
+}
+FEATURES = Features({
+    'audio': Audio(sampling_rate=SAMPLING_RATE),
+    'labels': Sequence(Value('string')),
+    'uttid': Sequence(Value('string')),
+    'recording': Sequence(Value('string')),
+    'turn_index': Sequence(Value('int64')),
+    'start_time': Value('int64'),
+    'total_len': Value('float64'),
+    'speakers': Sequence(Value('string')),
+    'context': [CONTEXT_FEATURES],
+})
+# with the context stored by reference, examples hold their position in the conversation instead of the context,
+# the turns are kept once per conversation in a separate turn table
+REFERENCE_COLUMNS = ['conversation_id', 'conversation_turn']
+REFERENCE_FEATURES = Features({
+    **{key: value for key, value in FEATURES.items() if key != 'context'},
+    'conversation_id': Value('string'),
+    'conversation_turn': Value('int32'),
+})
+
+# memory-mapped split of the worker, it is passed once per worker by the pool initializer instead of every task
+worker_dataset = None
+
+
+def get_start_time(uttid):
     # NOTE: this messed everything up..
-    if example['uttid'].startswith('fe'):
-        example['start_time'] = int(example['uttid'].split('-')[-2])
-    else:
-        example['start_time'] = int(example['uttid'].rpartition('_')[2].partition('-')[0])
-    return example
+    if uttid.startswith('fe'):
+        return int(uttid.split('-')[-2])
+    return int(uttid.rpartition('_')[2].partition('-')[0])
 
-def process_recording(args):
-    id, index, dataset, split, min_len, max_len, max_context = args
+
+def init_worker(dataset):
+    global worker_dataset
     disable_progress_bar()
+    worker_dataset = dataset
 
-    # select the relevant rows and sort according to the start time of each utterance
-    rows = dataset[split].select(index).map(get_start_time).sort('start_time')
 
-    length_limit = uniform(min_len, max_len)
+def group_rows(lengths, rng, min_len, max_len):
+    """Splits the time ordered utterances of a recording into groups of random length between min_len and max_len."""
+    length_limit = rng.uniform(min_len, max_len)
     length = 0
-    concat = []
-    accum = []
-
-    for row in rows:
-        input_len = row['input_len']
-
-        if length + input_len >= length_limit and len(concat) >= 1:
-            accum.append(concat)
+    groups = [[]]
+    for position, input_len in enumerate(lengths):
+        if length + input_len >= length_limit and len(groups[-1]) >= 1:
+            groups.append([])
             length = 0
-            concat = []
-            length_limit = uniform(min_len, max_len)
-
-        concat.append(row)
+            length_limit = rng.uniform(min_len, max_len)
+        groups[-1].append(position)
         length += input_len
+    return groups
 
-    accum.append(concat)
 
-    # now process the accumulated recordings
-    # concatenate the audio, labels, uttids, lengths, ...
+def process_recording(args):
+    """Concatenates utterances of a single recording, the task carries only the time ordered row indices."""
+    recording_id, index, start_times, seed, min_len, max_len, max_context, context_by_reference = args
+    rows = worker_dataset[index]  # single read of the rows from the memory-mapped arrow table
+    rng = Random(f"{seed}-{recording_id}")
+
     combined = []
-    for i, acc in enumerate(accum):
-        feats = acc[0]
-        feats['audio']['array'] = [ feats['audio']['array'] ] # for easier concat
-        feats['labels'] = [ feats['labels'] ]
-        feats['uttid'] = [ feats['uttid'] ]
-        feats.pop('input_len')
-        feats['recording'] = [ feats['recording'] ]
-        feats['turn_index'] = [ feats['turn_index'] ]
-
-        for a in acc[1:]:
-            feats['audio']['array'].append(a['audio']['array'])
-            feats['labels'].append(a['labels'])
-            feats['uttid'].append(a['uttid'])
-            feats['recording'].append(a['recording'])
-            feats['turn_index'].append(a['turn_index'])
-
-        # concatenate all the audio arrays and cast them to fp32, obviously...
-        feats['audio']['array'] = np.concatenate(feats['audio']['array'], dtype='float32')
-        feats['total_len'] = feats['audio']['array'].size / 16000
-        feats['speakers'] = list(map(lambda x: x[-1], feats['recording']))
-        combined.append(feats)
-
-    # combine the contexts for all combined utterances up to the current one
+    for group in group_rows(rows['input_len'], rng, min_len, max_len):
+        audio = np.concatenate([rows['audio'][i]['array'] for i in group], dtype='float32')
+        recordings = [rows['recording'][i] for i in group]
+        combined.append({
+            'audio': {'array': audio, 'sampling_rate': SAMPLING_RATE},
+            'labels': [rows['labels'][i] for i in group],
+            'uttid': [rows['uttid'][i] for i in group],
+            'recording': recordings,
+            'turn_index': [rows['turn_index'][i] for i in group],
+            'start_time': start_times[group[0]],
+            'total_len': audio.size / SAMPLING_RATE,
+            'speakers': [recording[-1] for recording in recordings],
+        })
+
+    if context_by_reference:
+        for i, utt in enumerate(combined):
+            utt['conversation_id'] = recording_id
+            utt['conversation_turn'] = i
+        return combined
+
+    # contexts reference the text columns of the previous utterances instead of copying them
     for i, utt in enumerate(combined):
-        utt['context'] = []
-        for j in range(max(0, i - max_context), i):
-            context_copy = deepcopy(combined[j])
-            context_copy.pop('audio')
-            context_copy.pop('context')
-            context_copy.pop('total_len')
-            context_copy.pop('start_time')
-            context_copy.pop('uttid')
-            context_copy.pop('recording')
-            utt['context'].append(context_copy)
-
-        if len(utt['context']) == 0: utt['context'] = None
-
-    combined = Dataset.from_list(combined).cast_column('audio', Audio(sampling_rate=16000))
-    enable_progress_bar()
+        context = [
+            {key: combined[j][key] for key in CONTEXT_FEATURES}
+            for j in range(max(0, i - max_context), i)
+        ]
+        utt['context'] = context if context else None
     return combined
 
-# casts the datasets shard to Audio and saves the shard to disk
-def save_shard(data, output_dir, split, shard_index, num_cores):
-    shard = concatenate_datasets(data) 
-    shard_path = os.path.join(output_dir, f"{split}_shard_{shard_index}")
-    shard.save_to_disk(shard_path, num_proc=num_cores)
-    return shard_path
 
+def generate_examples(dataset, tasks, num_cores):
+    with mp.Pool(processes=num_cores, initializer=init_worker, initargs=(dataset,)) as pool:
+        for examples in tqdm(pool.imap(process_recording, tasks, chunksize=4), total=len(tasks)):
+            yield from examples
+
+
+def prepare_tasks(dataset, seed, min_len, max_len, max_context, context_by_reference):
+    """Orders utterances of every recording by their start time, only the metadata columns are read."""
+    df = dataset.select_columns(['uttid', 'recording']).to_pandas()
+    df['recording_id'] = df['recording'].str[:-2]
+    df['start_time'] = df['uttid'].map(get_start_time)
+    df = df.sort_values(['recording_id', 'start_time'], kind='stable')
+    return [
+        (recording_id, group.index.tolist(), group['start_time'].tolist(), seed, min_len, max_len, max_context,
+         context_by_reference)
+        for recording_id, group in df.groupby('recording_id', sort=False)
+    ]
 
-def main(num_cores, dataset_path, output_dir, shard_size, min_len, max_len, max_context, clean):
+
+def main(num_cores, dataset_path, output_dir, shard_size, min_len, max_len, max_context, clean, seed, writer_batch_size,
+         context_by_reference):
     dataset = load_from_disk(dataset_path)
     splits = dataset.keys()
     os.makedirs(output_dir, exist_ok=True)
@@ -108,56 +139,42 @@ def main(num_cores, dataset_path, output_dir, shard_size, min_len, max_len, max_
     for split in splits:
         set_verbosity_error()
 
-        def get_recording_id(example):
-            example['recording_id'] = example['recording'][:-2]
-            return example
-
-        df = dataset[split].remove_columns(['audio']).map(get_recording_id, num_proc=num_cores).to_pandas()
-
         print(f"Preparing indices for the '{split}' split")
-        index_dict = df.groupby('recording_id').apply(lambda x: x.index.tolist()).to_dict()
-        rec_ids = list(index_dict.keys()) 
-
-        # Prepare arguments for multiprocessing
-        rec_ids_sharded = [ rec_ids[i:i+shard_size] for i in range(0, len(rec_ids), shard_size) ]
-
-        # Use multiprocessing to parallelize the processing
-        shard_paths = []
-        shard_index = 0
-
-        for rec_ids_shard in tqdm(rec_ids_sharded):
-            args_list = [(id, index_dict[id], dataset, split, min_len, max_len, max_context) for id in rec_ids_shard]
-
-            current_shard = []
-
-            print(f"Processing rec_id chunk {shard_index}..")
-            with mp.Pool(processes=num_cores) as pool:
-                for result in tqdm(pool.imap(process_recording, args_list), total=len(args_list)):
-                    current_shard.append(result)
-
-            shard_path = save_shard(current_shard, output_dir, split, shard_index, num_cores)
-            del current_shard
-            shard_paths.append(shard_path)
-            shard_index += 1
-
-        # Combine all shards for this split
-        print(f"Combining shards for split: {split}")
-        combined_dataset = concatenate_datasets([load_from_disk(path) for path in shard_paths])
+        tasks = prepare_tasks(dataset[split], seed, min_len, max_len, max_context, context_by_reference)
+
+        # examples are streamed from the workers and written to arrow in batches, nothing is held in memory
+        print(f"Processing {len(tasks)} recordings of the '{split}' split")
+        cache_dir = os.path.join(output_dir, f"{split}_cache")
+        combined_dataset = Dataset.from_generator(
+            generate_examples,
+            features=REFERENCE_FEATURES if context_by_reference else FEATURES,
+            cache_dir=cache_dir,
+            writer_batch_size=writer_batch_size,
+            gen_kwargs={'dataset': dataset[split], 'tasks': tasks, 'num_cores': num_cores},
+        )
 
         # Save the combined dataset for this split
         combined_path = os.path.join(output_dir, f"{split}")
-        combined_dataset.save_to_disk(combined_path, num_proc=num_cores)
+        combined_dataset.save_to_disk(combined_path, num_shards=max(1, len(tasks) // shard_size), num_proc=num_cores)
         print(f"Combined dataset for split {split} saved to {combined_path}")
 
-        # Remove individual shards to save disk space
-        for path in shard_paths:
-            os.system(f"rm -rf {path}")
+        if context_by_reference:
+            turn_table_path = os.path.join(output_dir, 'turn_table', f"{split}")
+            combined_dataset.select_columns(REFERENCE_COLUMNS + list(CONTEXT_FEATURES)).save_to_disk(turn_table_path)
+            print(f"Conversation turn table for split {split} saved to {turn_table_path}")
+
+        # Remove the generator cache to save disk space
+        del combined_dataset
+        shutil.rmtree(cache_dir, ignore_errors=True)
 
     print("All splits processed and combined.")
-    
+
     # Add the dataset dict to the destination dataset directory
     with open(os.path.join(output_dir, 'dataset_dict.json'), 'w') as f:
         f.write('{"splits": ["train", "test", "dev"]}')
+    if context_by_reference:
+        with open(os.path.join(output_dir, 'turn_table', 'dataset_dict.json'), 'w') as f:
+            f.write('{"splits": ["train", "test", "dev"]}')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(description='Process audio data with specified number of CPU cores and save progressively.')
@@ -170,16 +187,25 @@ if __name__ == '__main__':
     parser.add_argument('--output_dir', type=str, required=True,
                         help='Directory to save the processed dataset shards and final combined dataset')
     parser.add_argument('--shard_size', type=int, default=1000,
-                        help='Number of processed recordings per shard (default: 1000)')
+                        help='Number of processed recordings per saved shard (default: 1000)')
     parser.add_argument('--min_len', type=float, default=5.0,
                         help='Concatenated recording length soft lower bound (default: 10.0).')
     parser.add_argument('--max_len', type=float, default=20.0,
                         help='Concatenated recording length upper bound (default: 20.0).')
     parser.add_argument('--max_context', type=int, default=10,
                         help='Maximum context length (default: 10).')
+    parser.add_argument('--seed', type=int, default=42,
+                        help='Seed of the random concatenation lengths, drawn per recording (default: 42).')
+    parser.add_argument('--writer_batch_size', type=int, default=100,
+                        help='Number of concatenated utterances buffered before writing to arrow (default: 100).')
+    parser.add_argument('--context_by_reference', action='store_true',
+                        help='Store only the conversation id and turn position in the examples and the context turns '
+                             'once per conversation in the <output_dir>/turn_table dataset.')
     args = parser.parse_args()
 
     print(f"Using {args.cores} CPU cores")
     print(f"Saving output to {args.output_dir}")
     print(f"Shard size: {args.shard_size}")
-    main(args.cores, args.dataset_path, args.output_dir, args.shard_size, args.min_len, args.max_len, args.max_context, clean=args.clean)
+    main(args.cores, args.dataset_path, args.output_dir, args.shard_size, args.min_len, args.max_len, args.max_context,
+         clean=args.clean, seed=args.seed, writer_batch_size=args.writer_batch_size,
+         context_by_reference=args.context_by_reference)
@@ -1,13 +1,31 @@
+import argparse
+
 from datasets import load_dataset
 
+from utilities.context_utils import build_turn_table
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Prepare the SpokenWOZ dataset.')
+    parser.add_argument('--context_by_reference', action='store_true',
+                        help='Store only the conversation id and turn position in the examples and the context turns '
+                             'once per dialogue in a separate turn table.')
+    args = parser.parse_args()
 
     dataset = load_dataset(
         '/mnt/matylda6/isedlacek/projects/huggingface_asr/src/dataset_builders/spokenwoz',
         data_dir='/mnt/matylda4/kesiraju/datasets/dialogue_datasets/SpokenWoz_2023',
         num_proc=16,
         trust_remote_code=True,
+        context_by_reference=args.context_by_reference,
     )
 
     print(dataset)
     dataset.save_to_disk('/mnt/matylda6/isedlacek/data/spokenwoz', num_proc=16)
+
+    if args.context_by_reference:
+        # every example is a single dialogue turn, so the turn table is built from the dataset itself
+        turn_table = build_turn_table(
+            dataset, conversation_column='conversation_id', turn_column='conversation_turn', label_column='text',
+            speaker_column='tag', num_proc=16,
+        )
+        turn_table.save_to_disk('/mnt/matylda6/isedlacek/data/spokenwoz_turn_table', num_proc=16)
@@ -59,6 +59,7 @@ args=(
   --per_device_train_batch_size="8"   #"12" # 16
   --per_device_eval_batch_size="8" # 24
   --dataloader_num_workers="4"
+  --dataloader_persistent_workers # workers keep the context token ids cached by the collator across epochs
   #--num_train_epochs="14"
   --max_steps="80000"
   --group_by_length="True"
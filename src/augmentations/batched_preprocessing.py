@@ -0,0 +1,240 @@
+"""On-device preprocessing of padded raw waveform batches: speed perturbation, Kaldi-compatible log-mel filter banks,
+utterance CMVN and SpecAug computed in a single batched pass instead of per utterance in the dataloader workers."""
+import json
+from typing import Dict, Optional, Sequence, Tuple
+
+import torch
+import torchaudio
+from transformers import Speech2TextFeatureExtractor
+from transformers.audio_utils import mel_filter_bank, window_function
+
+from augmentations.batched_spec_aug import BatchedSpecAug
+
+FRAME_LENGTH = 400
+HOP_LENGTH = 160
+FFT_LENGTH = 512
+PREEMPHASIS = 0.97
+MEL_FLOOR = 1.192092955078125e-07
+
+
+def speed_perturb_batch(
+    waveforms: torch.Tensor, lengths: torch.Tensor, sampling_rate: int, factors: Sequence[float]
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Speed perturbation with a factor drawn for every utterance, utterances sharing the factor are resampled together.
+
+    Args:
+        waveforms: (Batch, Time) zero padded waveforms
+        lengths: (Batch,) numbers of valid samples
+        sampling_rate: sampling rate of the waveforms
+        factors: speed factors to choose from, as in `torchaudio.transforms.SpeedPerturbation`
+    """
+    factor_ids = torch.randint(len(factors), (waveforms.shape[0],), device=waveforms.device)
+    perturbed = [None] * waveforms.shape[0]
+    new_lengths = lengths.clone()
+    for factor_id, factor in enumerate(factors):
+        indices = (factor_ids == factor_id).nonzero(as_tuple=True)[0]
+        if len(indices) == 0:
+            continue
+        group = waveforms[indices]
+        if factor != 1.0:
+            source_sampling_rate = int(factor * sampling_rate)
+            group = torchaudio.functional.resample(group, source_sampling_rate, sampling_rate)
+            new_lengths[indices] = torch.ceil(lengths[indices] * sampling_rate / source_sampling_rate).long()
+        for index, waveform in zip(indices.tolist(), group):
+            perturbed[index] = waveform
+    max_length = int(new_lengths.max())
+    output = waveforms.new_zeros((waveforms.shape[0], max_length))
+    for index, waveform in enumerate(perturbed):
+        length = min(int(new_lengths[index]), waveform.shape[0])
+        output[index, :length] = waveform[:length]
+    return output, new_lengths.clamp(max=max_length)
+
+
+def kaldi_fbank_batch(
+    waveforms: torch.Tensor, lengths: torch.Tensor, mel_filters: torch.Tensor, window: torch.Tensor
+) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Log-mel filter banks with the defaults of `torchaudio.compliance.kaldi.fbank` (25ms frames, 10ms shift, DC offset
+    removal, pre-emphasis, povey window, no dithering), as computed by `Speech2TextFeatureExtractor`.
+
+    Args:
+        waveforms: (Batch, Time) zero padded waveforms in the 16-bit integer range
+        lengths: (Batch,) numbers of valid samples
+        mel_filters: (FFT_LENGTH // 2 + 1, Mel) filter bank matrix
+        window: (FRAME_LENGTH,) analysis window
+
+    Returns:
+        features (Batch, Frames, Mel) and numbers of valid frames (Batch,)
+    """
+    if waveforms.shape[1] < FRAME_LENGTH:
+        waveforms = torch.nn.functional.pad(waveforms, (0, FRAME_LENGTH - waveforms.shape[1]))
+    frames = waveforms.unfold(-1, FRAME_LENGTH, HOP_LENGTH)
+    frames = frames - frames.mean(dim=-1, keepdim=True)
+    frames = torch.cat([frames[..., :1] * (1 - PREEMPHASIS), frames[..., 1:] - PREEMPHASIS * frames[..., :-1]], dim=-1)
+    spectrum = torch.fft.rfft(frames * window, n=FFT_LENGTH).abs() ** 2
+    features = torch.clamp(spectrum @ mel_filters, min=MEL_FLOOR).log()
+    num_frames = torch.where(
+        lengths >= FRAME_LENGTH, 1 + torch.div(lengths - FRAME_LENGTH, HOP_LENGTH, rounding_mode="floor"), 0
+    )
+    return features, num_frames
+
+
+def utterance_cmvn_batch(
+    features: torch.Tensor,
+    num_frames: torch.Tensor,
+    normalize_means: bool = True,
+    normalize_vars: bool = True,
+    padding_value: float = 0.0,
+) -> torch.Tensor:
+    """Per utterance mean and variance normalization over the valid frames, padding frames are set to `padding_value`.
+
+    Args:
+        features: (Batch, Frames, Mel)
+        num_frames: (Batch,) numbers of valid frames
+    """
+    mask = (torch.arange(features.shape[1], device=features.device)[None, :] < num_frames[:, None]).unsqueeze(-1)
+    counts = num_frames.clamp(min=1)[:, None, None].to(features.dtype)
+    mean = (features * mask).sum(dim=1, keepdim=True) / counts
+    std = (((features - mean) ** 2 * mask).sum(dim=1, keepdim=True) / counts).sqrt()
+    if normalize_means:
+        features = features - mean
+    if normalize_vars:
+        features = features / std
+    return features.masked_fill(~mask, padding_value)
+
+
+class BatchedSpeechPreprocessor(torch.nn.Module):
+    """Computes input features of `Speech2TextFeatureExtractor` for a batch of padded raw waveforms on device.
+
+    Speed perturbation and SpecAug are applied only in training mode and after the given number of training steps,
+    mirroring `steps_before_activation` of the dataset preprocessing config.
+
+    Args:
+        sampling_rate: sampling rate of the waveforms
+        num_mel_bins: number of mel filter banks
+        do_ceptral_normalize: whether to apply utterance CMVN
+        normalize_means: whether to normalize the means in CMVN
+        normalize_vars: whether to normalize the variances in CMVN
+        padding_value: value of the padding frames
+        speed_perturbation_factors: speed factors, speed perturbation is disabled if not set
+        speed_perturbation_steps_before_activation: number of training steps without speed perturbation
+        spec_aug_params: parameters of `BatchedSpecAug`, SpecAug is disabled if not set
+        spec_aug_steps_before_activation: number of training steps without SpecAug
+    """
+
+    def __init__(
+        self,
+        sampling_rate: int = 16_000,
+        num_mel_bins: int = 80,
+        do_ceptral_normalize: bool = True,
+        normalize_means: bool = True,
+        normalize_vars: bool = True,
+        padding_value: float = 0.0,
+        speed_perturbation_factors: Optional[Sequence[float]] = None,
+        speed_perturbation_steps_before_activation: int = 0,
+        spec_aug_params: Optional[Dict] = None,
+        spec_aug_steps_before_activation: int = 0,
+    ):
+        super().__init__()
+        self.sampling_rate = sampling_rate
+        self.do_ceptral_normalize = do_ceptral_normalize
+        self.normalize_means = normalize_means
+        self.normalize_vars = normalize_vars
+        self.padding_value = padding_value
+        self.speed_perturbation_factors = speed_perturbation_factors
+        self.speed_perturbation_steps_before_activation = speed_perturbation_steps_before_activation
+        self.spec_aug = BatchedSpecAug(**spec_aug_params) if spec_aug_params is not None else None
+        self.spec_aug_steps_before_activation = spec_aug_steps_before_activation
+
+        mel_filters = mel_filter_bank(
+            num_frequency_bins=FFT_LENGTH // 2,
+            num_mel_filters=num_mel_bins,
+            min_frequency=20,
+            max_frequency=sampling_rate // 2,
+            sampling_rate=sampling_rate,
+            norm=None,
+            mel_scale="kaldi",
+            triangularize_in_mel_space=True,
+        )
+        mel_filters = torch.nn.functional.pad(torch.from_numpy(mel_filters), (0, 0, 0, 1))
+        self.register_buffer("mel_filters", mel_filters.float(), persistent=False)
+        window = torch.from_numpy(window_function(FRAME_LENGTH, "povey", periodic=False))
+        self.register_buffer("window", window.float(), persistent=False)
+
+    @classmethod
+    def from_feature_extractor(
+        cls, feature_extractor: Speech2TextFeatureExtractor, **kwargs
+    ) -> "BatchedSpeechPreprocessor":
+        if not isinstance(feature_extractor, Speech2TextFeatureExtractor):
+            raise ValueError(
+                f"Batched preprocessing reproduces only Speech2TextFeatureExtractor, got {type(feature_extractor)}."
+            )
+        return cls(
+            sampling_rate=feature_extractor.sampling_rate,
+            num_mel_bins=feature_extractor.num_mel_bins,
+            do_ceptral_normalize=feature_extractor.do_ceptral_normalize,
+            normalize_means=feature_extractor.normalize_means,
+            normalize_vars=feature_extractor.normalize_vars,
+            padding_value=feature_extractor.padding_value,
+            **kwargs,
+        )
+
+    @classmethod
+    def from_config(
+        cls, config_path: str, feature_extractor: Speech2TextFeatureExtractor
+    ) -> "BatchedSpeechPreprocessor":
+        """Config holds optional `speed_perturbation` ({"factors", "steps_before_activation"}) and `spec_aug`
+        ({"params", "steps_before_activation"}) entries."""
+        with open(config_path) as config_handle:
+            config = json.load(config_handle)
+        speed_perturbation = config.get("speed_perturbation", {})
+        spec_aug = config.get("spec_aug", {})
+        return cls.from_feature_extractor(
+            feature_extractor,
+            speed_perturbation_factors=speed_perturbation.get("factors"),
+            speed_perturbation_steps_before_activation=speed_perturbation.get("steps_before_activation", 0),
+            spec_aug_params=spec_aug.get("params"),
+            spec_aug_steps_before_activation=spec_aug.get("steps_before_activation", 0),
+        )
+
+    @torch.no_grad()
+    def forward(
+        self, waveforms: torch.Tensor, attention_mask: Optional[torch.Tensor] = None, global_step: int = 0
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Args:
+            waveforms: (Batch, Time) zero padded waveforms
+            attention_mask: (Batch, Time) mask of the valid samples
+            global_step: current training step, used for the delayed activation of the augmentations
+
+        Returns:
+            features (Batch, Frames, Mel) and their attention mask (Batch, Frames)
+        """
+        waveforms = waveforms.float()
+        if attention_mask is not None:
+            lengths = attention_mask.sum(dim=-1)
+        else:
+            lengths = torch.full((waveforms.shape[0],), waveforms.shape[1], device=waveforms.device)
+
+        if (
+            self.training
+            and self.speed_perturbation_factors is not None
+            and global_step >= self.speed_perturbation_steps_before_activation
+        ):
+            waveforms, lengths = speed_perturb_batch(
+                waveforms, lengths, self.sampling_rate, self.speed_perturbation_factors
+            )
+
+        # Kaldi compliance: 16-bit signed integers
+        features, num_frames = kaldi_fbank_batch(waveforms * 2**15, lengths, self.mel_filters, self.window)
+        if self.do_ceptral_normalize:
+            features = utterance_cmvn_batch(
+                features, num_frames, self.normalize_means, self.normalize_vars, self.padding_value
+            )
+
+        if self.training and self.spec_aug is not None and global_step >= self.spec_aug_steps_before_activation:
+            features, _ = self.spec_aug(features, num_frames)
+
+        feature_attention_mask = (
+            torch.arange(features.shape[1], device=features.device)[None, :] < num_frames[:, None]
+        ).long()
+        return features, feature_attention_mask
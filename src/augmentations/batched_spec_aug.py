@@ -0,0 +1,179 @@
+"""Batched SpecAugment respecting per-utterance lengths, all utterances are augmented in a single vectorized pass."""
+from typing import Optional, Sequence, Tuple, Union
+
+import torch
+
+
+def lengths_to_tensor(x: torch.Tensor, x_lengths: Optional[torch.Tensor]) -> torch.Tensor:
+    if x_lengths is None:
+        return torch.full((x.shape[0],), x.shape[1], dtype=torch.long, device=x.device)
+    return torch.as_tensor(x_lengths, device=x.device).long()
+
+
+def sample_masks(
+    axis_lengths: torch.Tensor,
+    max_axis_length: int,
+    min_width: torch.Tensor,
+    max_width: torch.Tensor,
+    num_mask: int,
+) -> torch.Tensor:
+    """Samples `num_mask` intervals for every utterance that lie within its valid part of the axis.
+
+    Args:
+        axis_lengths: (Batch,) valid lengths of the masked axis
+        max_axis_length: padded length of the masked axis
+        min_width: (Batch,) inclusive lower bounds of the mask widths
+        max_width: (Batch,) exclusive upper bounds of the mask widths, no mask is applied if not above `min_width`
+
+    Returns:
+        mask (Batch, max_axis_length)
+    """
+    batch_size = axis_lengths.shape[0]
+    device = axis_lengths.device
+    width_range = (max_width - min_width).clamp(min=0)
+    uniform = torch.rand((batch_size, num_mask), device=device)
+    width = (min_width[:, None] + (uniform * width_range[:, None]).long()) * (width_range[:, None] > 0)
+    width = torch.minimum(width, axis_lengths[:, None])
+    uniform = torch.rand((batch_size, num_mask), device=device)
+    position = (uniform * (axis_lengths[:, None] - width + 1)).long()
+    arange = torch.arange(max_axis_length, device=device)[None, None, :]
+    mask = (arange >= position[..., None]) & (arange < (position + width)[..., None])
+    return mask.any(dim=1)
+
+
+def time_warp_batch(x: torch.Tensor, x_lengths: torch.Tensor, window: int = 80, mode: str = "bicubic") -> torch.Tensor:
+    """Warps every utterance around its own random center, frames in [0, center) are stretched to [0, warped) and
+    frames in [center, length) to [warped, length), padding frames are kept untouched.
+
+    Args:
+        x: (Batch, Time, Freq)
+        x_lengths: (Batch,)
+        window: time warp parameter
+        mode: interpolation mode of `grid_sample`, "bilinear", "bicubic" or "nearest"
+    """
+    batch_size, max_time, num_freq = x.shape
+    lengths = x_lengths.to(x.dtype)
+    can_warp = x_lengths - window > window
+    uniform = torch.rand((batch_size, 2), device=x.device)
+    center = window + (uniform[:, 0] * (lengths - 2 * window).clamp(min=1)).floor()
+    warped = center - window + (uniform[:, 1] * 2 * window).floor() + 1
+    center = torch.where(can_warp, center, lengths)
+    warped = torch.where(can_warp, warped, lengths)
+
+    # source position of every output frame, follows `interpolate(..., align_corners=False)` on both segments
+    time = torch.arange(max_time, device=x.device, dtype=x.dtype)[None, :]
+    left = (time + 0.5) * (center / warped)[:, None] - 0.5
+    right_scale = ((lengths - center) / (lengths - warped).clamp(min=1))[:, None]
+    right = center[:, None] + (time - warped[:, None] + 0.5) * right_scale - 0.5
+    source = torch.where(time < warped[:, None], left, right)
+    source = torch.where(time < lengths[:, None], source, time)
+
+    freq = torch.arange(num_freq, device=x.device, dtype=x.dtype)
+    grid = torch.stack(
+        [
+            ((2 * freq + 1) / num_freq - 1)[None, None, :].expand(batch_size, max_time, num_freq),
+            ((2 * source + 1) / max_time - 1)[:, :, None].expand(batch_size, max_time, num_freq),
+        ],
+        dim=-1,
+    )
+    warped_x = torch.nn.functional.grid_sample(x[:, None], grid, mode=mode, padding_mode="border", align_corners=False)[
+        :, 0
+    ]
+    is_warped = can_warp[:, None] & (time < lengths[:, None])
+    return torch.where(is_warped[..., None], warped_x, x)
+
+
+class BatchedSpecAug(torch.nn.Module):
+    """Drop-in replacement of `augmentations.spec_aug.SpecAug` that takes per-utterance lengths into account.
+
+    Masks are sampled independently for every utterance and never cover its padding, time mask widths given by
+    `time_mask_width_ratio_range` are relative to the length of the utterance instead of the padded batch, and time
+    warping uses a separate center for every utterance.
+    """
+
+    def __init__(
+        self,
+        apply_time_warp: bool = True,
+        time_warp_window: int = 5,
+        time_warp_mode: str = "bicubic",
+        apply_freq_mask: bool = True,
+        freq_mask_width_range: Union[int, Sequence[int]] = (0, 20),
+        num_freq_mask: int = 2,
+        apply_time_mask: bool = True,
+        time_mask_width_range: Optional[Union[int, Sequence[int]]] = None,
+        time_mask_width_ratio_range: Optional[Union[float, Sequence[float]]] = None,
+        num_time_mask: int = 2,
+    ):
+        if not apply_time_warp and not apply_time_mask and not apply_freq_mask:
+            raise ValueError("Either one of time_warp, time_mask, or freq_mask should be applied")
+        if apply_time_mask and (time_mask_width_range is not None) and (time_mask_width_ratio_range is not None):
+            raise ValueError('Either one of "time_mask_width_range" or "time_mask_width_ratio_range" can be used')
+        if apply_time_mask and time_mask_width_range is None and time_mask_width_ratio_range is None:
+            raise ValueError('Either one of "time_mask_width_range" or "time_mask_width_ratio_range" should be used.')
+        super().__init__()
+        self.apply_time_warp = apply_time_warp
+        self.time_warp_window = time_warp_window
+        self.time_warp_mode = "bilinear" if time_warp_mode == "linear" else time_warp_mode
+        self.apply_freq_mask = apply_freq_mask
+        self.freq_mask_width_range = self._to_range(freq_mask_width_range, 0)
+        self.num_freq_mask = num_freq_mask
+        self.apply_time_mask = apply_time_mask
+        self.time_mask_width_range = (
+            self._to_range(time_mask_width_range, 0) if time_mask_width_range is not None else None
+        )
+        self.time_mask_width_ratio_range = (
+            self._to_range(time_mask_width_ratio_range, 0.0) if time_mask_width_ratio_range is not None else None
+        )
+        self.num_time_mask = num_time_mask
+
+    @staticmethod
+    def _to_range(value, lower):
+        value = (lower, value) if isinstance(value, (int, float)) else tuple(value)
+        if len(value) != 2 or value[1] < value[0]:
+            raise ValueError(f"Mask width range must be (min_width, max_width), got {value}")
+        return value
+
+    def extra_repr(self):
+        return (
+            f"time_warp={self.apply_time_warp}, freq_mask_width_range={self.freq_mask_width_range}, "
+            f"time_mask_width_range={self.time_mask_width_range or self.time_mask_width_ratio_range}"
+        )
+
+    def forward(
+        self, x: torch.Tensor, x_lengths: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        """
+        Args:
+            x: (Time, Freq) or (Batch, Time, Freq)
+            x_lengths: (Batch,) numbers of valid frames, all frames are valid if not set
+        """
+        if x.ndim == 2:
+            x = x[None, ...]
+        elif x.ndim != 3:
+            raise ValueError("Please ensure input has (T,H) or (B,T,H) shape.")
+        batch_size, max_time, num_freq = x.shape
+        lengths = lengths_to_tensor(x, x_lengths)
+
+        if self.apply_time_warp:
+            x = time_warp_batch(x, lengths, window=self.time_warp_window, mode=self.time_warp_mode)
+
+        if self.apply_freq_mask:
+            freq_mask = sample_masks(
+                torch.full_like(lengths, num_freq),
+                num_freq,
+                torch.full_like(lengths, self.freq_mask_width_range[0]),
+                torch.full_like(lengths, self.freq_mask_width_range[1]),
+                self.num_freq_mask,
+            )
+            x = x.masked_fill(freq_mask[:, None, :], 0.0)
+        if self.apply_time_mask:
+            if self.time_mask_width_range is not None:
+                min_width = torch.full_like(lengths, self.time_mask_width_range[0])
+                max_width = torch.full_like(lengths, self.time_mask_width_range[1])
+            else:
+                min_width = (lengths * self.time_mask_width_ratio_range[0]).floor().long().clamp(min=0)
+                max_width = torch.minimum((lengths * self.time_mask_width_ratio_range[1]).floor().long(), lengths)
+            time_mask = sample_masks(lengths, max_time, min_width, max_width, self.num_time_mask)
+            x = x.masked_fill(time_mask[:, :, None], 0.0)
+
+        return x, x_lengths
@@ -0,0 +1,84 @@
+"""Compares the ESPnet SpecAug with the batched length-aware implementation on random padded batches."""
+import time
+from dataclasses import dataclass, field
+
+import torch
+from transformers import HfArgumentParser
+
+from augmentations.batched_spec_aug import BatchedSpecAug
+from augmentations.spec_aug import SpecAug
+
+
+@dataclass
+class BenchmarkArguments:
+    """Arguments of the SpecAug benchmark"""
+
+    batch_size: int = field(default=32, metadata={"help": "Number of utterances in a batch."})
+    max_frames: int = field(default=1500, metadata={"help": "Number of frames of the longest utterance."})
+    min_length_ratio: float = field(
+        default=0.3, metadata={"help": "Length of the shortest utterance relative to the longest one."}
+    )
+    num_mel_bins: int = field(default=80, metadata={"help": "Number of features per frame."})
+    steps: int = field(default=50, metadata={"help": "Number of timed calls of each implementation."})
+    device: str = field(default="cuda" if torch.cuda.is_available() else "cpu", metadata={"help": "Device to use."})
+    apply_time_warp: bool = field(default=True, metadata={"help": "Whether to include time warping."})
+
+
+def timed(module: torch.nn.Module, x: torch.Tensor, x_lengths: torch.Tensor, steps: int) -> float:
+    """Average wall time of a single call in seconds, inputs are copied as SpecAug may work in place."""
+    module(x.clone(), x_lengths)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(steps):
+        module(x.clone(), x_lengths)
+    if x.is_cuda:
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / steps
+
+
+def padding_frames_masked(module: torch.nn.Module, x: torch.Tensor, x_lengths: torch.Tensor) -> int:
+    """Number of padding frames hit by a time mask, padding holds a non-zero value to make the masks visible."""
+    augmented, _ = module(x.clone(), x_lengths)
+    padding = torch.arange(x.shape[1], device=x.device)[None, :] >= x_lengths[:, None]
+    return int((augmented.view_as(x) == 0).all(dim=-1)[padding].sum())
+
+
+def valid_frames_masked(module: torch.nn.Module, x: torch.Tensor, x_lengths: torch.Tensor) -> float:
+    """Ratio of valid frames that are completely masked."""
+    augmented, _ = module(x.clone(), x_lengths)
+    valid = torch.arange(x.shape[1], device=x.device)[None, :] < x_lengths[:, None]
+    return float((augmented.view_as(x) == 0).all(dim=-1)[valid].float().mean())
+
+
+if __name__ == "__main__":
+    parser = HfArgumentParser((BenchmarkArguments,))
+    (args,) = parser.parse_args_into_dataclasses()
+
+    x_lengths = torch.randint(
+        int(args.max_frames * args.min_length_ratio), args.max_frames + 1, (args.batch_size,), device=args.device
+    )
+    x_lengths[0] = args.max_frames
+    x = torch.randn(args.batch_size, args.max_frames, args.num_mel_bins, device=args.device) + 10
+    x.masked_fill_((torch.arange(args.max_frames, device=args.device)[None, :] >= x_lengths[:, None])[..., None], -1)
+
+    spec_aug_params = {
+        "apply_time_warp": args.apply_time_warp,
+        "time_warp_window": 5,
+        "time_warp_mode": "bicubic",
+        "freq_mask_width_range": (0, 27),
+        "num_freq_mask": 2,
+        "time_mask_width_ratio_range": (0, 0.05),
+        "num_time_mask": 2,
+    }
+    implementations = {
+        "SpecAug": SpecAug(**spec_aug_params).to(args.device),
+        "BatchedSpecAug": BatchedSpecAug(**spec_aug_params).to(args.device),
+    }
+    print(f"Batch {tuple(x.shape)} on {args.device}, lengths {int(x_lengths.min())}-{int(x_lengths.max())}")
+    for name, module in implementations.items():
+        print(
+            f"{name:>15}: {timed(module, x, x_lengths, args.steps) * 1000:8.3f} ms/batch, "
+            f"padding frames masked {padding_frames_masked(module, x, x_lengths):6d}, "
+            f"valid frames masked {valid_frames_masked(module, x, x_lengths):.3f}"
+        )
@@ -1,5 +1,8 @@
 """AudioFolderVAD dataset."""
-from typing import TYPE_CHECKING, List, Optional, Union
+import hashlib
+import json
+import os
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Union
 
 import datasets
 import torch
@@ -9,15 +12,135 @@ from datasets.splits import SplitGenerator
 from datasets.tasks import AudioClassification
 
 # pylint: disable=no-name-in-module
-from multiprocess import set_start_method
+from multiprocess import get_context, set_start_method
 from pyannote.audio import Model
 from pyannote.audio.pipelines import VoiceActivityDetection
 
+from utilities.audio_utils import resample
+
 if TYPE_CHECKING:
     pass
 logger = datasets.utils.logging.get_logger(__name__)
 
 
+class VADSegmenter:
+    """Cuts audio files to the speech segments found by the pyannote VAD pipeline.
+
+    The pipeline is loaded lazily, i.e. once in every process using the segmenter. Annotations are cached in
+    `cache_dir` under the hash of the file content and of the VAD parameters, so re-runs skip the segmentation.
+    """
+
+    def __init__(
+        self,
+        vad_model: str,
+        vad_device: str,
+        vad_batch_size: int,
+        vad_min_duration_on: float,
+        vad_min_duration_off: float,
+        sampling_rate: int,
+        cache_dir: Optional[str] = None,
+        use_auth_token: Optional[str] = None,
+    ):
+        self.vad_model = vad_model
+        self.vad_device = vad_device
+        self.vad_batch_size = vad_batch_size
+        self.params = {
+            # remove speech regions shorter than that many seconds.
+            "min_duration_on": vad_min_duration_on,
+            # fill non-speech regions shorter than that many seconds.
+            "min_duration_off": vad_min_duration_off,
+        }
+        self.sampling_rate = sampling_rate
+        self.cache_dir = cache_dir
+        self.use_auth_token = use_auth_token
+        self._pipeline = None
+
+    def __getstate__(self):
+        # the pipeline is loaded again by each worker
+        return {**self.__dict__, "_pipeline": None}
+
+    @property
+    def pipeline(self) -> VoiceActivityDetection:
+        if self._pipeline is None:
+            model = Model.from_pretrained(self.vad_model, use_auth_token=self.use_auth_token)
+            self._pipeline = VoiceActivityDetection(
+                segmentation=model, batch_size=self.vad_batch_size, device=torch.device(self.vad_device)
+            )
+            self._pipeline.instantiate(self.params)
+        return self._pipeline
+
+    def file_hash(self, path: str) -> str:
+        # the pipeline runs on the waveform resampled to `sampling_rate`, so the rate is a part of the key as well
+        vad_config = {"model": self.vad_model, "sampling_rate": self.sampling_rate, **self.params}
+        sha = hashlib.sha1(json.dumps(vad_config, sort_keys=True).encode())
+        with open(path, "rb") as file:
+            for block in iter(lambda: file.read(1 << 20), b""):
+                sha.update(block)
+        return sha.hexdigest()
+
+    def get_segments(self, path: str, waveform: torch.Tensor, sample_rate: int) -> List[Tuple[float, float]]:
+        """Start and end times of the speech segments in seconds"""
+        cache_file = None
+        if self.cache_dir is not None:
+            cache_file = os.path.join(self.cache_dir, f"{self.file_hash(path)}.json")
+            if os.path.exists(cache_file):
+                with open(cache_file) as cache_handle:
+                    return [tuple(segment) for segment in json.load(cache_handle)]
+
+        annotation = self.pipeline({"waveform": waveform, "sample_rate": sample_rate})
+        segments = [(segment.start, segment.end) for segment in annotation.itersegments()]
+
+        if cache_file is not None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # written under a temporary name first, so that concurrent workers never read a partial file
+            with open(f"{cache_file}.{os.getpid()}", "w") as cache_handle:
+                json.dump(segments, cache_handle)
+            os.replace(f"{cache_file}.{os.getpid()}", cache_file)
+        return segments
+
+    def __call__(self, item: Tuple[str, Dict[str, Any]]) -> List[Tuple[str, Dict[str, Any]]]:
+        """Returns the examples of all the speech segments of a single file"""
+        example_id, example = item
+        audio_encoder = datasets.Audio(sampling_rate=self.sampling_rate, mono=True)
+        # pylint: disable=no-member
+        waveform, sample_rate = torchaudio.load(example["audio"])
+        # segments are stored at the target sampling rate, so they are not resampled at every load
+        waveform, sample_rate = resample(waveform, sample_rate, self.sampling_rate), self.sampling_rate
+
+        segment_examples = []
+        for start, end in self.get_segments(example["audio"], waveform, sample_rate):
+            chunk = waveform[:, int(start * sample_rate) : int(end * sample_rate)].squeeze().numpy()
+            chunk_shape = chunk.shape
+
+            if len(chunk_shape) > 1 and chunk_shape[0] > 1:
+                raise ValueError(f"Expected mono audio, please fix recording {example['audio']}")
+
+            segment_examples.append(
+                (
+                    f"{example_id}_{start:.2f}_{end:.2f}",
+                    {
+                        **example,
+                        "audio": audio_encoder.encode_example({"array": chunk, "sampling_rate": sample_rate}),
+                        "input_len": len(chunk) / self.sampling_rate,
+                    },
+                )
+            )
+        return segment_examples
+
+
+# segmenter of the pool worker, it is passed once per worker by the pool initializer
+worker_segmenter: Optional[VADSegmenter] = None
+
+
+def init_vad_worker(segmenter: VADSegmenter):
+    global worker_segmenter
+    worker_segmenter = segmenter
+
+
+def segment_in_worker(item: Tuple[str, Dict[str, Any]]) -> List[Tuple[str, Dict[str, Any]]]:
+    return worker_segmenter(item)
+
+
 class AudioFolderConfig(folder_based_builder.FolderBasedBuilderConfig):
     """Builder Config for AudioFolder."""
 
@@ -44,20 +167,29 @@ class AudioFolderVAD(folder_based_builder.FolderBasedBuilder):
         vad_batch_size: int = 1024,
         vad_min_duration_on: float = 0.0,
         vad_min_duration_off: float = 0.0,
+        vad_num_workers: int = 1,
+        vad_cache_dir: Optional[str] = None,
         sampling_rate: int = 16000,
         **kwargs,
     ):
+        """
+        :param vad_num_workers: number of processes segmenting the files of a single preparation job, each of them
+            loads the VAD pipeline once, segments are yielded in the order of the files. It cannot be combined with
+            `num_proc` > 1, as the preparation jobs are daemonic processes that are not allowed to start the pool
+        :param vad_cache_dir: directory of the VAD annotations cached by the hash of the file content
+        """
         super().__init__(*args, **kwargs)
-        device = torch.device(vad_device)
-        model = Model.from_pretrained(vad_model, use_auth_token=kwargs.get("use_auth_token", None))
-        self.vad_pipeline = VoiceActivityDetection(segmentation=model, batch_size=vad_batch_size, device=device)
-        params = {
-            # remove speech regions shorter than that many seconds.
-            "min_duration_on": vad_min_duration_on,
-            # fill non-speech regions shorter than that many seconds.
-            "min_duration_off": vad_min_duration_off,
-        }
-        self.vad_pipeline.instantiate(params)
+        self.segmenter = VADSegmenter(
+            vad_model=vad_model,
+            vad_device=vad_device,
+            vad_batch_size=vad_batch_size,
+            vad_min_duration_on=vad_min_duration_on,
+            vad_min_duration_off=vad_min_duration_off,
+            sampling_rate=sampling_rate,
+            cache_dir=vad_cache_dir,
+            use_auth_token=kwargs.get("use_auth_token", None),
+        )
+        self.vad_num_workers = vad_num_workers
         self.sampling_rate = sampling_rate
 
     def _split_generators(self, dl_manager):
@@ -73,31 +205,27 @@ class AudioFolderVAD(folder_based_builder.FolderBasedBuilder):
         num_proc: Optional[int] = None,
         max_shard_size: Optional[Union[int, str]] = None,
     ):
+        if num_proc is not None and num_proc > 1 and self.vad_num_workers > 1:
+            raise ValueError(
+                f"vad_num_workers={self.vad_num_workers} cannot be combined with num_proc={num_proc}, the preparation "
+                "jobs cannot start their own pools of VAD workers. Use either of them to parallelize the segmentation."
+            )
         set_start_method("spawn", force=True)
         super()._prepare_split(split_generator, check_duplicate_keys, file_format, num_proc, max_shard_size)
 
     def _generate_examples(self, files, metadata_files, split_name, add_metadata, add_labels):
-        audio_encoder = datasets.Audio(sampling_rate=self.sampling_rate, mono=True)
-        for example_id, example in super()._generate_examples(
-            files, metadata_files, split_name, add_metadata, add_labels
-        ):
-            # pylint: disable=no-member
-            waveform, sample_rate = torchaudio.load(example["audio"])
-
-            annotation = self.vad_pipeline({"waveform": waveform, "sample_rate": sample_rate})
-
-            for segment in annotation.itersegments():
-                chunk = waveform[:, int(segment.start * sample_rate) : int(segment.end * sample_rate)].squeeze().numpy()
-                chunk_shape = chunk.shape
-
-                if len(chunk_shape) > 1 and chunk_shape[0] > 1:
-                    raise ValueError(f"Expected mono audio, please fix recording {example['audio']}")
-
-                yield f"{example_id}_{segment.start:.2f}_{segment.end:.2f}", {
-                    **example,
-                    "audio": audio_encoder.encode_example({"array": chunk, "sampling_rate": sample_rate}),
-                    "input_len": len(chunk) / self.sampling_rate,
-                }
+        examples = super()._generate_examples(files, metadata_files, split_name, add_metadata, add_labels)
+        if self.vad_num_workers <= 1:
+            for example in examples:
+                yield from self.segmenter(example)
+            return
+
+        # spawned workers, as the pipeline may use CUDA
+        with get_context("spawn").Pool(
+            self.vad_num_workers, initializer=init_vad_worker, initargs=(self.segmenter,)
+        ) as pool:
+            for segment_examples in pool.imap(segment_in_worker, examples):
+                yield from segment_examples
 
 
 # Obtained with:
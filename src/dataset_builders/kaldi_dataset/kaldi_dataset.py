@@ -3,6 +3,7 @@ import io
 import logging
 import math
 import os
+import re
 import wave
 from itertools import groupby
 from typing import Iterable, List, Optional, Tuple, Union
@@ -12,30 +13,67 @@ import kaldiio
 import librosa
 import numpy as np
 
+from utilities.audio_utils import resample
+
 _FILEPATHS = {
     "feats": "wav.scp",
     "segments": "segments",
     "transcripts": "text",
     "channels2recordings": "reco2file_and_channel",
 }
+# scp entry pointing into an ark file at a byte offset, optionally with slices, e.g. "feats.ark:1234"
+_ARK_OFFSET_PATTERN = re.compile(r":\d+(\[.*\])?$")
 
 
 class KaldiDataset(datasets.GeneratorBasedBuilder):
     """Dataset builder for Fisher dataset"""
 
     DEFAULT_WRITER_BATCH_SIZE = 50  # the default size of the batch may not fit in memory
+    AUDIO_STORAGES = ("wav", "pcm_memmap")
 
-    def __init__(self, data_dir: Optional[str], splits: List[str], sampling_rate: int = 16000, **kwargs):
+    def __init__(
+        self,
+        data_dir: Optional[str],
+        splits: List[str],
+        sampling_rate: int = 16000,
+        audio_storage: str = "wav",
+        pcm_store_dir: Optional[str] = None,
+        **kwargs,
+    ):
+        """
+        :param audio_storage: "wav" stores every segment as WAV bytes decoded by `datasets.Audio`, "pcm_memmap" writes
+            int16 samples of each recording once to raw PCM shards and stores only references (shard, offset, length)
+            that are sliced from a memory map at load time. The audio column is then a struct instead of `Audio`, so
+            `load_multiple_datasets` cannot concatenate it with splits of datasets using `Audio` columns
+        :param pcm_store_dir: directory of the PCM shards, defaults to the datasets cache, the shards have to stay there
+            as long as the dataset is used
+        """
+        if audio_storage not in self.AUDIO_STORAGES:
+            raise ValueError(f"Unknown audio storage {audio_storage}, expected one of {self.AUDIO_STORAGES}.")
+        self.audio_storage = audio_storage
+        if audio_storage != "wav" and kwargs.get("config_name") is None:
+            # separates the cache of the dataset from the one with the default storage
+            kwargs["config_name"] = audio_storage
         super().__init__(data_dir=data_dir, **kwargs)
         self.sampling_rate = sampling_rate
         self.data_dir = data_dir
         self.splits = splits
+        self.pcm_store_dir = pcm_store_dir or os.path.join(self._cache_dir_root, "kaldi_pcm_shards", self.config_id)
 
     def _info(self):
+        if self.audio_storage == "pcm_memmap":
+            audio_feature = {
+                "shard": datasets.Value("string"),
+                "offset": datasets.Value("int64"),
+                "length": datasets.Value("int64"),
+                "sampling_rate": datasets.Value("int32"),
+            }
+        else:
+            audio_feature = datasets.Audio(sampling_rate=16_000)
         return datasets.DatasetInfo(
             features=datasets.Features(
                 {
-                    "audio": datasets.Audio(sampling_rate=16_000),
+                    "audio": audio_feature,
                     "labels": datasets.Value("string"),
                     "uttid": datasets.Value("string"),
                     "recording": datasets.Value("string"),
@@ -93,14 +131,18 @@ class KaldiDataset(datasets.GeneratorBasedBuilder):
             """If segments file does not exist, create dummy mapping (segment_id -> (segment_id, 0, -1))"""
             segments = dict(map(lambda s: (s, (s, 0, -1)), texts.keys()))
 
-        # load kaldiio feature generator
+        # scp entries are kept as plain strings (ark path with the byte offset, wav path or command), so the list of
+        # recordings can be sharded among the preparation processes, each of them opening the ark files on its own
         featfile = os.path.join(self.data_dir, split, _FILEPATHS["feats"])
-        feats_generator = kaldiio.load_scp(featfile)
+        with open(featfile) as file:
+            scp_entries = dict(self._split_text_string(line) for line in file if line.strip())
         segments = [(*segments[uttid], uttid, transcript) for (uttid, transcript) in texts.items()]
-        grouped_by_recordings = [(k, list(v)) for k, v in groupby(sorted(segments), key=lambda segment: segment[0])]
+        grouped_by_recordings = [
+            (k, scp_entries[k], list(v)) for k, v in groupby(sorted(segments), key=lambda segment: segment[0])
+        ]
         return {
             "recordings": grouped_by_recordings,
-            "features": feats_generator,
+            "split": split,
         }
 
     @staticmethod
@@ -123,19 +165,37 @@ class KaldiDataset(datasets.GeneratorBasedBuilder):
         wav_bytes = wav_buffer.getvalue()
         return wav_bytes
 
-    def _generate_examples(self, recordings, features):
-        """Generator for split examples fetching"""
-        for recording, segments in recordings:
-            sampling_rate, audio = features[recording]
-            if audio.dtype == np.int16:
-                audio = librosa.util.buf_to_float(audio, n_bytes=audio.dtype.itemsize)
+    @staticmethod
+    def _load_recording(recording, scp_entry, fd_dict) -> Tuple[int, np.ndarray]:
+        """Load int16 samples of a single channel recording, ark files stay open in `fd_dict` for the next recordings"""
+        is_ark = _ARK_OFFSET_PATTERN.search(scp_entry) is not None
+        sampling_rate, audio = kaldiio.load_mat(scp_entry, fd_dict=fd_dict if is_ark else None)
+        if audio.dtype != np.int16:
+            raise ValueError("Data type of input audio is not int16.")
+        if len(audio.shape) > 1:
+            raise ValueError(f"Recording {recording} does not have single channel.")
+        return sampling_rate, audio
+
+    def _generate_examples(self, recordings, split):
+        """Generator for split examples fetching, `recordings` is a shard of the split with `num_proc` > 1"""
+        fd_dict = {}
+        try:
+            if self.audio_storage == "pcm_memmap":
+                yield from self._generate_pcm_examples(recordings, split, fd_dict)
             else:
-                raise ValueError("Data type of input audio is not int16.")
-            if len(audio.shape) > 1:
-                raise ValueError(f"Recording {recording} does not have single channel.")
-            if sampling_rate != self.sampling_rate or len(audio.shape) > 1:
+                yield from self._generate_wav_examples(recordings, fd_dict)
+        finally:
+            for fd in fd_dict.values():
+                fd.close()
+
+    def _generate_wav_examples(self, recordings, fd_dict):
+        """Yields segments as WAV bytes"""
+        for recording, scp_entry, segments in recordings:
+            sampling_rate, audio = self._load_recording(recording, scp_entry, fd_dict)
+            audio = librosa.util.buf_to_float(audio, n_bytes=audio.dtype.itemsize)
+            if sampling_rate != self.sampling_rate:
                 logging.debug(f"Resampled {recording} from {sampling_rate} to {self.sampling_rate}")
-                audio = librosa.resample(audio, orig_sr=sampling_rate, target_sr=self.sampling_rate)
+                audio = resample(audio, sampling_rate, self.sampling_rate)
             sorted_segments = sorted(segments, key=lambda x: x[1])
             for index, (_, start, end, uttid, transcript) in enumerate(sorted_segments):
                 audio_cropped = self._crop_audio(audio, self.sampling_rate, start, end)
@@ -149,11 +209,57 @@ class KaldiDataset(datasets.GeneratorBasedBuilder):
                     "input_len": len(audio_cropped) / self.sampling_rate,
                 }
 
+    def _generate_pcm_examples(self, recordings, split, fd_dict):
+        """Writes int16 samples of the recordings to a single PCM shard and yields segments as references into it"""
+        if not recordings:
+            return
+        os.makedirs(self.pcm_store_dir, exist_ok=True)
+        # recordings are distributed among the preparation jobs, the first one names the shard of the job
+        shard = os.path.join(self.pcm_store_dir, f"{split}-{recordings[0][0]}.pcm")
+        shard_offset = 0
+        with open(shard, "wb") as shard_handle:
+            for recording, scp_entry, segments in recordings:
+                sampling_rate, audio = self._load_recording(recording, scp_entry, fd_dict)
+                if sampling_rate != self.sampling_rate:
+                    logging.debug(f"Resampled {recording} from {sampling_rate} to {self.sampling_rate}")
+                    audio = resample(
+                        librosa.util.buf_to_float(audio, n_bytes=audio.dtype.itemsize),
+                        sampling_rate,
+                        self.sampling_rate,
+                    )
+                    audio = np.clip(np.round(audio * 32768), -32768, 32767).astype(np.int16)
+                shard_handle.write(np.ascontiguousarray(audio, dtype="<i2").tobytes())
+                sorted_segments = sorted(segments, key=lambda x: x[1])
+                for index, (_, start, end, uttid, transcript) in enumerate(sorted_segments):
+                    start_sample, end_sample = self._segment_bounds(len(audio), self.sampling_rate, start, end)
+                    text = self.preprocess_text(transcript)
+                    yield f"{recording}_{index}", {
+                        "audio": {
+                            "shard": shard,
+                            "offset": shard_offset + start_sample,
+                            "length": end_sample - start_sample,
+                            "sampling_rate": self.sampling_rate,
+                        },
+                        "labels": text,
+                        "uttid": uttid,
+                        "recording": recording,
+                        "turn_index": index,
+                        "input_len": (end_sample - start_sample) / self.sampling_rate,
+                    }
+                shard_offset += len(audio)
+
     @staticmethod
     def _parse_segment_info(segment_key, uri, start, end):
         """Parse segment info"""
         return segment_key, (uri, float(start), float(end))
 
+    @staticmethod
+    def _segment_bounds(n_samples, sampling_rate, start, end):
+        """Sample indices of the segment, clipped to the recording as slicing in `_crop_audio` does"""
+        start_sample = min(math.floor(sampling_rate * start), n_samples)
+        end_sample = min(math.ceil(end * sampling_rate), n_samples) if end != -1 else n_samples - 1
+        return start_sample, max(end_sample, start_sample)
+
     @staticmethod
     def _crop_audio(audio, sampling_rate, start, end):
         """Crop audio"""
@@ -16,12 +16,24 @@ class DatasetArguments:
     output_dir: Optional[str] = field(default=None, metadata={"help": "The directory to save the processed dataset."})
     num_proc: Optional[int] = field(default=1, metadata={"help": "The number of processes to use."})
     regenerate: Optional[bool] = field(default=False, metadata={"help": "Whether to regenerate the dataset."})
+    audio_storage: Optional[str] = field(
+        default=None,
+        metadata={"help": "Audio storage of the kaldi dataset builder, `wav` or `pcm_memmap` (int16 PCM shards)."},
+    )
+    pcm_store_dir: Optional[str] = field(
+        default=None, metadata={"help": "The directory of the PCM shards with the `pcm_memmap` audio storage."}
+    )
 
 
 if __name__ == "__main__":
     parser = HfArgumentParser((DatasetArguments,))
 
     (args,) = parser.parse_args_into_dataclasses()
+    builder_kwargs = {}
+    if args.audio_storage is not None:
+        builder_kwargs["audio_storage"] = args.audio_storage
+    if args.pcm_store_dir is not None:
+        builder_kwargs["pcm_store_dir"] = args.pcm_store_dir
 
     dataset = datasets.load_dataset(
         args.dataset_builder,
@@ -32,6 +44,7 @@ if __name__ == "__main__":
         download_mode=datasets.DownloadMode.FORCE_REDOWNLOAD
         if args.regenerate
         else datasets.DownloadMode.REUSE_DATASET_IF_EXISTS,
+        **builder_kwargs,
     )
     if args.output_dir is not None:
         dataset.save_to_disk(args.output_dir, num_proc=args.num_proc)
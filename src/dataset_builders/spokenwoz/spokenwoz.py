@@ -1,4 +1,5 @@
 """Dataset builder module for the raw audio version of the HOW2 dataset"""
+import math
 import sys
 import string
 import re
@@ -7,7 +8,15 @@ import json
 import pandas as pd
 from typing import Optional, List
 import os
-import torchaudio
+import numpy as np
+import soundfile as sf
+
+from utilities.audio_utils import resample
+
+SAMPLING_RATE = 16000
+CHANNELS = {'user': 0, 'system': 1}
+# seconds of the neighbouring audio resampled together with a turn, so its edges are not distorted by the zero padding
+RESAMPLING_MARGIN = 0.01
 
 
 class SpokenWOZ(datasets.GeneratorBasedBuilder):
@@ -15,12 +24,36 @@ class SpokenWOZ(datasets.GeneratorBasedBuilder):
 
     BUILDER_CONFIG_CLASS = datasets.BuilderConfig
 
-    def __init__(self, data_dir: Optional[str], splits: List[str] = [], **kwargs):
+    def __init__(self, data_dir: Optional[str], splits: List[str] = [], context_by_reference: bool = False, **kwargs):
+        # examples hold only their conversation id and turn position instead of the context, the context is resolved
+        # from a turn table built from the dataset itself (see `utilities.context_utils.build_turn_table`)
+        self.context_by_reference = context_by_reference
+        if context_by_reference and kwargs.get("config_name") is None:
+            kwargs["config_name"] = "context_by_reference"
         super().__init__(data_dir=data_dir, **kwargs)
         self.data_dir = data_dir
         self.splits = splits if splits else ['dev', 'train', 'test']
 
     def _info(self):
+        if self.context_by_reference:
+            context_features = {
+                "conversation_id": datasets.Value("string"),
+                "conversation_turn": datasets.Value("int32"),
+            }
+        else:
+            context_features = {
+                # TODO: subsequently convert to something consistent with fisher..
+                "context": datasets.Sequence(feature={
+                    "turn_index": datasets.Value("int32"),
+                    "text": datasets.Value("string"),
+                    "span_info": datasets.Sequence(feature=datasets.Sequence(feature=datasets.Value('string'))),
+                    "dialog_act": datasets.Value('string'),
+                    "metadata": datasets.Value('string'),
+                    "tag": datasets.ClassLabel(num_classes=2, names=['user', 'system']),
+                    "start_time": datasets.Value("int32"),
+                    "end_time": datasets.Value("int32"),
+                }),
+            }
         return datasets.DatasetInfo(
             features=datasets.Features(
                 {
@@ -34,17 +67,7 @@ class SpokenWOZ(datasets.GeneratorBasedBuilder):
                     "tag": datasets.ClassLabel(num_classes=2, names=['user', 'system']),
                     "start_time": datasets.Value("int32"),
                     "end_time": datasets.Value("int32"),
-                    # TODO: subsequently convert to something consistent with fisher..
-                    "context": datasets.Sequence(feature={
-                        "turn_index": datasets.Value("int32"),
-                        "text": datasets.Value("string"),
-                        "span_info": datasets.Sequence(feature=datasets.Sequence(feature=datasets.Value('string'))),
-                        "dialog_act": datasets.Value('string'),
-                        "metadata": datasets.Value('string'),
-                        "tag": datasets.ClassLabel(num_classes=2, names=['user', 'system']),
-                        "start_time": datasets.Value("int32"),
-                        "end_time": datasets.Value("int32"),
-                    }),
+                    **context_features,
                 }
             ),
             supervised_keys=None,
@@ -91,60 +114,91 @@ class SpokenWOZ(datasets.GeneratorBasedBuilder):
             'features': features
         }
 
+    @staticmethod
+    def _read_turn(audio_file: sf.SoundFile, channel: int, start_time: int, end_time: int) -> np.ndarray:
+        """Reads int16 samples of a single turn, times are in milliseconds. Only the frames of the turn are read from
+        the file, so the rest of the long dialogue recording is never decoded nor resampled. The read starts at a frame
+        that falls on a 16 kHz sample (a multiple of 441 frames at 44.1 kHz), so the resampling kernel is in the same
+        phase as for the whole recording and the samples match slicing it up to the float32 rounding."""
+        sr = audio_file.samplerate
+        if sr == SAMPLING_RATE:
+            audio_file.seek(min(start_time * 16, audio_file.frames))
+            return audio_file.read(max(end_time * 16 - start_time * 16, 0), dtype='int16', always_2d=True)[:, channel]
+
+        margin = int(RESAMPLING_MARGIN * sr)
+        period = sr // math.gcd(sr, SAMPLING_RATE)
+        first = max(start_time * sr // 1000 - margin, 0)
+        first = min(first - first % period, audio_file.frames)
+        last = min(-(-end_time * sr // 1000) + margin, audio_file.frames)
+        if last <= first:
+            return np.zeros(0, dtype=np.int16)
+        audio_file.seek(first)
+        audio_slice = audio_file.read(last - first, dtype='float32', always_2d=True)[:, channel]
+        audio_slice = resample(audio_slice, sr, SAMPLING_RATE)
+        # the same samples as slicing the whole resampled recording at the turn boundaries
+        offset = first * SAMPLING_RATE // sr
+        audio_slice = audio_slice[max(start_time * 16 - offset, 0):max(end_time * 16 - offset, 0)]
+        return np.clip(np.round(audio_slice * 32768), -32768, 32767).astype(np.int16)
+
     # method parameters are unpacked from `gen_kwargs` as given in `_split_generators`
     def _generate_examples(self, recordings, features):
+        # int16 samples are written to the WAV bytes as they are, without a conversion from float
+        audio_encoder = datasets.features.Audio(sampling_rate=SAMPLING_RATE)
         for wav_id, data in features:
             audio_file = recordings[wav_id]
 
             if not os.path.isfile(audio_file):
                 continue
 
-            audio, sr = torchaudio.load(audio_file)
-            audio = torchaudio.functional.resample(audio, orig_freq=sr, new_freq=16000)
-            channels = {'user': audio[0], 'system': audio[1]}
-
-            context = []
-
-            for i, turn in enumerate(data['log']):
-                span_info = turn['span_info']
-                dialog_act = json.dumps(turn['dialog_act'])
-                metadata = json.dumps(turn['metadata'])
-                tag = turn['tag']
-                text = turn['text']
-                start_time = turn['words'][0]['BeginTime']
-                end_time = turn['words'][-1]['EndTime']
-                
-                # get the corresponding audio slice
-                audio_slice = channels[tag][start_time*16:end_time*16]
-
-                # preprocess the text
-                # remove punctuation
-                text = text.translate(str.maketrans('', '', string.punctuation.replace("'", "")))
-                text = re.sub(' +', ' ', text)
-                text = text.strip()
-
-                return_dict = {
-                    'audio': datasets.features.Audio(sampling_rate=16000).encode_example({
-                            'path': None,
-                            'array': audio_slice,
-                            'sampling_rate': 16000,
-                    }),
-                    'wav_id': wav_id,
-                    'turn_index': i,
-                    'text': text,
-                    'span_info': span_info,
-                    'dialog_act': dialog_act,
-                    'metadata': metadata,
-                    'tag': tag,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'context': context,
-                }
-
-                yield wav_id + '_' + str(i), return_dict
-
-                return_dict.pop('wav_id')
-                return_dict.pop('context')
-                return_dict.pop('audio')
-                context.append(return_dict)
-
+            # the header is read only, turns are read by seeking to their frames
+            with sf.SoundFile(audio_file) as audio:
+
+                context = []
+
+                for i, turn in enumerate(data['log']):
+                    span_info = turn['span_info']
+                    dialog_act = json.dumps(turn['dialog_act'])
+                    metadata = json.dumps(turn['metadata'])
+                    tag = turn['tag']
+                    text = turn['text']
+                    start_time = turn['words'][0]['BeginTime']
+                    end_time = turn['words'][-1]['EndTime']
+
+                    # get the corresponding audio slice
+                    audio_slice = self._read_turn(audio, CHANNELS[tag], start_time, end_time)
+
+                    # preprocess the text
+                    # remove punctuation
+                    text = text.translate(str.maketrans('', '', string.punctuation.replace("'", "")))
+                    text = re.sub(' +', ' ', text)
+                    text = text.strip()
+
+                    return_dict = {
+                        'audio': audio_encoder.encode_example({
+                                'path': None,
+                                'array': audio_slice,
+                                'sampling_rate': SAMPLING_RATE,
+                        }),
+                        'wav_id': wav_id,
+                        'turn_index': i,
+                        'text': text,
+                        'span_info': span_info,
+                        'dialog_act': dialog_act,
+                        'metadata': metadata,
+                        'tag': tag,
+                        'start_time': start_time,
+                        'end_time': end_time,
+                    }
+                    if self.context_by_reference:
+                        return_dict['conversation_id'] = wav_id
+                        return_dict['conversation_turn'] = i
+                        yield wav_id + '_' + str(i), return_dict
+                        continue
+                    return_dict['context'] = context
+
+                    yield wav_id + '_' + str(i), return_dict
+
+                    return_dict.pop('wav_id')
+                    return_dict.pop('context')
+                    return_dict.pop('audio')
+                    context.append(return_dict)
@@ -6,8 +6,10 @@ class GenerationConfigCustom(GenerationConfig):
         self,
         ctc_weight=0.0,
         ctc_margin=0,
+        ctc_pre_beam_size=0,
         lm_weight=0,
         lm_model=None,
+        lm_use_cache=True,
         space_token_id=-1,
         eos_space_trick_weight=0,
         apply_eos_space_trick=False,
@@ -16,8 +18,10 @@ class GenerationConfigCustom(GenerationConfig):
         super().__init__(**kwargs)
         self.ctc_weight = ctc_weight
         self.ctc_margin = ctc_margin
+        self.ctc_pre_beam_size = ctc_pre_beam_size
         self.lm_weight = lm_weight
         self.lm_model = lm_model
+        self.lm_use_cache = lm_use_cache
         self.space_token_id = space_token_id
         self.eos_space_trick_weight = eos_space_trick_weight
         self.apply_eos_space_trick = apply_eos_space_trick
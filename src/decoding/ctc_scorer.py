@@ -1,7 +1,14 @@
 # pylint: skip-file
 # Copied from: https://github.com/espnet/espnet/blob/master/espnet/nets/ctc_prefix_score.py
+from typing import Optional
+
 import torch
 from transformers import LogitsProcessor
+from transformers.utils import logging
+
+from decoding.utils import get_beam_origins
+
+logger = logging.get_logger("transformers")
 
 
 class CTCPrefixScoreTH(object):
@@ -22,7 +29,9 @@ class CTCPrefixScoreTH(object):
         :param torch.Tensor xlens: input lengths (B,)
         :param int blank: blank label id
         :param int eos: end-of-sequence id
-        :param int margin: margin parameter for windowing (0 means no windowing)
+        :param int margin: margin parameter for windowing (0 means no windowing), without attention weights
+            the window starts at the most likely frames of the last labels of the hypotheses and spans
+            `margin` frames dominated by non-blank labels after them
         """
         # In the comment lines,
         # we assume T: input_length, B: batch size, W: beam width, O: output dim.
@@ -35,11 +44,7 @@ class CTCPrefixScoreTH(object):
         self.dtype = x.dtype
         self.device = torch.device("cuda:%d" % x.get_device()) if x.is_cuda else torch.device("cpu")
         # Pad the rest of posteriors in the batch
-        # TODO(takaaki-hori): need a better way without for-loops
-        for i, l in enumerate(xlens):
-            if l < self.input_length:
-                x[i, l:, :] = self.logzero
-                x[i, l:, blank] = 0
+        x = self.mask_padded_frames(x, xlens)
         # Reshape input x
         xn = x.transpose(0, 1)  # (B, T, O) -> (T, B, O)
         xb = xn[:, :, self.blank].unsqueeze(2).expand(-1, -1, self.odim)
@@ -50,36 +55,86 @@ class CTCPrefixScoreTH(object):
         self.margin = margin
         if margin > 0:
             self.frame_ids = torch.arange(self.input_length, dtype=self.dtype, device=self.device)
+            # number of frames dominated by a non-blank label up to each frame (B, T)
+            self.emitting_frames = torch.cumsum(x.argmax(dim=-1) != self.blank, dim=1)
         # Base indices for index conversion
-        self.idx_bh = None
         self.idx_b = torch.arange(self.batch, device=self.device)
-        self.idx_bo = (self.idx_b * self.odim).unsqueeze(1)
+
+    def mask_padded_frames(self, x, xlens):
+        """Force blank emissions on the padded frames of each utterance
+
+        :param torch.Tensor x: input label posterior sequences (B, T, O)
+        :param xlens: input lengths (B,)
+        :return: masked posteriors (B, T, O)
+        """
+        xlens = torch.as_tensor(xlens, device=x.device)
+        pad_mask = torch.arange(x.size(1), device=x.device).unsqueeze(0) >= xlens.unsqueeze(1)  # (B, T)
+        blank_mask = torch.zeros(x.size(2), dtype=torch.bool, device=x.device)
+        blank_mask[self.blank] = True
+        x = x.masked_fill(pad_mask.unsqueeze(2), self.logzero)
+        return x.masked_fill(pad_mask.unsqueeze(2) & blank_mask, 0)
 
     def __call__(self, y, state, scoring_ids=None, att_w=None):
         """Compute CTC prefix scores for next labels
 
+        Hypotheses of the same utterance sharing an identical prefix (e.g. all beams in the first step) have identical
+        forward variables, so these are computed only once per unique prefix and the state keeps a map from the
+        hypotheses to the unique rows.
+
         :param list y: prefix label sequences
         :param tuple state: previous CTC state
         :param torch.Tensor att_w: attention weights to decide CTC window
         :return new_state, ctc_local_scores (BW, O)
         """
-
-        # print(self.tokenizer.batch_decode(y))
-        output_length = len(y[0]) - 1  # ignore sos
-        last_ids = [yi[-1] for yi in y]  # last output label ids
-        n_bh = len(last_ids)  # batch * hyps
+        y = torch.as_tensor(y, device=self.device)
+        n_bh = y.size(0)  # batch * hyps
         n_hyps = n_bh // self.batch  # assuming each utterance has the same # of hyps
+        utt_ids = torch.arange(n_bh, device=self.device) // n_hyps
         self.scoring_num = scoring_ids.size(-1) if scoring_ids is not None else 0
+
+        keys = [utt_ids.unsqueeze(1), y] + ([scoring_ids] if scoring_ids is not None else [])
+        unique_keys, row_map = torch.unique(torch.cat(keys, dim=1), dim=0, return_inverse=True)
+        if unique_keys.size(0) == n_bh:
+            token_scores, new_state = self.score_prefixes(y, utt_ids, state, scoring_ids, att_w)
+            return token_scores, new_state + (None,)
+
+        # the first hypothesis of each group of identical prefixes represents the whole group
+        rows = torch.full((unique_keys.size(0),), n_bh, dtype=torch.long, device=self.device)
+        rows = rows.scatter_reduce(0, row_map, torch.arange(n_bh, device=self.device), reduce="amin")
+        if state is not None:
+            r_prev, s_prev, f_min_prev, f_max_prev = state
+            state = (r_prev[:, :, rows], s_prev[rows], f_min_prev, f_max_prev)
+        token_scores, new_state = self.score_prefixes(
+            y[rows],
+            utt_ids[rows],
+            state,
+            scoring_ids[rows] if scoring_ids is not None else None,
+            att_w[rows] if att_w is not None else None,
+        )
+        return token_scores[row_map], new_state + (row_map,)
+
+    def score_prefixes(self, y, utt_ids, state, scoring_ids=None, att_w=None):
+        """Compute CTC prefix scores for next labels of the given hypotheses
+
+        :param torch.Tensor y: prefix label sequences (N, L)
+        :param torch.Tensor utt_ids: index of the utterance of each hypothesis (N,)
+        :param tuple state: previous CTC state of the hypotheses
+        :param torch.Tensor scoring_ids: label ids to be scored (N, S)
+        :param torch.Tensor att_w: attention weights to decide CTC window (N, T)
+        :return ctc_local_scores (N, O), new_state
+        """
+        output_length = y.size(1) - 1  # ignore sos
+        last_ids = y[:, -1]  # last output label ids
+        n_bh = y.size(0)
         # prepare state info
         if state is None:
             r_prev = torch.full(
-                (self.input_length, 2, self.batch, n_hyps),
+                (self.input_length, 2, n_bh),
                 self.logzero,
                 dtype=self.dtype,
                 device=self.device,
             )
-            r_prev[:, 1] = torch.cumsum(self.x[0, :, :, self.blank], 0).unsqueeze(2)
-            r_prev = r_prev.view(-1, 2, n_bh)
+            r_prev[:, 1] = torch.cumsum(self.x[0, :, :, self.blank], 0)[:, utt_ids]
             s_prev = 0.0
             f_min_prev = 0
             f_max_prev = 1
@@ -90,16 +145,16 @@ class CTCPrefixScoreTH(object):
         if self.scoring_num > 0:
             scoring_idmap = torch.full((n_bh, self.odim), -1, dtype=torch.long, device=self.device)
             snum = self.scoring_num
-            if self.idx_bh is None or n_bh > len(self.idx_bh):
-                self.idx_bh = torch.arange(n_bh, device=self.device).view(-1, 1)
-            scoring_idmap[self.idx_bh[:n_bh], scoring_ids] = torch.arange(snum, device=self.device)
-            scoring_idx = (scoring_ids + self.idx_bo.repeat(1, n_hyps).view(-1, 1)).view(-1)
+            scoring_idmap[torch.arange(n_bh, device=self.device).view(-1, 1), scoring_ids] = torch.arange(
+                snum, device=self.device
+            )
+            scoring_idx = (scoring_ids + (utt_ids * self.odim).view(-1, 1)).view(-1)
             x_ = torch.index_select(self.x.view(2, -1, self.batch * self.odim), 2, scoring_idx).view(2, -1, n_bh, snum)
         else:
             scoring_ids = None
             scoring_idmap = None
             snum = self.odim
-            x_ = self.x.unsqueeze(3).repeat(1, 1, 1, n_hyps, 1).view(2, -1, n_bh, snum)
+            x_ = torch.index_select(self.x, 2, utt_ids)
 
         # new CTC forward probs are prepared as a (T x 2 x BW x S) tensor
         # that corresponds to r_t^n(h) and r_t^b(h) in a batch.
@@ -114,14 +169,16 @@ class CTCPrefixScoreTH(object):
 
         r_sum = torch.logsumexp(r_prev, 1)
         log_phi = r_sum.unsqueeze(2).repeat(1, 1, snum)
+        # a repeated label can only follow a blank, so its prefix probability excludes r_t^n(h)
         if scoring_ids is not None:
-            for idx in range(n_bh):
-                pos = scoring_idmap[idx, last_ids[idx]]
-                if pos >= 0:
-                    log_phi[:, idx, pos] = r_prev[:, 1, idx]
+            pos = scoring_idmap[torch.arange(n_bh, device=self.device), last_ids]
+            valid = pos >= 0
+            pos = pos.clamp(min=0).view(1, n_bh, 1).expand(r_prev.size(0), -1, -1)
+            last_phi = torch.where(valid.unsqueeze(0), r_prev[:, 1], log_phi.gather(2, pos).squeeze(2))
+            log_phi.scatter_(2, pos, last_phi.unsqueeze(2))
         else:
-            for idx in range(n_bh):
-                log_phi[:, idx, last_ids[idx]] = r_prev[:, 1, idx]
+            pos = last_ids.view(1, n_bh, 1).expand(r_prev.size(0), -1, -1)
+            log_phi.scatter_(2, pos, r_prev[:, 1].unsqueeze(2))
 
         # decide start and end frames based on attention weights
         if att_w is not None and self.margin > 0:
@@ -130,44 +187,45 @@ class CTCPrefixScoreTH(object):
             f_max = max(int(f_arg.max().cpu()), f_max_prev)
             start = min(f_max_prev, max(f_min - self.margin, output_length, 1))
             end = min(f_max + self.margin, self.input_length)
+        elif self.margin > 0 and output_length > 0:
+            # decide start and end frames based on the most likely frame of the last label of each hypothesis
+            # the window closes after `margin` frames dominated by non-blank labels, so that pauses do not count
+            f_arg = r_prev[:, 0].argmax(dim=0)
+            emitting_frames = self.emitting_frames[utt_ids]
+            target = emitting_frames.gather(1, f_arg.unsqueeze(1)) + self.margin
+            f_end = torch.searchsorted(emitting_frames, target)
+            f_min = int(f_arg.min().cpu())
+            f_max = int(f_arg.max().cpu())
+            start = max(f_min - self.margin, output_length, 1)
+            end = min(int(f_end.max().cpu()) + 1, self.input_length)
         else:
             f_min = f_max = 0
             start = max(output_length, 1)
             end = self.input_length
 
         if start > end:
-            return torch.full_like(s_prev, self.logzero), (
-                r,
-                torch.full_like(s_prev, self.logzero),
-                f_min,
-                f_max,
-                scoring_idmap,
-            )
+            log_psi = torch.full((n_bh, self.odim), self.logzero, dtype=self.dtype, device=self.device)
+            return log_psi.clone(), (r, log_psi, f_min, f_max, scoring_idmap)
 
         # compute forward probabilities log(r_t^n(h)) and log(r_t^b(h))
         for t in range(start, end):
             rp = r[t - 1]
-            rr = torch.stack([rp[0], log_phi[t - 1], rp[0], rp[1]]).view(2, 2, n_bh, snum)
-            r[t] = torch.logsumexp(rr, 1) + x_[:, t]
+            torch.logaddexp(rp[0], log_phi[t - 1], out=r[t, 0])
+            torch.logaddexp(rp[0], rp[1], out=r[t, 1])
+            r[t] += x_[:, t]
 
         # compute log prefix probabilities log(psi)
-        log_phi_x = torch.cat((log_phi[0].unsqueeze(0), log_phi[:-1]), dim=0) + x_[0]
+        # only frames inside the window contribute, start >= 1 so each frame t pairs with log_phi[t - 1]
+        log_phi_x = log_phi[start - 1 : end - 1] + x_[0, start:end]
+        log_psi_ = torch.logsumexp(torch.cat((log_phi_x, r[start - 1, 0].unsqueeze(0)), dim=0), dim=0)
         if scoring_ids is not None:
             log_psi = torch.full((n_bh, self.odim), self.logzero, dtype=self.dtype, device=self.device)
-            log_psi_ = torch.logsumexp(
-                torch.cat((log_phi_x[start:end], r[start - 1, 0].unsqueeze(0)), dim=0),
-                dim=0,
-            )
-            for si in range(n_bh):
-                log_psi[si, scoring_ids[si]] = log_psi_[si]
+            log_psi.scatter_(1, scoring_ids, log_psi_)
         else:
-            log_psi = torch.logsumexp(
-                torch.cat((log_phi_x[start:end], r[start - 1, 0].unsqueeze(0)), dim=0),
-                dim=0,
-            )
+            log_psi = log_psi_
 
         # for si in range(n_bh):
-        #     log_psi[si, self.eos] = r_sum[self.end_frames[si // n_hyps], si]
+        #     log_psi[si, self.eos] = r_sum[self.end_frames[utt_ids[si]], si]
 
         # exclude blank probs
         log_psi[:, self.blank] = self.logzero
@@ -184,26 +242,28 @@ class CTCPrefixScoreTH(object):
         :param best_ids : index numbers selected by beam pruning (B, W)
         :return selected_state
         """
-        r, s, f_min, f_max, scoring_idmap = state
+        r, s, f_min, f_max, scoring_idmap, row_map = state
         # convert ids to BHO space
-        n_bh = len(s)
+        n_bh = best_ids.numel()
         n_hyps = n_bh // self.batch
-        vidx = (best_ids + (self.idx_b * (n_hyps * self.odim)).view(-1, 1)).view(-1)
-        # select hypothesis scores
-        s_new = torch.index_select(s.view(-1), 0, vidx)
-        s_new = s_new.view(-1, 1).repeat(1, self.odim).view(n_bh, self.odim)
+        hyp_idx = (best_ids // self.odim + (self.idx_b * n_hyps).view(-1, 1)).view(-1)
+        label_ids = torch.fmod(best_ids, self.odim).view(-1)
+        if row_map is not None:
+            # hypotheses sharing a prefix were scored once
+            hyp_idx = row_map[hyp_idx]
+        # select hypothesis scores, kept as (BW, 1) and broadcast over the labels
+        s_new = s[hyp_idx, label_ids].unsqueeze(1)
         # convert ids to BHS space (S: scoring_num)
         if scoring_idmap is not None:
             snum = self.scoring_num
-            hyp_idx = (best_ids // self.odim + (self.idx_b * n_hyps).view(-1, 1)).view(-1)
-            label_ids = torch.fmod(best_ids, self.odim).view(-1)
             score_idx = scoring_idmap[hyp_idx, label_ids]
             score_idx[score_idx == -1] = 0
-            vidx = score_idx + hyp_idx * snum
         else:
             snum = self.odim
+            score_idx = label_ids
+        vidx = score_idx + hyp_idx * snum
         # select forward probabilities
-        r_new = torch.index_select(r.view(-1, 2, n_bh * snum), 2, vidx).view(-1, 2, n_bh)
+        r_new = torch.index_select(r.view(r.size(0), 2, -1), 2, vidx)
         return r_new, s_new, f_min, f_max
 
     def extend_prob(self, x):
@@ -214,12 +274,8 @@ class CTCPrefixScoreTH(object):
 
         if self.x.shape[1] < x.shape[1]:  # self.x (2,T,B,O); x (B,T,O)
             # Pad the rest of posteriors in the batch
-            # TODO(takaaki-hori): need a better way without for-loops
             xlens = [x.size(1)]
-            for i, l in enumerate(xlens):
-                if l < self.input_length:
-                    x[i, l:, :] = self.logzero
-                    x[i, l:, self.blank] = 0
+            x = self.mask_padded_frames(x, xlens)
             tmp_x = self.x
             xn = x.transpose(0, 1)  # (B, T, O) -> (T, B, O)
             xb = xn[:, :, self.blank].unsqueeze(2).expand(-1, -1, self.odim)
@@ -227,6 +283,9 @@ class CTCPrefixScoreTH(object):
             self.x[:, : tmp_x.shape[1], :, :] = tmp_x
             self.input_length = x.size(1)
             self.end_frames = torch.as_tensor(xlens) - 1
+            if self.margin > 0:
+                self.frame_ids = torch.arange(self.input_length, dtype=self.dtype, device=self.device)
+                self.emitting_frames = torch.cumsum(self.x[0].argmax(dim=-1).transpose(0, 1) != self.blank, dim=1)
 
     def extend_state(self, state):
         """Compute CTC prefix state.
@@ -269,6 +328,7 @@ class CTCRescorerLogitsProcessor(LogitsProcessor):
         space_token_id: int,
         apply_eos_space_trick: bool,
         eos_space_trick_weight: float,
+        pre_beam_size: int = 0,
         debug: bool = False,
     ):
         super().__init__()
@@ -280,11 +340,15 @@ class CTCRescorerLogitsProcessor(LogitsProcessor):
             encoder_output_lens,
             pad_token_id,
             eos_token_id,
-            ctc_margin,
+            int(ctc_margin),
         )
         self.ctc_weight = ctc_weight
         self.ctc_states = None
+        self.prev_input_ids = None
+        self.prev_scoring_ids = None
         self.num_beams = num_beams
+        # Number of the best attention candidates per hypothesis to be CTC scored, 0 scores the whole vocabulary
+        self.pre_beam_size = pre_beam_size if 0 < pre_beam_size < encoder_logits.size(-1) else 0
         self.eos_token_id = eos_token_id
         self.apply_eos_space_trick = apply_eos_space_trick
         self.space_token_id = space_token_id
@@ -321,14 +385,47 @@ class CTCRescorerLogitsProcessor(LogitsProcessor):
         print_prediction(best_ids, "NEXT_TOKEN_SCORES")
         print()
 
+    def get_best_ids(self, input_ids: torch.LongTensor) -> Optional[torch.LongTensor]:
+        """Convert the selected hypotheses to the (B, W) ids in the beam x vocabulary space of the prefix scorer,
+        None if some of them do not extend any hypothesis of the previous step."""
+        preferred_origins = None
+        if self.prev_scoring_ids is not None and self.prev_scoring_ids.size(0) == input_ids.size(0):
+            # identical prefixes may have been scored for different labels, the state has to come from a hypothesis
+            # that scored the selected one
+            scoring_ids = self.prev_scoring_ids.view(-1, 1, self.num_beams, self.prev_scoring_ids.size(-1))
+            last_ids = input_ids[:, -1].view(-1, self.num_beams, 1, 1)
+            preferred_origins = (scoring_ids == last_ids).any(dim=-1).view(-1, self.num_beams)
+        beam_origins = get_beam_origins(input_ids, self.prev_input_ids, self.num_beams, preferred_origins)
+        if beam_origins is None:
+            return None
+        best_ids = (beam_origins % self.num_beams) * self.ctc_prefix_scorer.odim + input_ids[:, -1]
+        return best_ids.reshape(-1, self.num_beams)
+
+    def recompute_ctc_states(self, input_ids: torch.LongTensor):
+        """Compute the CTC states of the prefixes from scratch, extending each hypothesis by its own tokens."""
+        beam_ids = torch.arange(self.num_beams, device=input_ids.device).repeat(input_ids.size(0) // self.num_beams)
+        ctc_states = None
+        for length in range(1, input_ids.size(1)):
+            _, ctc_states = self.ctc_prefix_scorer(input_ids[:, :length], ctc_states)
+            best_ids = beam_ids * self.ctc_prefix_scorer.odim + input_ids[:, length]
+            ctc_states = self.ctc_prefix_scorer.index_select_state(ctc_states, best_ids.reshape(-1, self.num_beams))
+        return ctc_states
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
         scores[:, self.pad_token_id] = self.ctc_prefix_scorer.logzero
         if self.ctc_states is not None:
-            self.ctc_states = self.ctc_prefix_scorer.index_select_state(
-                self.ctc_states, input_ids[:, -1].reshape(-1, self.num_beams)
-            )
-        ctc_scores, ctc_states = self.ctc_prefix_scorer(input_ids, self.ctc_states)
+            best_ids = self.get_best_ids(input_ids)
+            if best_ids is None:
+                # the states of other hypotheses would be misaligned with the prefixes, so none of them is reused
+                logger.warning("CTC states do not match the reordered hypotheses, they are recomputed from scratch.")
+                self.ctc_states = self.recompute_ctc_states(input_ids)
+            else:
+                self.ctc_states = self.ctc_prefix_scorer.index_select_state(self.ctc_states, best_ids)
+        scoring_ids = scores.topk(self.pre_beam_size, dim=-1).indices if self.pre_beam_size > 0 else None
+        ctc_scores, ctc_states = self.ctc_prefix_scorer(input_ids, self.ctc_states, scoring_ids)
         self.ctc_states = ctc_states
+        self.prev_input_ids = input_ids
+        self.prev_scoring_ids = scoring_ids
         next_token_scores = (1 - self.ctc_weight) * scores + self.ctc_weight * ctc_scores
         if self.apply_eos_space_trick:
             space_eos_conflict = torch.logical_and(
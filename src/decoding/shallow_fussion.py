@@ -1,15 +1,45 @@
 import torch
 from transformers import LogitsProcessor, PreTrainedModel
 
+from decoding.utils import get_beam_origins
+
 
 class LMRescorerLogitsProcessor(LogitsProcessor):
-    """Logits Processor to rescore the next token scores with a language model."""
+    """Logits Processor to rescore the next token scores with a language model.
+
+    With `use_cache` enabled, the LM key/value cache is kept between the decoding steps, reordered according to
+    the beam search selection and only the last token of each hypothesis is fed to the LM.
+    """
 
-    def __init__(self, lm_weight: float, lm_model: PreTrainedModel, device: torch.device):
+    def __init__(
+        self,
+        lm_weight: float,
+        lm_model: PreTrainedModel,
+        device: torch.device,
+        num_beams: int = 1,
+        use_cache: bool = True,
+    ):
         super().__init__()
         self.lm_model = lm_model.to(device)
         self.lm_weight = lm_weight
-        # self.past_key_values = None
+        self.num_beams = num_beams
+        self.use_cache = use_cache
+        self.past_key_values = None
+        self.prev_input_ids = None
+
+    def reset(self):
+        self.past_key_values = None
+        self.prev_input_ids = None
+
+    @staticmethod
+    def reorder_past_key_values(past_key_values, beam_idx: torch.LongTensor):
+        if hasattr(past_key_values, "reorder_cache"):
+            past_key_values.reorder_cache(beam_idx)
+            return past_key_values
+        return tuple(
+            tuple(past_state.index_select(0, beam_idx.to(past_state.device)) for past_state in layer_past)
+            for layer_past in past_key_values
+        )
 
     @staticmethod
     def analyze_predictions(scores, lm_scores, next_token_scores, input_ids, k=10, tokenizer="Lakoc/ted_uni500"):
@@ -38,15 +68,31 @@ class LMRescorerLogitsProcessor(LogitsProcessor):
         print_prediction(best_ids, "NEXT_TOKEN_SCORES")
         print()
 
+    def get_lm_outputs(self, input_ids: torch.LongTensor):
+        if not self.use_cache:
+            return self.lm_model(input_ids)
+
+        beam_idx = None
+        if self.past_key_values is not None:
+            beam_idx = get_beam_origins(input_ids, self.prev_input_ids, self.num_beams)
+            if beam_idx is None:
+                # New generation call or unexpected prefix change, start from scratch
+                self.reset()
+
+        if self.past_key_values is None:
+            outputs = self.lm_model(input_ids, use_cache=True)
+        else:
+            outputs = self.lm_model(
+                input_ids[:, -1:],
+                past_key_values=self.reorder_past_key_values(self.past_key_values, beam_idx),
+                use_cache=True,
+            )
+        self.past_key_values = outputs.past_key_values
+        self.prev_input_ids = input_ids
+        return outputs
+
     def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor) -> torch.FloatTensor:
-        # TODO: KarelB: Can you implement the past_key_values logic?
-        outputs = self.lm_model(
-            input_ids,
-            # input_ids[:, -1]
-            # past_key_values=self.past_key_values,
-            # use_cache=True
-        )
-        # self.past_key_values = outputs.past_key_values
+        outputs = self.get_lm_outputs(input_ids)
         lm_scores = torch.nn.functional.log_softmax(outputs.logits[:, -1, :], dim=-1)
         next_token_scores = scores + self.lm_weight * lm_scores
         # self.analyze_predictions(scores, lm_scores, next_token_scores, input_ids)
@@ -0,0 +1,116 @@
+"""Streaming greedy CTC decoding on top of the chunk-wise inference of causal encoders."""
+from dataclasses import dataclass
+from typing import List, Optional
+
+import torch
+
+from models.encoders.e_branchformer import Wav2Vec2EBranchformerForCTC
+
+
+@dataclass
+class StreamingCTCOutput:
+    """Decoding results after a chunk, one entry per stream in the batch."""
+
+    token_ids: List[List[int]]
+    new_token_ids: List[List[int]]
+    is_endpoint: List[bool]
+
+
+class StreamingCTCGreedyDecoder:
+    """Greedy CTC decoder consuming a batch of input streams chunk by chunk.
+
+    Partial hypotheses are extended as soon as the encoder emits new frames. An endpoint is detected once a stream
+    produced at least one token followed by `endpoint_blank_frames` consecutive blank frames, the next chunk of such
+    stream then starts a new segment. Encoder context is kept until `reset` is called, `flush` decodes the frames held
+    back by the encoder at the end of the streams.
+    """
+
+    def __init__(
+        self,
+        model: Wav2Vec2EBranchformerForCTC,
+        blank_token_id: Optional[int] = None,
+        endpoint_blank_frames: int = 0,
+    ):
+        self.model = model.eval()
+        self.blank_token_id = model.config.pad_token_id if blank_token_id is None else blank_token_id
+        self.endpoint_blank_frames = endpoint_blank_frames
+        self.streaming_state = None
+        self.token_ids = None
+        self.last_ids = None
+        self.trailing_blanks = None
+        self.is_endpoint = None
+
+    def reset(self):
+        """Drop all the encoder and decoder state to start new streams."""
+        self.streaming_state = None
+        self.token_ids = None
+        self.last_ids = None
+        self.trailing_blanks = None
+        self.is_endpoint = None
+
+    def _init_streams(self, batch_size: int, device: torch.device):
+        self.token_ids = [[] for _ in range(batch_size)]
+        self.last_ids = torch.full((batch_size,), self.blank_token_id, dtype=torch.long, device=device)
+        self.trailing_blanks = torch.zeros(batch_size, dtype=torch.long, device=device)
+        self.is_endpoint = [False] * batch_size
+
+    def _start_new_segments(self):
+        for index, is_endpoint in enumerate(self.is_endpoint):
+            if is_endpoint:
+                self.token_ids[index] = []
+                self.last_ids[index] = self.blank_token_id
+                self.trailing_blanks[index] = 0
+                self.is_endpoint[index] = False
+
+    @torch.no_grad()
+    def __call__(self, input_values: torch.Tensor) -> StreamingCTCOutput:
+        """Decode the next chunk of the input streams (N, T, F)."""
+        if self.token_ids is None:
+            self._init_streams(input_values.size(0), input_values.device)
+        else:
+            self._start_new_segments()
+
+        logits, self.streaming_state = self.model.forward_streaming(input_values, self.streaming_state)
+        return self._decode_logits(logits)
+
+    @torch.no_grad()
+    def flush(self) -> StreamingCTCOutput:
+        """Decode the last frames of the input streams, those of an incomplete attention chunk of the encoder.
+        The streams cannot be continued afterwards, `reset` has to be called before new ones."""
+        self._start_new_segments()
+        return self._decode_logits(self.model.flush_streaming(self.streaming_state))
+
+    def _decode_logits(self, logits: torch.Tensor) -> StreamingCTCOutput:
+        frame_ids = logits.argmax(dim=-1)  # (N, T')
+        num_frames = frame_ids.size(1)
+
+        # CTC collapse has to respect the last frame of the previous chunk
+        previous_ids = torch.cat((self.last_ids.unsqueeze(1), frame_ids[:, :-1]), dim=1)
+        emitted = (frame_ids != self.blank_token_id) & (frame_ids != previous_ids)
+        if num_frames > 0:
+            self.last_ids = frame_ids[:, -1]
+
+        # count blank frames at the end of the stream
+        non_blank = frame_ids != self.blank_token_id
+        frame_positions = torch.arange(1, num_frames + 1, device=frame_ids.device)
+        last_non_blank = (non_blank * frame_positions).max(dim=1).values if num_frames > 0 else self.trailing_blanks * 0
+        self.trailing_blanks = torch.where(
+            last_non_blank > 0, num_frames - last_non_blank, self.trailing_blanks + num_frames
+        )
+
+        new_token_ids = []
+        for index, (stream_ids, stream_emitted) in enumerate(zip(frame_ids.tolist(), emitted.tolist())):
+            new_ids = [token_id for token_id, is_emitted in zip(stream_ids, stream_emitted) if is_emitted]
+            self.token_ids[index].extend(new_ids)
+            new_token_ids.append(new_ids)
+            self.is_endpoint[index] = (
+                self.endpoint_blank_frames > 0
+                and len(self.token_ids[index]) > 0
+                and int(self.trailing_blanks[index]) >= self.endpoint_blank_frames
+            )
+
+        return StreamingCTCOutput(
+            token_ids=[list(stream_token_ids) for stream_token_ids in self.token_ids],
+            new_token_ids=new_token_ids,
+            is_endpoint=list(self.is_endpoint),
+        )
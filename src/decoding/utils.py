@@ -0,0 +1,44 @@
+"""Helpers shared by the stateful logits processors."""
+from typing import Optional
+
+import torch
+
+
+def get_beam_origins(
+    input_ids: torch.LongTensor,
+    prev_input_ids: Optional[torch.LongTensor],
+    num_beams: int,
+    preferred_origins: Optional[torch.BoolTensor] = None,
+) -> Optional[torch.LongTensor]:
+    """Recover which hypothesis of the previous step each current hypothesis extends.
+
+    Beam search reorders `input_ids` before calling the logits processors, but does not pass the beam indices to them.
+    Every current prefix (without its last token) is therefore matched against the prefixes seen in the previous step
+    within the same utterance. Hypotheses with identical prefixes share the same state, so the first match is taken.
+
+    :param input_ids: current prefixes (B * W, L)
+    :param prev_input_ids: prefixes from the previous step (B * W, L - 1)
+    :param num_beams: number of hypotheses per utterance
+    :param preferred_origins: previous hypotheses of the utterance to be matched first (B * W, W), e.g. those whose
+        state is valid for the last token, other matching ones are taken only if none of these matches
+    :return: global indices of the previous hypotheses (B * W,) or None if the steps are not consecutive
+    """
+    if (
+        prev_input_ids is None
+        or prev_input_ids.shape[0] != input_ids.shape[0]
+        or prev_input_ids.shape[1] + 1 != input_ids.shape[1]
+    ):
+        return None
+    n_bh = input_ids.shape[0]
+    batch_size = n_bh // num_beams
+    current = input_ids[:, :-1].view(batch_size, num_beams, 1, -1)
+    previous = prev_input_ids.view(batch_size, 1, num_beams, -1)
+    matches = (current == previous).all(dim=-1)  # (B, W_current, W_previous)
+    if not matches.any(dim=-1).all():
+        return None
+    if preferred_origins is not None:
+        preferred = matches & preferred_origins.view(batch_size, num_beams, num_beams)
+        matches = torch.where(preferred.any(dim=-1, keepdim=True), preferred, matches)
+    local_ids = matches.int().argmax(dim=-1)
+    offsets = torch.arange(batch_size, device=input_ids.device).unsqueeze(1) * num_beams
+    return (local_ids + offsets).view(-1)
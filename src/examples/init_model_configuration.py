@@ -60,6 +60,35 @@ configuration.push_to_hub("Lakoc/ebranchformer_6_128h_2d")
 model_enc = Wav2Vec2EBranchformerModel(configuration)
 print(model_enc.num_parameters())
 
+# Causal model for 2d input supporting streaming inference (`forward_streaming`)
+configuration = Wav2Vec2EBranchformerConfig()
+configuration.num_hidden_layers = 6
+configuration.hidden_size = 128
+configuration.output_hidden_size = 128
+configuration.num_attention_heads = 8
+configuration.num_feat_extract_layers = 2
+configuration.intermediate_size = 1024
+configuration.max_source_positions = 1024
+configuration.ebranchformer_conv_dropout = 0.1
+configuration.csgu_activation = "identity"
+configuration.csgu_kernel_size = 31
+configuration.csgu_use_linear_after_conv = False
+configuration.merge_conv_kernel = 31
+configuration.use_macaron_ff = True
+configuration.use_fbanks = True
+configuration.ctc_zero_infinity = True
+configuration.apply_spec_augment = True
+configuration.conv_dim = [128, 128]
+configuration.conv_stride = [2, 2]
+configuration.conv_kernel = [3, 3]
+configuration.is_causal = True
+configuration.causal_conv_fusion = True
+configuration.attention_chunk_size = 16
+configuration.attention_num_left_chunks = 4
+
+model_enc = Wav2Vec2EBranchformerModel(configuration)
+print(model_enc.num_parameters())
+
 
 configuration = BestRQEBranchformerConfig()
 configuration.num_hidden_layers = 6
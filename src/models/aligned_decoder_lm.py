@@ -10,12 +10,13 @@ from transformers import (
     PreTrainedTokenizer,
     PretrainedConfig,
     Blip2QFormerConfig,
+    SequenceFeatureExtractor,
 )
 from transformers.modeling_outputs import ModelOutput, BaseModelOutput
 
 from torch.nn import CrossEntropyLoss
 
-from typing import Optional, Tuple, Union, Any
+from typing import Any, List, Optional, Tuple, Union
 
 import torch
 from torch import nn
@@ -191,6 +192,40 @@ class SpeechEncoderConnectorLMDecoder(PreTrainedModel):
         if self.freeze_decoder:
             self.decoder.eval()
 
+    def estimate_connector_lengths(
+        self,
+        durations: List[float],
+        sampling_rate: int = 16_000,
+        feature_extractor: Optional[SequenceFeatureExtractor] = None,
+    ) -> List[int]:
+        """Estimates the number of connector outputs (soft prompts included) for inputs of the given durations in
+        seconds, used to batch the training data by the decoder sequence length. Encoders are expected to consume raw
+        samples unless the `feature_extractor` outputs feature frames (`input_features`)."""
+        if self.config.connector_type == 'qformer':
+            lengths = torch.full((len(durations),), self.config.num_query_tokens)
+        else:
+            if self.encoder.config.model_type == 'whisper':
+                # whisper inputs are always padded to 30s
+                lengths = torch.full((len(durations),), self.encoder.config.max_source_positions)
+            else:
+                input_lengths = (torch.tensor(durations, dtype=torch.float64) * sampling_rate).long()
+                if feature_extractor is not None and feature_extractor.model_input_names[0] == 'input_features':
+                    # fbank front-ends consume frames, 25ms windows shifted by 10ms unless the extractor says otherwise
+                    hop_length = getattr(feature_extractor, 'hop_length', sampling_rate // 100)
+                    window_length = getattr(feature_extractor, 'n_fft', sampling_rate * 25 // 1000)
+                    input_lengths = torch.clamp(
+                        torch.div(input_lengths - window_length, hop_length, rounding_mode='floor') + 1, min=0
+                    )
+                lengths = self.encoder._get_feat_extract_output_lengths(input_lengths)
+            if self.config.connector_type in ['linear', 'ste']:
+                lengths = self.connector.conv._get_feat_extract_output_lengths(lengths)
+            else:
+                lengths = torch.div(lengths, self.config.downsampling_factor, rounding_mode='floor') + (
+                    lengths % self.config.downsampling_factor > 0
+                ).long()
+        lengths = lengths + self.config.prompt_tuning_prefix_len + self.config.prompt_tuning_suffix_len
+        return lengths.tolist()
+
     def freeze_encoder(self):
         for _, param in self.encoder.named_parameters():
             param.requires_grad = False
@@ -216,6 +251,52 @@ class SpeechEncoderConnectorLMDecoder(PreTrainedModel):
         if hasattr(self.decoder, 'final_logits_bias'):
             self.decoder.final_logits_bias.requires_grad = False
 
+    def encode_audio(
+        self,
+        input_features: torch.FloatTensor,
+        attention_mask: Optional[torch.LongTensor] = None,
+        output_attentions: Optional[bool] = None,
+        output_hidden_states: Optional[bool] = None,
+    ) -> Tuple[BaseModelOutput, Optional[torch.LongTensor]]:
+        """Runs the speech encoder, returns its outputs and the attention mask downsampled to the encoder frames."""
+        if self.encoder.training: self.encoder.eval()
+        encoder_outputs = self.encoder(
+            input_features,
+            attention_mask=attention_mask,
+            output_attentions=output_attentions,
+            output_hidden_states=output_hidden_states,
+            return_dict=True
+        )
+
+        encoder_outputs = BaseModelOutput(
+            last_hidden_state=encoder_outputs.last_hidden_state,
+            hidden_states=encoder_outputs.hidden_states,
+            attentions=encoder_outputs.attentions
+        )
+
+        audio_embeds = encoder_outputs.last_hidden_state
+
+        # downsample encoder attention mask
+        if attention_mask is not None:
+            if hasattr(self.encoder, '_get_feature_vector_attention_mask'):
+                audio_attention_mask = self.encoder._get_feature_vector_attention_mask(
+                    audio_embeds.shape[1], attention_mask
+                )
+
+            else:
+                audio_attention_mask = torch.ones(
+                    (
+                        audio_embeds.shape[0],
+                        audio_embeds.shape[1],
+                    ),
+                    device = audio_embeds.device,
+                    dtype=torch.long,
+                )
+        else:
+            audio_attention_mask = None
+
+        return encoder_outputs, audio_attention_mask
+
     def forward(
         self,
         input_features: Optional[torch.LongTensor] = None,
@@ -232,6 +313,8 @@ class SpeechEncoderConnectorLMDecoder(PreTrainedModel):
         decoder_head_mask: Optional[torch.Tensor] = None,
         cross_attn_head_mask: Optional[torch.Tensor] = None,
         encoder_outputs: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
+        encoder_hidden_states: Optional[torch.FloatTensor] = None,
+        encoder_attention_mask: Optional[torch.LongTensor] = None,
         past_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
         decoder_inputs_embeds: Optional[torch.FloatTensor] = None,
         labels: Optional[torch.LongTensor] = None,
@@ -264,42 +347,15 @@ class SpeechEncoderConnectorLMDecoder(PreTrainedModel):
                 # suffix -- perhaps we need to enforce a space at the end of it?
                 decoder_input_ids = decoder_input_ids[:,1:]
 
-        # 1. forward the audio through the encoder
-        if self.encoder.training: self.encoder.eval()
-        encoder_outputs = self.encoder(
-            input_features,
-            attention_mask=attention_mask,
-            output_attentions=output_attentions,
-            output_hidden_states=output_hidden_states,
-            return_dict=True
-        )
-
-        encoder_outputs = BaseModelOutput(
-            last_hidden_state=encoder_outputs.last_hidden_state,
-            hidden_states=encoder_outputs.hidden_states,
-            attentions=encoder_outputs.attentions
-        )
-
-        audio_embeds = encoder_outputs.last_hidden_state
-
-        # downsample encoder attention mask
-        if attention_mask is not None:
-            if hasattr(self.encoder, '_get_feature_vector_attention_mask'):
-                audio_attention_mask = self.encoder._get_feature_vector_attention_mask(
-                    audio_embeds.shape[1], attention_mask
-                )
-
-            else:
-                audio_attention_mask = torch.ones(
-                    (
-                        audio_embeds.shape[0],
-                        audio_embeds.shape[1],
-                    ),
-                    device = audio_embeds.device,
-                    dtype=torch.long,
-                )
+        # 1. forward the audio through the encoder, unless its outputs were precomputed
+        if encoder_hidden_states is None:
+            encoder_outputs, audio_attention_mask = self.encode_audio(
+                input_features, attention_mask, output_attentions, output_hidden_states
+            )
         else:
-            audio_attention_mask = None
+            encoder_outputs = BaseModelOutput(last_hidden_state=encoder_hidden_states.to(self.connector.dtype))
+            audio_attention_mask = encoder_attention_mask
+        audio_embeds = encoder_outputs.last_hidden_state
 
         # pass the encoder outputs through the bridge network
         connector_outputs, audio_attention_mask = self.connector(
@@ -417,13 +417,20 @@ class JointCTCAttentionEncoderDecoder(SpeechEncoderDecoderModel):
                 self.generation_config.space_token_id,
                 self.generation_config.apply_eos_space_trick,
                 self.generation_config.eos_space_trick_weight,
+                getattr(self.generation_config, "ctc_pre_beam_size", 0),
             )
             processors.append(self.ctc_rescorer)
         if hasattr(generation_config, "lm_weight") and generation_config.lm_weight > 0:
             if not hasattr(generation_config, "lm_model"):
                 raise ValueError("If `lm_weight` is specified, make sure that `lm_model` is defined.")
             processors.append(
-                LMRescorerLogitsProcessor(generation_config.lm_weight, generation_config.lm_model, device=self.device)
+                LMRescorerLogitsProcessor(
+                    generation_config.lm_weight,
+                    generation_config.lm_model,
+                    device=self.device,
+                    num_beams=generation_config.num_beams,
+                    use_cache=getattr(generation_config, "lm_use_cache", True),
+                )
             )
         return processors
 
@@ -1,13 +1,16 @@
 """ PyTorch Wav2Vec2-Ebranchformer model."""
 
 import math
-from typing import Optional, Tuple, Union
+from functools import lru_cache
+from typing import Dict, Optional, Tuple, Union
 
 import torch
 import torch.utils.checkpoint
 from torch import nn
 from torch.linalg import vector_norm
 from transformers.activations import ACT2FN
+from transformers.integrations.deepspeed import is_deepspeed_zero3_enabled
+from transformers.modeling_outputs import BaseModelOutput
 from transformers.models.wav2vec2.modeling_wav2vec2 import (
     Wav2Vec2Config,
     Wav2Vec2ForCTC,
@@ -27,7 +30,11 @@ from transformers.models.wav2vec2_conformer.modeling_wav2vec2_conformer import (
 )
 from transformers.utils import logging
 
-from models.streaming_modules import CausalConv1d, FeatureExtractorForStreaming
+from models.streaming_modules import (
+    CausalConv1d,
+    EncoderStreamingState,
+    FeatureExtractorForStreaming,
+)
 
 logger = logging.get_logger(__name__)
 
@@ -46,6 +53,10 @@ class Wav2Vec2EBranchformerConfig(Wav2Vec2ConformerConfig, Wav2Vec2Config):
         merge_conv_kernel=31,
         use_macaron_ff=True,
         is_causal=False,
+        causal_conv_fusion=False,
+        attention_chunk_size=0,
+        attention_num_left_chunks=-1,
+        use_sdpa=False,
         **kwargs,
     ):
         super().__init__(**kwargs)
@@ -57,15 +68,67 @@ class Wav2Vec2EBranchformerConfig(Wav2Vec2ConformerConfig, Wav2Vec2Config):
         self.merge_conv_kernel = merge_conv_kernel
         self.use_macaron_ff = use_macaron_ff
         self.is_causal = is_causal
+        # causal merge convolution of the branches, required for streaming, the older causal models were trained with
+        # the centered one, so it is enabled only explicitly to keep their outputs unchanged
+        self.causal_conv_fusion = causal_conv_fusion
+        # chunk-wise attention, each frame sees its own chunk and `attention_num_left_chunks` previous ones (-1 = all)
+        self.attention_chunk_size = attention_chunk_size
+        self.attention_num_left_chunks = attention_num_left_chunks
+        # fused scaled_dot_product_attention for rotary / no position embeddings
+        self.use_sdpa = use_sdpa
+
+
+@lru_cache(maxsize=32)
+def get_chunked_attention_mask(
+    query_length: int, key_length: int, chunk_size: int, num_left_chunks: int, device: torch.device
+) -> torch.BoolTensor:
+    """Mask of the keys hidden from each query, queries being the last `query_length` key positions.
+
+    Each query attends to its whole chunk and to `num_left_chunks` previous chunks (all of them if negative), chunk size
+    of 1 without the left chunk limit gives the full causal mask. Masks are cached per length and must not be modified
+    in place.
+    """
+    key_positions = torch.arange(key_length, device=device)
+    query_chunks = (key_positions[key_length - query_length :] // chunk_size).unsqueeze(1)
+    key_chunks = (key_positions // chunk_size).unsqueeze(0)
+    mask = key_chunks > query_chunks
+    if num_left_chunks >= 0:
+        mask |= key_chunks < query_chunks - num_left_chunks
+    return mask
 
 
 class Wav2Vec2EBranchformerSelfAttention(Wav2Vec2ConformerSelfAttention):
     def __init__(self, config: Wav2Vec2EBranchformerConfig):
         super().__init__(config)
         self.is_causal = config.is_causal
+        self.use_sdpa = config.use_sdpa and config.position_embeddings_type != "relative"
+
+    def _apply_relative_embeddings(self, query, key, relative_position_embeddings):
+        if query.size(-2) == key.size(-2):
+            return super()._apply_relative_embeddings(query, key, relative_position_embeddings)
+
+        # Queries are the last positions of the cached keys (streaming inference),
+        # relative embeddings span all the key positions => (1, head, d_k, 2*time2-1)
+        proj_relative_position_embeddings = self.linear_pos(relative_position_embeddings)
+        proj_relative_position_embeddings = proj_relative_position_embeddings.view(
+            relative_position_embeddings.size(0), -1, self.num_heads, self.head_size
+        ).permute(0, 2, 3, 1)
+
+        query = query.transpose(1, 2)
+        q_with_bias_u = (query + self.pos_bias_u).transpose(1, 2)
+        q_with_bias_v = (query + self.pos_bias_v).transpose(1, 2)
+
+        # => (batch, head, time1, time2)
+        scores_ac = torch.matmul(q_with_bias_u, key.transpose(-2, -1))
+        # => (batch, head, time1, 2*time2-1), index k corresponds to the relative position time2-1-k
+        scores_bd = torch.matmul(q_with_bias_v, proj_relative_position_embeddings)
+        query_length, key_length = query.size(1), key.size(-2)
+        query_positions = torch.arange(key_length - query_length, key_length, device=query.device)
+        key_positions = torch.arange(key_length, device=query.device)
+        relative_index = key_length - 1 - query_positions.unsqueeze(1) + key_positions.unsqueeze(0)
+        scores_bd = scores_bd.gather(-1, relative_index.expand(*scores_bd.shape[:2], -1, -1))
 
-    def get_causal_mask(self, i, j, device):
-        return torch.ones((i, j), device=device, dtype=torch.bool).triu(j - i + 1)
+        return (scores_ac + scores_bd) / math.sqrt(self.head_size)
 
     def forward(
         self,
@@ -73,6 +136,7 @@ class Wav2Vec2EBranchformerSelfAttention(Wav2Vec2ConformerSelfAttention):
         attention_mask: Optional[torch.Tensor] = None,
         relative_position_embeddings: Optional[torch.Tensor] = None,
         output_attentions: bool = False,
+        streaming_cache: Optional[Dict[str, torch.Tensor]] = None,
     ) -> Tuple[torch.Tensor, Optional[torch.Tensor], Optional[Tuple[torch.Tensor]]]:
         # self-attention mechanism
         batch_size, sequence_length, hidden_size = hidden_states.size()
@@ -98,37 +162,48 @@ class Wav2Vec2EBranchformerSelfAttention(Wav2Vec2ConformerSelfAttention):
         key = key.transpose(1, 2)
         value = value.transpose(1, 2)
 
-        if self.position_embeddings_type == "relative":
-            if relative_position_embeddings is None:
-                raise ValueError(
-                    "`relative_position_embeddings` has to be defined when `self.position_embeddings_type =="
-                    " 'relative'"
-                )
-            # apply relative_position_embeddings to qk scores
-            # as proposed in Transformer_XL: https://arxiv.org/abs/1901.02860
-            scores = self._apply_relative_embeddings(
-                query=query, key=key, relative_position_embeddings=relative_position_embeddings
+        if streaming_cache is not None:
+            # prepend keys and values of the previous chunks of the stream
+            if "key" in streaming_cache:
+                key = torch.cat((streaming_cache["key"], key), dim=2)
+                value = torch.cat((streaming_cache["value"], value), dim=2)
+            streaming_cache["key"], streaming_cache["value"] = key, value
+
+        if self.use_sdpa and not output_attentions:
+            # => (batch, head, time1, d_k), attention probabilities are never materialized
+            hidden_states = nn.functional.scaled_dot_product_attention(
+                query,
+                key,
+                value,
+                attn_mask=attention_mask,
+                dropout_p=self.dropout.p if self.training else 0.0,
             )
+            probs = None
         else:
-            scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(self.head_size)
-
-        if self.is_causal:
-            causal_mask = self.get_causal_mask(query.size(-2), key.size(-2), device=query.device)
-            if attention_mask is None:
-                attention_mask = causal_mask * -torch.finfo(query.dtype).max
+            if self.position_embeddings_type == "relative":
+                if relative_position_embeddings is None:
+                    raise ValueError(
+                        "`relative_position_embeddings` has to be defined when `self.position_embeddings_type =="
+                        " 'relative'"
+                    )
+                # apply relative_position_embeddings to qk scores
+                # as proposed in Transformer_XL: https://arxiv.org/abs/1901.02860
+                scores = self._apply_relative_embeddings(
+                    query=query, key=key, relative_position_embeddings=relative_position_embeddings
+                )
             else:
-                attention_mask = attention_mask.masked_fill(causal_mask, -torch.finfo(query.dtype).max)
+                scores = torch.matmul(query, key.transpose(-2, -1)) / math.sqrt(self.head_size)
 
-        # apply attention_mask if necessary
-        if attention_mask is not None:
-            scores = scores + attention_mask
+            # apply attention_mask if necessary, causal / chunk masking is already merged in by the encoder
+            if attention_mask is not None:
+                scores = scores + attention_mask
 
-        # => (batch, head, time1, time2)
-        probs = torch.softmax(scores, dim=-1)
-        probs = self.dropout(probs)
+            # => (batch, head, time1, time2)
+            probs = torch.softmax(scores, dim=-1)
+            probs = self.dropout(probs)
 
-        # => (batch, head, time1, d_k)
-        hidden_states = torch.matmul(probs, value)
+            # => (batch, head, time1, d_k)
+            hidden_states = torch.matmul(probs, value)
 
         # => (batch, time1, hidden_size)
         hidden_states = hidden_states.transpose(1, 2).reshape(batch_size, -1, self.num_heads * self.head_size)
@@ -177,11 +252,12 @@ class ConvolutionalSpatialGatingUnit(torch.nn.Module):
 
         self.dropout = torch.nn.Dropout(config.csgu_conv_dropout)
 
-    def forward(self, hidden_states: torch.FloatTensor):
+    def forward(self, hidden_states: torch.FloatTensor, streaming_cache: Optional[Dict[str, torch.Tensor]] = None):
         """Forward method
 
         Args:
             hidden_states (torch.Tensor): (N, T, D)
+            streaming_cache (dict): convolution left context carried between the chunks of a stream
 
         Returns:
             out (torch.Tensor): (N, T, D/2)
@@ -190,7 +266,13 @@ class ConvolutionalSpatialGatingUnit(torch.nn.Module):
         x_r, x_g = hidden_states.chunk(2, dim=-1)
 
         x_g = self.norm(x_g)  # (N, T, D/2)
-        x_g = self.conv(x_g.transpose(1, 2)).transpose(1, 2)  # (N, T, D/2)
+        if streaming_cache is None:
+            x_g = self.conv(x_g.transpose(1, 2)).transpose(1, 2)  # (N, T, D/2)
+        else:
+            x_g, streaming_cache["csgu_conv"] = self.conv.forward_streaming(
+                x_g.transpose(1, 2), streaming_cache.get("csgu_conv")
+            )
+            x_g = x_g.transpose(1, 2)
         if self.linear is not None:
             x_g = self.linear(x_g)
 
@@ -211,9 +293,9 @@ class ConvolutionalGatingMLP(torch.nn.Module):
         self.csgu = ConvolutionalSpatialGatingUnit(config)
         self.channel_proj2 = torch.nn.Linear(config.intermediate_size // 2, config.hidden_size)
 
-    def forward(self, hidden_states: torch.FloatTensor):
+    def forward(self, hidden_states: torch.FloatTensor, streaming_cache: Optional[Dict[str, torch.Tensor]] = None):
         hidden_states = self.channel_proj1(hidden_states)  # hidden_size -> intermediate_size
-        hidden_states = self.csgu(hidden_states)  # intermediate_size -> intermediate_size/2
+        hidden_states = self.csgu(hidden_states, streaming_cache)  # intermediate_size -> intermediate_size/2
         hidden_states = self.channel_proj2(hidden_states)  # intermediate_size/2 -> hidden_size
         return hidden_states
 
@@ -241,14 +323,25 @@ class Wav2Vec2EBranchformerEncoderLayer(nn.Module):
         # Merge
         self.final_dropout = torch.nn.Dropout(dropout)
         self.merge_proj = torch.nn.Linear(embed_dim + embed_dim, embed_dim)
-        self.depthwise_conv_fusion = torch.nn.Conv1d(
-            embed_dim + embed_dim,
-            embed_dim + embed_dim,
-            kernel_size=config.merge_conv_kernel,
-            stride=1,
-            padding=(config.merge_conv_kernel - 1) // 2,
-            groups=embed_dim + embed_dim,
-            bias=True,
+        self.depthwise_conv_fusion = (
+            CausalConv1d(
+                embed_dim + embed_dim,
+                embed_dim + embed_dim,
+                kernel_size=config.merge_conv_kernel,
+                stride=1,
+                groups=embed_dim + embed_dim,
+                bias=True,
+            )
+            if config.is_causal and config.causal_conv_fusion
+            else torch.nn.Conv1d(
+                embed_dim + embed_dim,
+                embed_dim + embed_dim,
+                kernel_size=config.merge_conv_kernel,
+                stride=1,
+                padding=(config.merge_conv_kernel - 1) // 2,
+                groups=embed_dim + embed_dim,
+                bias=True,
+            )
         )
         self.final_layer_norm = nn.LayerNorm(embed_dim)
 
@@ -262,6 +355,7 @@ class Wav2Vec2EBranchformerEncoderLayer(nn.Module):
         attention_mask: Optional[torch.Tensor] = None,
         relative_position_embeddings: Optional[torch.Tensor] = None,
         output_attentions: bool = False,
+        streaming_cache: Optional[Dict[str, torch.Tensor]] = None,
     ):
         # 1. Optional ff1
         if self.ff1:
@@ -280,19 +374,26 @@ class Wav2Vec2EBranchformerEncoderLayer(nn.Module):
             attention_mask=attention_mask,
             relative_position_embeddings=relative_position_embeddings,
             output_attentions=output_attentions,
+            streaming_cache=streaming_cache,
         )
         global_branch = self.self_attn_dropout(global_branch)
 
         # 4. cgMLP Branch
         local_branch = self.cgMLP_layer_norm(local_branch)
-        local_branch = self.cgMLP(local_branch)
+        local_branch = self.cgMLP(local_branch, streaming_cache)
 
         # 5. Merge operator
         # a, concat
         hidden_states = torch.cat([global_branch, local_branch], dim=-1)
         merge_residual = hidden_states
         # b, depth-wise conv mixing
-        hidden_states = merge_residual + self.depthwise_conv_fusion(hidden_states.transpose(1, 2)).transpose(1, 2)
+        if streaming_cache is None:
+            hidden_states = self.depthwise_conv_fusion(hidden_states.transpose(1, 2))
+        else:
+            hidden_states, streaming_cache["fusion_conv"] = self.depthwise_conv_fusion.forward_streaming(
+                hidden_states.transpose(1, 2), streaming_cache.get("fusion_conv")
+            )
+        hidden_states = merge_residual + hidden_states.transpose(1, 2)
         # c, project back to original size and final dropout
         hidden_states = self.final_dropout(self.merge_proj(hidden_states))
 
@@ -317,6 +418,163 @@ class Wav2Vec2EBranchformerEncoder(Wav2Vec2ConformerEncoder):
         )
         self.pos_conv_embed = None
 
+    def get_causal_mask(self, query_length: int, key_length: int, device: torch.device) -> Optional[torch.BoolTensor]:
+        """Chunk-wise mask if chunked attention is configured, causal mask for causal models, None otherwise."""
+        if self.config.attention_chunk_size > 0:
+            return get_chunked_attention_mask(
+                query_length,
+                key_length,
+                self.config.attention_chunk_size,
+                self.config.attention_num_left_chunks,
+                device,
+            )
+        if self.config.is_causal:
+            return get_chunked_attention_mask(query_length, key_length, 1, -1, device)
+        return None
+
+    def forward(
+        self,
+        hidden_states,
+        attention_mask=None,
+        output_attentions=False,
+        output_hidden_states=False,
+        return_dict=True,
+    ):
+        all_hidden_states = () if output_hidden_states else None
+        all_self_attentions = () if output_attentions else None
+
+        # padding and causal masks are merged once and shared by all the layers
+        mask = self.get_causal_mask(hidden_states.size(1), hidden_states.size(1), hidden_states.device)
+        if mask is not None:
+            mask = mask[None, None]
+        if attention_mask is not None:
+            # make sure padded tokens output 0
+            hidden_states[~attention_mask] = 0.0
+            padding_mask = ~attention_mask[:, None, None, :]
+            mask = padding_mask if mask is None else padding_mask | mask
+        attention_mask = None
+        if mask is not None:
+            attention_mask = torch.zeros(mask.shape, dtype=hidden_states.dtype, device=hidden_states.device)
+            attention_mask.masked_fill_(mask, torch.finfo(hidden_states.dtype).min)
+
+        hidden_states = self.dropout(hidden_states)
+
+        if self.embed_positions is not None:
+            relative_position_embeddings = self.embed_positions(hidden_states)
+        else:
+            relative_position_embeddings = None
+
+        deepspeed_zero3_is_enabled = is_deepspeed_zero3_enabled()
+
+        for layer in self.layers:
+            if output_hidden_states:
+                all_hidden_states = all_hidden_states + (hidden_states,)
+
+            # add LayerDrop (see https://arxiv.org/abs/1909.11556 for description)
+            dropout_probability = torch.rand([])
+
+            skip_the_layer = True if self.training and (dropout_probability < self.config.layerdrop) else False
+            if not skip_the_layer or deepspeed_zero3_is_enabled:
+                # under deepspeed zero3 all gpus must run in sync
+                if self.gradient_checkpointing and self.training:
+                    layer_outputs = self._gradient_checkpointing_func(
+                        layer.__call__,
+                        hidden_states,
+                        attention_mask,
+                        relative_position_embeddings,
+                        output_attentions,
+                    )
+                else:
+                    layer_outputs = layer(
+                        hidden_states,
+                        attention_mask=attention_mask,
+                        relative_position_embeddings=relative_position_embeddings,
+                        output_attentions=output_attentions,
+                    )
+                hidden_states = layer_outputs[0]
+
+            if skip_the_layer:
+                layer_outputs = (None, None)
+
+            if output_attentions:
+                all_self_attentions = all_self_attentions + (layer_outputs[1],)
+
+        hidden_states = self.layer_norm(hidden_states)
+        if output_hidden_states:
+            all_hidden_states = all_hidden_states + (hidden_states,)
+
+        if not return_dict:
+            return tuple(v for v in [hidden_states, all_hidden_states, all_self_attentions] if v is not None)
+        return BaseModelOutput(
+            last_hidden_state=hidden_states,
+            hidden_states=all_hidden_states,
+            attentions=all_self_attentions,
+        )
+
+    def forward_streaming(
+        self, hidden_states: torch.FloatTensor, streaming_state: EncoderStreamingState, flush: bool = False
+    ):
+        """Encode the next chunk of a stream, attention keys/values and convolution buffers of each layer
+        are kept in `streaming_state.layer_caches`.
+
+        With chunked attention, frames attend to the whole chunk they belong to, so they are encoded only once their
+        chunk is complete (or the stream is flushed) and only the keys of the left chunks visible to the next frame
+        are kept. Frames of an incomplete chunk wait in `streaming_state.pending_hidden_states`."""
+        if streaming_state.pending_hidden_states is not None:
+            hidden_states = torch.cat((streaming_state.pending_hidden_states, hidden_states), dim=1)
+        num_ready = hidden_states.size(1)
+        if self.config.attention_chunk_size > 0 and not flush:
+            num_ready -= num_ready % self.config.attention_chunk_size
+        streaming_state.pending_hidden_states = hidden_states[:, num_ready:]
+        hidden_states = hidden_states[:, :num_ready]
+        if num_ready == 0:
+            return self.layer_norm(hidden_states)
+
+        if streaming_state.layer_caches is None:
+            streaming_state.layer_caches = [{} for _ in self.layers]
+
+        offset = streaming_state.num_frames
+        total_length = offset + hidden_states.size(1)
+        cached_length = (
+            streaming_state.layer_caches[0]["key"].size(2) if "key" in streaming_state.layer_caches[0] else 0
+        )
+        relative_position_embeddings = None
+        if self.config.position_embeddings_type == "rotary":
+            relative_position_embeddings = self.embed_positions(hidden_states.new_zeros((1, total_length, 1)))
+            relative_position_embeddings = relative_position_embeddings[:, offset:]
+        elif self.embed_positions is not None:
+            # relative positions have to cover the cached keys as well
+            key_length = cached_length + hidden_states.size(1)
+            relative_position_embeddings = self.embed_positions(hidden_states.new_zeros((1, key_length, 1)))
+
+        attention_mask = None
+        causal_mask = self.get_causal_mask(
+            hidden_states.size(1), cached_length + hidden_states.size(1), hidden_states.device
+        )
+        if causal_mask is not None:
+            attention_mask = torch.zeros(causal_mask.shape, dtype=hidden_states.dtype, device=hidden_states.device)
+            attention_mask = attention_mask.masked_fill_(causal_mask, torch.finfo(hidden_states.dtype).min)[None, None]
+
+        for layer, layer_cache in zip(self.layers, streaming_state.layer_caches):
+            hidden_states, _ = layer(
+                hidden_states,
+                attention_mask=attention_mask,
+                relative_position_embeddings=relative_position_embeddings,
+                streaming_cache=layer_cache,
+            )
+        streaming_state.num_frames = total_length
+
+        chunk_size, num_left_chunks = self.config.attention_chunk_size, self.config.attention_num_left_chunks
+        if chunk_size > 0 and num_left_chunks >= 0:
+            # drop the keys and values no longer visible to the following frames
+            keep_length = total_length - max(0, (total_length // chunk_size - num_left_chunks) * chunk_size)
+            for layer_cache in streaming_state.layer_caches:
+                start = layer_cache["key"].size(2) - keep_length
+                layer_cache["key"] = layer_cache["key"][:, :, start:]
+                layer_cache["value"] = layer_cache["value"][:, :, start:]
+
+        return self.layer_norm(hidden_states)
+
 
 class Wav2Vec2EBranchformerModel(FeatureExtractorForStreaming, Wav2Vec2ConformerModel):
     def __init__(self, config: Wav2Vec2EBranchformerConfig):
@@ -326,6 +584,53 @@ class Wav2Vec2EBranchformerModel(FeatureExtractorForStreaming, Wav2Vec2Conformer
         # Initialize weights and apply final processing
         self.post_init()
 
+    @torch.no_grad()
+    def forward_streaming(
+        self, input_values: torch.Tensor, streaming_state: Optional[EncoderStreamingState] = None
+    ) -> Tuple[torch.FloatTensor, EncoderStreamingState]:
+        """Encode the next chunk of an input stream with a causal model.
+
+        Args:
+            input_values (torch.Tensor): next chunk of 2d input features (N, T, F)
+            streaming_state (EncoderStreamingState): state returned for the previous chunk, None for a new stream
+
+        Returns:
+            hidden states of the newly available frames (N, T', D) and the updated streaming state
+        """
+        if not self.config.is_causal:
+            raise ValueError("Streaming inference requires a causal model, set `is_causal` in the model config.")
+        if not self.config.causal_conv_fusion:
+            raise ValueError(
+                "Streaming inference requires the causal merge convolution, set `causal_conv_fusion` in the model "
+                "config. Models trained without it cannot be streamed exactly."
+            )
+        if not hasattr(self.feature_extractor, "forward_streaming"):
+            raise NotImplementedError("Causal streaming models are not supported for 1d input")
+        if self.adapter is not None:
+            raise NotImplementedError("Streaming inference is not supported for models with an adapter")
+        if streaming_state is None:
+            streaming_state = EncoderStreamingState()
+
+        extract_features, streaming_state.feature_extractor_cache = self.feature_extractor.forward_streaming(
+            input_values, streaming_state.feature_extractor_cache
+        )
+        hidden_states, _ = self.feature_projection(extract_features.transpose(1, 2))
+        hidden_states = self.encoder.forward_streaming(hidden_states, streaming_state)
+        return hidden_states, streaming_state
+
+    @torch.no_grad()
+    def flush_streaming(self, streaming_state: EncoderStreamingState) -> torch.FloatTensor:
+        """Encode the frames held back at the end of a stream, i.e. those of an incomplete attention chunk.
+        The stream cannot be continued afterwards.
+
+        Returns:
+            hidden states of the remaining frames (N, T', D)
+        """
+        if streaming_state is None or streaming_state.pending_hidden_states is None:
+            raise ValueError("There is no stream to flush, `forward_streaming` has to be called first.")
+        pending_hidden_states = streaming_state.pending_hidden_states
+        return self.encoder.forward_streaming(pending_hidden_states[:, :0], streaming_state, flush=True)
+
 
 class Wav2Vec2EBranchformerForPreTraining(Wav2Vec2ForPreTraining):
     config_class = Wav2Vec2EBranchformerConfig
@@ -346,6 +651,21 @@ class Wav2Vec2EBranchformerForCTC(Wav2Vec2ForCTC):
         self.wav2vec2 = Wav2Vec2EBranchformerModel(config)
         self.post_init()
 
+    @torch.no_grad()
+    def forward_streaming(
+        self, input_values: torch.Tensor, streaming_state: Optional[EncoderStreamingState] = None
+    ) -> Tuple[torch.FloatTensor, EncoderStreamingState]:
+        """Compute CTC logits of the next chunk of an input stream, see `Wav2Vec2EBranchformerModel.forward_streaming`."""
+        hidden_states, streaming_state = self.wav2vec2.forward_streaming(input_values, streaming_state)
+        logits = self.lm_head(self.dropout(hidden_states))
+        return logits, streaming_state
+
+    @torch.no_grad()
+    def flush_streaming(self, streaming_state: EncoderStreamingState) -> torch.FloatTensor:
+        """Compute CTC logits of the frames held back at the end of a stream, see
+        `Wav2Vec2EBranchformerModel.flush_streaming`."""
+        return self.lm_head(self.dropout(self.wav2vec2.flush_streaming(streaming_state)))
+
 
 class BestRQEBranchformerConfig(Wav2Vec2EBranchformerConfig):
     model_type = "bestrq-ebranchformer"
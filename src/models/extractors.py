@@ -1,3 +1,5 @@
+from typing import List, Optional, Tuple
+
 import torch
 from torch import nn
 from transformers.activations import ACT2FN
@@ -47,3 +49,20 @@ class Conv2dFeatureExtractor(nn.Module):
         hidden_states = self.conv(input_values[:, None, ...])
         hidden_states = self.out(hidden_states.transpose(1, 2).flatten(2, 3))
         return hidden_states.transpose(1, 2)
+
+    def forward_streaming(
+        self, input_values: torch.Tensor, cache: Optional[List[torch.Tensor]] = None
+    ) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """Process the next chunk of a stream, `cache` holds the left context of each causal convolution."""
+        if cache is None:
+            cache = [None] * len(self.conv)
+        hidden_states = input_values[:, None, ...]
+        new_cache = []
+        for (conv, activation), left_context in zip(self.conv, cache):
+            if not isinstance(conv, CausalConv2d):
+                raise ValueError("Streaming feature extraction requires causal convolutions.")
+            hidden_states, left_context = conv.forward_streaming(hidden_states, left_context)
+            hidden_states = activation(hidden_states)
+            new_cache.append(left_context)
+        hidden_states = self.out(hidden_states.transpose(1, 2).flatten(2, 3))
+        return hidden_states.transpose(1, 2), new_cache
@@ -1,4 +1,5 @@
-from typing import Optional, Union
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
 
 import torch
 import torch.nn.functional as F
@@ -27,6 +28,18 @@ class CausalConv1d(torch.nn.Conv1d):
     def forward(self, input_tensor: torch.Tensor):
         return super().forward(F.pad(input_tensor, (self.__padding, 0)))
 
+    def forward_streaming(
+        self, input_tensor: torch.Tensor, left_context: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Process the next chunk of a stream, `left_context` holds the input frames not yet fully consumed."""
+        if left_context is None:
+            left_context = input_tensor.new_zeros((*input_tensor.shape[:2], self.__padding))
+        input_tensor = torch.cat((left_context, input_tensor), dim=-1)
+        num_outputs = max((input_tensor.size(-1) - self.__padding - 1) // self.stride[0] + 1, 0)
+        if num_outputs == 0:
+            return input_tensor.new_zeros((input_tensor.size(0), self.out_channels, 0)), input_tensor
+        return super().forward(input_tensor), input_tensor[..., num_outputs * self.stride[0] :]
+
 
 class CausalConv2d(nn.Conv2d):
     def __init__(self, in_channels, out_channels, kernel_size, stride=1, padding=None, dilation=1, groups=1, bias=True):
@@ -54,6 +67,33 @@ class CausalConv2d(nn.Conv2d):
         output = super().forward(inputs)
         return output
 
+    def forward_streaming(
+        self, inputs: torch.Tensor, left_context: Optional[torch.Tensor] = None
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Process the next chunk of a stream along the time axis (dim 2),
+        `left_context` holds the input frames not yet fully consumed."""
+        inputs = F.pad(inputs, (self.left_padding[1], 0, 0, 0))
+        if left_context is None:
+            left_context = inputs.new_zeros((*inputs.shape[:2], self.left_padding[0], inputs.size(3)))
+        inputs = torch.cat((left_context, inputs), dim=2)
+        receptive_field = self.dilation[0] * (self.kernel_size[0] - 1) + 1
+        num_outputs = max((inputs.size(2) - receptive_field) // self.stride[0] + 1, 0)
+        if num_outputs == 0:
+            freq_size = (inputs.size(3) - self.dilation[1] * (self.kernel_size[1] - 1) - 1) // self.stride[1] + 1
+            return inputs.new_zeros((inputs.size(0), self.out_channels, 0, freq_size)), inputs
+        return super().forward(inputs), inputs[:, :, num_outputs * self.stride[0] :]
+
+
+@dataclass
+class EncoderStreamingState:
+    """Buffers carried between the chunks of streaming inference of causal encoders."""
+
+    feature_extractor_cache: Optional[List[torch.Tensor]] = None
+    layer_caches: Optional[List[Dict[str, torch.Tensor]]] = None
+    num_frames: int = 0
+    # encoder inputs of an incomplete attention chunk, they are encoded once the chunk is complete or the stream flushed
+    pending_hidden_states: Optional[torch.Tensor] = None
+
 
 class FeatureExtractorForStreaming(PreTrainedModel):
     def _get_feat_extract_output_lengths(
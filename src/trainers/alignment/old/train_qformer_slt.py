@@ -21,7 +21,7 @@ from transformers import (
 )
 from transformers.utils import logging
 
-from utilities.callbacks import init_callbacks
+from utilities.callbacks import get_preprocessed_split, init_callbacks
 from utilities.collators import SpeechMTCollatorWithPadding, SpeechCollatorWithPadding
 from utilities.data_utils import get_dataset
 from utilities.eval_utils import compute_metrics_translation
@@ -163,6 +163,7 @@ if __name__ == "__main__":
 
     # 5. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
     # 6. Initialize data collator
     data_collator = SpeechMTCollatorWithPadding(
@@ -22,7 +22,7 @@ from transformers import (
 )
 from transformers.utils import logging
 
-from utilities.callbacks import init_callbacks
+from utilities.callbacks import get_preprocessed_split, init_callbacks
 from utilities.collators import SpeechAlignedCollatorWithPadding, SpeechCollatorWithPadding
 from utilities.data_utils import get_dataset
 from utilities.eval_utils import compute_metrics_translation
@@ -39,7 +39,10 @@ from utilities.training_arguments import (
 from models.old_alignment import AlignmentConfig
 from models.aligned import SpeechEncoderBridgeTextDecoder
 from models.ctc_encoder_plus_autoregressive_decoder import JointCTCAttentionEncoderDecoder
-from utilities.training_utils import AdditionalLossTrackerTrainer
+from utilities.training_utils import (
+    AdditionalLossTrackerTrainer,
+    DynamicBatchingSeq2SeqTrainer,
+)
 
 
 if __name__ == "__main__":
@@ -201,6 +204,7 @@ if __name__ == "__main__":
 
     # 5. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
     # 6. Initialize data collator
     data_collator = SpeechAlignedCollatorWithPadding(
@@ -216,7 +220,7 @@ if __name__ == "__main__":
     )
 
     # 7. Initialize trainer
-    trainer_class = AdditionalLossTrackerTrainer if qformer_args.qf_mm_loss_weight > 0 else Seq2SeqTrainer
+    trainer_class = AdditionalLossTrackerTrainer if qformer_args.qf_mm_loss_weight > 0 else DynamicBatchingSeq2SeqTrainer
     trainer = Seq2SeqTrainer
     trainer = trainer_class(
             args=training_args,
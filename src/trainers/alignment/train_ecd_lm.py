@@ -7,7 +7,6 @@ from transformers import (
     AutoTokenizer,
     GenerationConfig,
     HfArgumentParser,
-    Seq2SeqTrainer,
     Blip2QFormerConfig,
     WhisperForConditionalGeneration,
     BitsAndBytesConfig,
@@ -19,9 +18,10 @@ from transformers.modeling_outputs import Wav2Vec2BaseModelOutput
 from transformers.utils import logging
 import torch
 
-from utilities.callbacks import init_callbacks
+from utilities.callbacks import get_preprocessed_split, init_callbacks
 from utilities.collators import SpeechAlignedCollatorWithPadding
-from utilities.data_utils import get_dataset
+from utilities.data_utils import estimate_decoder_lengths, get_dataset
+from utilities.encoder_cache import get_cached_encoder_outputs
 from utilities.eval_utils import compute_metrics
 from utilities.model_utils import average_checkpoints as average_checkpoints
 from utilities.general_utils import do_evaluate, do_generate
@@ -37,7 +37,7 @@ set_seed(42)
 
 from models.old_alignment import AlignmentConfig
 from models.aligned_decoder_lm import SpeechEncoderConnectorLMDecoder
-from utilities.training_utils import AdditionalLossTrackerTrainer
+from utilities.training_utils import AdditionalLossTrackerTrainer, TokenBudgetSeq2SeqTrainer
 
 from peft import LoraConfig, get_peft_model, replace_lora_weights_loftq
 
@@ -234,6 +234,7 @@ if __name__ == "__main__":
 
     # 5. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
     # 6. Initialize data collator
     data_collator = SpeechAlignedCollatorWithPadding(
@@ -256,8 +257,22 @@ if __name__ == "__main__":
     else:
         c_metrics = lambda pred: compute_metrics(tokenizer, pred, gen_args.wandb_predictions_to_save) 
 
-    # 7. Initialize trainer
-    trainer = Seq2SeqTrainer(
+    # 7. Initialize trainer, optionally batching by the estimated decoder sequence length
+    decoder_lengths = None
+    if training_args.do_train and training_args.max_batch_tokens:
+        train_dataset = dataset[data_args.train_split]
+        decoder_lengths = estimate_decoder_lengths(
+            train_dataset,
+            tokenizer,
+            data_args.text_column_name,
+            model.estimate_connector_lengths(
+                train_dataset[training_args.length_column_name], data_args.sampling_rate, feature_extractor
+            ),
+            max_context=0,
+            prompts=[conn_args.prompt_prefix, conn_args.prompt_suffix],
+        )
+
+    trainer = TokenBudgetSeq2SeqTrainer(
             args=training_args,
             model=model,
             callbacks=callbacks,
@@ -265,8 +280,24 @@ if __name__ == "__main__":
             eval_dataset=training_eval_dataset,
             data_collator=data_collator,
             compute_metrics=c_metrics,
+            decoder_lengths=decoder_lengths,
     )
 
+    # train the connector on the precomputed outputs of the frozen encoder
+    if training_args.do_train and conn_args.encoder_outputs_cache_dir:
+        with training_args.main_process_first(desc="encoder outputs precomputation"):
+            trainer.train_dataset, trainer.data_collator = get_cached_encoder_outputs(
+                model,
+                trainer.train_dataset,
+                data_collator,
+                conn_args.encoder_outputs_cache_dir,
+                audio_column=data_args.audio_column_name,
+                sampling_rate=data_args.sampling_rate,
+                batch_size=training_args.per_device_eval_batch_size,
+                num_workers=training_args.dataloader_num_workers,
+                fp16=conn_args.encoder_outputs_cache_fp16,
+            )
+
     # 8. Train model
     if training_args.do_train:
         trainer.train(resume_from_checkpoint=training_args.restart_from or None)
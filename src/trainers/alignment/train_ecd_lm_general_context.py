@@ -7,19 +7,21 @@ from transformers import (
     AutoTokenizer,
     GenerationConfig,
     HfArgumentParser,
-    Seq2SeqTrainer,
     Blip2QFormerConfig,
     WhisperForConditionalGeneration,
 )
 from transformers.utils import logging
 import torch
 
-from utilities.callbacks import init_callbacks
+from utilities.callbacks import get_preprocessed_split, init_callbacks
 from utilities.collators import GeneralContextCollator
-from utilities.data_utils import get_dataset
+from utilities.context_utils import ConversationTurnTable
+from utilities.data_utils import estimate_decoder_lengths, get_dataset
+from utilities.encoder_cache import get_cached_encoder_outputs
 from utilities.eval_utils import compute_metrics_fisher_turns
 from utilities.model_utils import average_checkpoints as average_checkpoints
 from utilities.general_utils import do_evaluate, do_generate
+from utilities.training_utils import TokenBudgetSeq2SeqTrainer
 from utilities.training_arguments import (
     DataTrainingArguments,
     GeneralTrainingArguments,
@@ -189,8 +191,12 @@ if __name__ == "__main__":
 
     # 5. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
-    # 6. Initialize data collator
+    # 6. Initialize data collator, contexts stored by reference are resolved from the turn table
+    turn_table = (
+        ConversationTurnTable.from_disk(data_args.context_turn_table) if data_args.context_turn_table else None
+    )
     data_collator = GeneralContextCollator(
         feature_extractor=feature_extractor,
         tokenizer=tokenizer,
@@ -204,6 +210,7 @@ if __name__ == "__main__":
         prompt_suffix=conn_args.prompt_suffix,
         max_context=data_args.fisher_max_context,
         context_trunc_to_shortest=data_args.fisher_context_trunc_to_shortest,
+        turn_table=turn_table,
     )
 
     if gen_args.no_metrics:
@@ -213,8 +220,23 @@ if __name__ == "__main__":
     else:
         c_metrics = lambda pred: compute_metrics_fisher_turns(tokenizer, pred, gen_args.wandb_predictions_to_save, remove_spk_tags=True) 
 
-    # 7. Initialize trainer
-    trainer = Seq2SeqTrainer(
+    # 7. Initialize trainer, optionally batching by the estimated decoder sequence length
+    decoder_lengths = None
+    if training_args.do_train and training_args.max_batch_tokens:
+        train_dataset = dataset[data_args.train_split]
+        decoder_lengths = estimate_decoder_lengths(
+            train_dataset,
+            tokenizer,
+            data_args.text_column_name,
+            model.estimate_connector_lengths(
+                train_dataset[training_args.length_column_name], data_args.sampling_rate, feature_extractor
+            ),
+            max_context=data_args.fisher_max_context,
+            prompts=[data_args.fisher_context_prefix, conn_args.prompt_prefix, conn_args.prompt_suffix],
+            turn_table=turn_table,
+        )
+
+    trainer = TokenBudgetSeq2SeqTrainer(
             args=training_args,
             model=model,
             callbacks=callbacks,
@@ -222,8 +244,24 @@ if __name__ == "__main__":
             eval_dataset=training_eval_dataset,
             data_collator=data_collator,
             compute_metrics=c_metrics,
+            decoder_lengths=decoder_lengths,
     )
 
+    # train the connector on the precomputed outputs of the frozen encoder
+    if training_args.do_train and conn_args.encoder_outputs_cache_dir:
+        with training_args.main_process_first(desc="encoder outputs precomputation"):
+            trainer.train_dataset, trainer.data_collator = get_cached_encoder_outputs(
+                model,
+                trainer.train_dataset,
+                data_collator,
+                conn_args.encoder_outputs_cache_dir,
+                audio_column=data_args.audio_column_name,
+                sampling_rate=data_args.sampling_rate,
+                batch_size=training_args.per_device_eval_batch_size,
+                num_workers=training_args.dataloader_num_workers,
+                fp16=conn_args.encoder_outputs_cache_fp16,
+            )
+
     # 8. Train model
     if training_args.do_train:
         trainer.train(resume_from_checkpoint=training_args.restart_from or None)
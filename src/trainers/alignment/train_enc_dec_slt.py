@@ -6,13 +6,12 @@ from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     HfArgumentParser,
-    Seq2SeqTrainer,
     WhisperForConditionalGeneration,
 )
 from transformers.utils import logging
 
 from decoding.config import GenerationConfigCustom
-from utilities.callbacks import init_callbacks
+from utilities.callbacks import get_preprocessed_split, init_callbacks
 from utilities.collators import SpeechCollatorWithPadding
 from utilities.data_utils import get_dataset
 from utilities.eval_utils import compute_metrics
@@ -24,7 +23,10 @@ from utilities.training_arguments import (
     GenerationArguments,
     ModelArguments,
 )
-from utilities.training_utils import AdditionalLossTrackerTrainer
+from utilities.training_utils import (
+    AdditionalLossTrackerTrainer,
+    DynamicBatchingSeq2SeqTrainer,
+)
 from models.ctc_encoder_plus_autoregressive_decoder import JointCTCAttentionEncoderDecoder
 from models.auto_wrappers import CustomAutoModelForCTC, CustomModelForCausalLM
 
@@ -97,8 +99,10 @@ if __name__ == "__main__":
         num_beams=gen_args.num_beams,
         ctc_weight=gen_args.decoding_ctc_weight,
         ctc_margin=gen_args.ctc_margin,
+        ctc_pre_beam_size=gen_args.ctc_pre_beam_size,
         lm_weight=gen_args.lm_weight,
         lm_model=AutoModelForCausalLM.from_pretrained(gen_args.lm_model) if gen_args.lm_model else None,
+        lm_use_cache=gen_args.lm_use_cache,
         space_token_id=gen_args.space_token_id,
         apply_eos_space_trick=gen_args.apply_eos_space_trick,
         eos_space_trick_weight=gen_args.eos_space_trick_weight,
@@ -114,6 +118,7 @@ if __name__ == "__main__":
 
     # 5. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
     # 6. Initialize data collator
     data_collator = SpeechCollatorWithPadding(
@@ -129,7 +134,7 @@ if __name__ == "__main__":
     )
 
     # 7. Initialize trainer
-    trainer_class = AdditionalLossTrackerTrainer if training_args.track_ctc_loss else Seq2SeqTrainer
+    trainer_class = AdditionalLossTrackerTrainer if training_args.track_ctc_loss else DynamicBatchingSeq2SeqTrainer
     trainer = trainer_class(
         args=training_args,
         model=model,
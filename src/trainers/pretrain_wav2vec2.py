@@ -4,7 +4,7 @@ import sys
 from transformers import AutoFeatureExtractor, HfArgumentParser
 from transformers.utils import logging
 
-from utilities.callbacks import GumbelTemperatureCallback, init_callbacks
+from utilities.callbacks import GumbelTemperatureCallback, get_preprocessed_split, init_callbacks
 from utilities.collators import DataCollatorForWav2Vec2Pretraining
 from utilities.data_utils import get_dataset
 from utilities.model_utils import instantiate_speech_encoder_model
@@ -63,6 +63,7 @@ if __name__ == "__main__":
 
     # 4. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
     temperature_callback = GumbelTemperatureCallback(
         training_args.gumbel_temperature_decay,
@@ -1,10 +1,11 @@
 """Main training script for training of CTC ASR models."""
 import sys
 
-from transformers import AutoFeatureExtractor, AutoTokenizer, HfArgumentParser, Trainer
+from transformers import AutoFeatureExtractor, AutoTokenizer, HfArgumentParser
 from transformers.utils import logging
 
-from utilities.callbacks import init_callbacks
+from augmentations.batched_preprocessing import BatchedSpeechPreprocessor
+from utilities.callbacks import get_preprocessed_split, init_callbacks
 from utilities.collators import SpeechCollatorWithPadding
 from utilities.data_utils import get_dataset
 from utilities.eval_utils import compute_metrics_ctc, get_most_likely_tokens
@@ -16,6 +17,7 @@ from utilities.training_arguments import (
     GenerationArguments,
     ModelArguments,
 )
+from utilities.training_utils import DynamicBatchingTrainer
 
 if __name__ == "__main__":
     logging.set_verbosity_debug()
@@ -65,6 +67,7 @@ if __name__ == "__main__":
 
     # 4. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
     # 5. Initialize data collator
     data_collator = SpeechCollatorWithPadding(
@@ -77,15 +80,22 @@ if __name__ == "__main__":
         model_input_name=model.main_input_name,
         mask_unks=training_args.mask_unks,
         pad_to_multiple_of=data_args.pad_to_multiples_of,
+        raw_audio=data_args.batch_preprocessing_config is not None,
     )
 
-    trainer = Trainer(
+    batch_preprocessor = (
+        BatchedSpeechPreprocessor.from_config(data_args.batch_preprocessing_config, feature_extractor)
+        if data_args.batch_preprocessing_config
+        else None
+    )
+    trainer = DynamicBatchingTrainer(
         args=training_args,
         model=model,
         callbacks=callbacks,
         train_dataset=dataset[data_args.train_split],
         eval_dataset=training_eval_dataset,
         data_collator=data_collator,
+        batch_preprocessor=batch_preprocessor,
         preprocess_logits_for_metrics=get_most_likely_tokens,
         compute_metrics=lambda pred: compute_metrics_ctc(tokenizer, pred, gen_args.wandb_predictions_to_save),
     )
@@ -6,13 +6,13 @@ from transformers import (
     AutoModelForCausalLM,
     AutoTokenizer,
     HfArgumentParser,
-    Seq2SeqTrainer,
     WhisperForConditionalGeneration,
 )
 from transformers.utils import logging
 
+from augmentations.batched_preprocessing import BatchedSpeechPreprocessor
 from decoding.config import GenerationConfigCustom
-from utilities.callbacks import init_callbacks
+from utilities.callbacks import get_preprocessed_split, init_callbacks
 from utilities.collators import SpeechCollatorWithPadding
 from utilities.data_utils import get_dataset
 from utilities.eval_utils import compute_metrics
@@ -24,7 +24,10 @@ from utilities.training_arguments import (
     GenerationArguments,
     ModelArguments,
 )
-from utilities.training_utils import AdditionalLossTrackerTrainer
+from utilities.training_utils import (
+    AdditionalLossTrackerTrainer,
+    DynamicBatchingSeq2SeqTrainer,
+)
 
 if __name__ == "__main__":
     logging.set_verbosity_debug()
@@ -86,8 +89,10 @@ if __name__ == "__main__":
         num_beams=gen_args.num_beams,
         ctc_weight=gen_args.decoding_ctc_weight,
         ctc_margin=gen_args.ctc_margin,
+        ctc_pre_beam_size=gen_args.ctc_pre_beam_size,
         lm_weight=gen_args.lm_weight,
         lm_model=AutoModelForCausalLM.from_pretrained(gen_args.lm_model) if gen_args.lm_model else None,
+        lm_use_cache=gen_args.lm_use_cache,
         space_token_id=gen_args.space_token_id,
         apply_eos_space_trick=gen_args.apply_eos_space_trick,
         eos_space_trick_weight=gen_args.eos_space_trick_weight,
@@ -106,6 +111,7 @@ if __name__ == "__main__":
 
     # 5. Initialize callbacks
     callbacks = init_callbacks(data_args, training_args, dataset, feature_extractor)
+    training_eval_dataset = get_preprocessed_split(callbacks, training_eval_dataset)
 
     # 6. Initialize data collator
     data_collator = SpeechCollatorWithPadding(
@@ -118,10 +124,16 @@ if __name__ == "__main__":
         model_input_name=model.main_input_name,
         mask_unks=training_args.mask_unks,
         pad_to_multiple_of=data_args.pad_to_multiples_of,
+        raw_audio=data_args.batch_preprocessing_config is not None,
     )
 
     # 7. Initialize trainer
-    trainer_class = AdditionalLossTrackerTrainer if training_args.track_ctc_loss else Seq2SeqTrainer
+    trainer_class = AdditionalLossTrackerTrainer if training_args.track_ctc_loss else DynamicBatchingSeq2SeqTrainer
+    batch_preprocessor = (
+        BatchedSpeechPreprocessor.from_config(data_args.batch_preprocessing_config, feature_extractor)
+        if data_args.batch_preprocessing_config
+        else None
+    )
     trainer = trainer_class(
         args=training_args,
         model=model,
@@ -129,6 +141,7 @@ if __name__ == "__main__":
         train_dataset=dataset[data_args.train_split],
         eval_dataset=training_eval_dataset,
         data_collator=data_collator,
+        batch_preprocessor=batch_preprocessor,
         compute_metrics=lambda pred: compute_metrics(tokenizer, pred, gen_args.wandb_predictions_to_save),
     )
 
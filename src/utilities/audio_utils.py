@@ -0,0 +1,50 @@
+"""Resampling of waveforms with kernels cached per sampling rate pair, shared by the dataset builders."""
+import math
+from functools import lru_cache
+from typing import List, Sequence, TypeVar, Union
+
+import numpy as np
+import torch
+import torchaudio
+
+Waveform = TypeVar("Waveform", np.ndarray, torch.Tensor)
+
+# windowed sinc interpolation of a quality comparable to the librosa "kaiser_best" resampling
+KAISER_BEST = {
+    "resampling_method": "sinc_interp_kaiser",
+    "lowpass_filter_width": 64,
+    "rolloff": 0.9475937167399596,
+    "beta": 14.769656459379492,
+}
+
+
+@lru_cache(maxsize=16)
+def get_resampler(orig_sr: int, target_sr: int, device: Union[str, torch.device] = "cpu") -> torch.nn.Module:
+    """Resampling module of the sampling rate pair, its kernel is computed once and reused for all the recordings."""
+    return torchaudio.transforms.Resample(orig_sr, target_sr, dtype=torch.float32, **KAISER_BEST).to(device)
+
+
+@torch.no_grad()
+def resample(waveform: Waveform, orig_sr: int, target_sr: int, device: Union[str, torch.device] = "cpu") -> Waveform:
+    """Resamples a (..., Time) waveform, numpy inputs are returned as float32 numpy arrays on the CPU."""
+    if orig_sr == target_sr:
+        return waveform
+    is_numpy = isinstance(waveform, np.ndarray)
+    tensor = torch.from_numpy(np.asarray(waveform, dtype=np.float32)) if is_numpy else waveform.float()
+    resampled = get_resampler(orig_sr, target_sr, device)(tensor.to(device))
+    return resampled.cpu().numpy() if is_numpy else resampled
+
+
+def resample_batch(
+    waveforms: Sequence[np.ndarray], orig_sr: int, target_sr: int, device: Union[str, torch.device] = "cpu"
+) -> List[np.ndarray]:
+    """Resamples 1D waveforms of different lengths in a single call, the zero padding of the shorter waveforms does not
+    change their resampled samples as the kernel pads the waveforms with zeros anyway."""
+    if orig_sr == target_sr or len(waveforms) == 0:
+        return list(waveforms)
+    lengths = [len(waveform) for waveform in waveforms]
+    padded = np.zeros((len(waveforms), max(lengths)), dtype=np.float32)
+    for index, waveform in enumerate(waveforms):
+        padded[index, : lengths[index]] = waveform
+    resampled = resample(padded, orig_sr, target_sr, device)
+    return [resampled[index, : math.ceil(length * target_sr / orig_sr)] for index, length in enumerate(lengths)]
@@ -9,7 +9,7 @@ import numpy as np
 import sys
 import torch
 import torch.multiprocessing as mp
-from datasets import DatasetDict
+from datasets import Dataset, DatasetDict
 from transformers import (
     EarlyStoppingCallback,
     SequenceFeatureExtractor,
@@ -20,7 +20,7 @@ from transformers import (
 )
 from transformers.utils import logging
 
-from utilities.data_utils import audio_object_stripper
+from utilities.data_utils import audio_object_stripper, distributed_process
 from utilities.general_utils import (
     FunctionReturnWrapper,
     resolve_attribute_from_nested_class,
@@ -130,6 +130,18 @@ class DelayedStartWrapper:
         return args[0]
 
 
+def extract_features_batched(
+    audios: List, transforms: List[Tuple[FunctionReturnWrapper, Dict]], audio_column: str
+) -> Dict[str, List[np.ndarray]]:
+    """Applies deterministic preprocessing transforms to a batch of audios."""
+    return {
+        audio_column: [
+            DataPreprocessingManagerCallback.transformer(audio_object_stripper(audio), transforms).numpy()
+            for audio in audios
+        ]
+    }
+
+
 class DataPreprocessingManagerCallback(TrainerCallback):
     def __init__(
         self,
@@ -137,11 +149,24 @@ class DataPreprocessingManagerCallback(TrainerCallback):
         dataset: DatasetDict,
         audio_column_name: str,
         feature_extractor: SequenceFeatureExtractor,
+        precompute_features: bool = False,
+        preprocessing_num_workers: int = 1,
+        writer_batch_size: int = 500,
     ):
         super().__init__()
         self.dataset = dataset
         self.audio_column_name = audio_column_name
+        self.precompute_features = precompute_features
+        self.preprocessing_num_workers = preprocessing_num_workers
+        self.writer_batch_size = writer_batch_size
+        self.precomputed_splits = set()
+        # splits as they were before the features were precomputed, see `get_preprocessed_split`
+        self.original_splits = {}
         self.transforms = {split: [] for split in preprocessing_config.keys()}
+        self.num_deterministic_transforms = {
+            split: self.count_deterministic_transforms(config_list)
+            for split, config_list in preprocessing_config.items()
+        }
         for split, config_list in preprocessing_config.items():
             for config in config_list:
                 if config["name"] == "feature_extractor":
@@ -161,6 +186,18 @@ class DataPreprocessingManagerCallback(TrainerCallback):
                     )
                 )
 
+    @staticmethod
+    def count_deterministic_transforms(config_list: List[Dict]) -> int:
+        """Number of leading transforms that are active from the start and do not change between epochs,
+        the feature extractor is deterministic, other transforms have to be marked by `"deterministic": true`."""
+        count = 0
+        for config in config_list:
+            is_deterministic = config["name"] == "feature_extractor" or config.get("deterministic", False)
+            if not is_deterministic or config["steps_before_activation"] > 0:
+                break
+            count += 1
+        return count
+
     @staticmethod
     def transformer(audio: Union[np.ndarray, torch.Tensor], transforms: List[Tuple[DelayedStartWrapper, Dict]]):
         if not isinstance(audio, torch.Tensor):
@@ -172,7 +209,10 @@ class DataPreprocessingManagerCallback(TrainerCallback):
     def default_transform(self, batch, transform_key):
         return {
             self.audio_column_name: [
-                self.transformer(audio_object_stripper(audio), self.transforms[transform_key])
+                self.transformer(
+                    audio if transform_key in self.precomputed_splits else audio_object_stripper(audio),
+                    self.transforms[transform_key],
+                )
                 for audio in batch[self.audio_column_name]
             ]
         }
@@ -182,9 +222,48 @@ class DataPreprocessingManagerCallback(TrainerCallback):
             for transform in split_transforms:
                 transform[0].new_step(state.global_step)
 
+    def precompute_splits(self):
+        """Precomputes features of all the splits with leading deterministic transforms, it has to be called before
+        the trainer is built, as the splits of `self.dataset` are replaced by the precomputed ones."""
+        if not self.precompute_features:
+            return
+        for split in self.dataset.keys():
+            transform_key = "default_preprocessing" if split not in self.transforms else split
+            if self.num_deterministic_transforms[transform_key] > 0:
+                self.precompute_split_features(split, transform_key)
+
+    def precompute_split_features(self, split: str, transform_key: str):
+        """Stores outputs of the deterministic transforms in a new dataset split, so they are computed only once.
+        Remaining transforms are kept and applied on the fly to the precomputed features.
+        """
+        num_deterministic = self.num_deterministic_transforms[transform_key]
+        transforms = [(wrapper.callback, fn_call_params) for wrapper, fn_call_params in self.transforms[transform_key]]
+        precomputed = distributed_process(
+            self.dataset[split],
+            process_by="map",
+            function=extract_features_batched,
+            input_columns=[self.audio_column_name],
+            batched=True,
+            batch_size=max(1, self.writer_batch_size // 4),
+            writer_batch_size=self.writer_batch_size,
+            num_proc=self.preprocessing_num_workers,
+            fn_kwargs={"transforms": transforms[:num_deterministic], "audio_column": self.audio_column_name},
+            desc=f"Precomputing features of {split} split",
+        )
+        self.original_splits[split] = self.dataset[split]
+        self.dataset[split] = precomputed
+        self.transforms[split] = self.transforms[transform_key][num_deterministic:]
+        self.precomputed_splits.add(split)
+
     def on_init_end(self, args: TrainingArguments, state: TrainerState, control: TrainerControl, **kwargs):
         for split in self.dataset.keys():
             transform_key = "default_preprocessing" if split not in self.transforms else split
+            if split in self.precomputed_splits:
+                transform_key = split
+                if not self.transforms[transform_key]:
+                    # nothing stochastic is left, features are only converted to tensors
+                    self.dataset[split].set_format("torch", columns=[self.audio_column_name], output_all_columns=True)
+                    continue
             self.dataset[split].set_transform(
                 partial(self.default_transform, transform_key=transform_key),
                 columns=[self.audio_column_name],
@@ -218,12 +297,24 @@ class AdditionalLossPrinterCallback(TrainerCallback):
             state.additional_logs = []
 
 
+def get_preprocessed_split(callbacks: List[TrainerCallback], split_dataset: Dataset) -> Dataset:
+    """Returns the split with precomputed features for a reference to the split taken before `init_callbacks`."""
+    for callback in callbacks:
+        if isinstance(callback, DataPreprocessingManagerCallback):
+            for split, original_split in callback.original_splits.items():
+                if original_split is split_dataset:
+                    return callback.dataset[split]
+    return split_dataset
+
+
 def init_callbacks(
     data_args: DataTrainingArguments,
     training_args: GeneralTrainingArguments,
     dataset: DatasetDict,
     feature_extractor: SequenceFeatureExtractor,
 ):
+    """Initializes the callbacks, features of the dataset splits are precomputed here with `precompute_splits`,
+    so the splits have to be taken from `dataset` afterwards (or passed through `get_preprocessed_split`)."""
     callbacks = []
     if data_args.data_preprocessing_config:
         with open(data_args.data_preprocessing_config) as config_handle:
@@ -233,6 +324,9 @@ def init_callbacks(
                     dataset=dataset,
                     audio_column_name=data_args.audio_column_name,
                     feature_extractor=feature_extractor,
+                    precompute_features=data_args.precompute_features,
+                    preprocessing_num_workers=data_args.preprocessing_num_workers,
+                    writer_batch_size=data_args.writer_batch_size,
                 )
             )
     else:
@@ -248,14 +342,22 @@ def init_callbacks(
                 "return_behaviour": ["input_features[0]"],
             }
         ]
+        if data_args.batch_preprocessing_config:
+            # raw waveforms are passed to the collator, features are computed on device
+            default_preprocessing = []
         callbacks.append(
             DataPreprocessingManagerCallback(
                 preprocessing_config={"default_preprocessing": default_preprocessing},
                 dataset=dataset,
                 audio_column_name=data_args.audio_column_name,
                 feature_extractor=feature_extractor,
+                precompute_features=data_args.precompute_features,
+                preprocessing_num_workers=data_args.preprocessing_num_workers,
+                writer_batch_size=data_args.writer_batch_size,
             )
         )
+    # features are precomputed before the trainer is built, so that it gets the new splits
+    callbacks[-1].precompute_splits()
     if training_args.early_stopping_patience > -1:
         callbacks.append(EarlyStoppingCallback(early_stopping_patience=training_args.early_stopping_patience))
     if training_args.track_ctc_loss:
@@ -1,4 +1,4 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Union
 from contextlib import contextmanager
 
@@ -6,6 +6,7 @@ import torch
 import json
 import re
 from transformers import (
+    BatchEncoding,
     BatchFeature,
     PreTrainedModel,
     PreTrainedTokenizer,
@@ -18,6 +19,8 @@ from transformers.models.wav2vec2.modeling_wav2vec2 import (
     _sample_negative_indices,
 )
 
+from utilities.context_utils import ConversationTurnTable
+
 
 @dataclass
 class SpeechCollatorWithPadding:
@@ -62,6 +65,14 @@ class SpeechCollatorWithPadding:
     text_path: str = None
     model_input_name: str = True
     mask_unks: bool = False
+    raw_audio: bool = False
+
+    def pad_raw_audio(self, waveforms: List[torch.Tensor]) -> BatchFeature:
+        """Pads raw waveforms and returns the sample level attention mask, features are computed on device later."""
+        lengths = torch.tensor([len(waveform) for waveform in waveforms])
+        padded = torch.nn.utils.rnn.pad_sequence(waveforms, batch_first=True)
+        attention_mask = (torch.arange(padded.shape[1])[None, :] < lengths[:, None]).long()
+        return BatchFeature({self.feature_extractor.model_input_names[0]: padded, "attention_mask": attention_mask})
 
     def __call__(
         self, features: List[Dict[str, Union[List[int], torch.Tensor, Dict[str, BatchFeature]]]]
@@ -85,18 +96,21 @@ class SpeechCollatorWithPadding:
             return_tensors="pt",
         )
 
-        batch = self.feature_extractor.pad(
-            input_features,
-            padding=self.padding,
-            max_length=self.max_length,
-            pad_to_multiple_of=self.pad_to_multiple_of,
-            return_tensors="pt",
-        )
+        if self.raw_audio:
+            batch = self.pad_raw_audio([feature[self.audio_path].squeeze(dim=0) for feature in features])
+        else:
+            batch = self.feature_extractor.pad(
+                input_features,
+                padding=self.padding,
+                max_length=self.max_length,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+                return_tensors="pt",
+            )
 
-        if isinstance(self.feature_extractor, WhisperFeatureExtractor):
-            batch[self.feature_extractor.model_input_names[0]] = batch[
-                self.feature_extractor.model_input_names[0]
-            ].transpose(-2, -1)
+            if isinstance(self.feature_extractor, WhisperFeatureExtractor):
+                batch[self.feature_extractor.model_input_names[0]] = batch[
+                    self.feature_extractor.model_input_names[0]
+                ].transpose(-2, -1)
 
         labels = labels["input_ids"].masked_fill(labels.attention_mask.ne(1), -100)
 
@@ -583,10 +597,14 @@ class GeneralContextCollator:
     prompt_suffix: Optional[str] = None
     max_context: Optional[int] = 5
     context_trunc_to_shortest: Optional[bool] = False
+    turn_table: Optional[ConversationTurnTable] = None # resolves context of examples referencing their conversation
 
     def __call__(
         self, features: List[Dict[str, Union[List[int], torch.Tensor, Dict[str, BatchFeature]]]]
     ) -> BatchFeature:
+        if self.turn_table is not None:
+            features = self.turn_table.resolve(features, self.max_context)
+
         # split inputs and labels since they have to be of different lengths and need
         # different padding methods
         input_features = [
@@ -690,7 +708,10 @@ class GeneralContextCollator:
 
 @dataclass
 class FisherContextCollatorLeftPadding:
-    """ Data collator for the fisher dataset augmented with conversation context. """
+    """ Data collator for the fisher dataset augmented with conversation context.
+
+    Token ids of the context turns and prompts are cached on the collator instance, i.e. in every dataloader worker.
+    Workers are started again every epoch unless `dataloader_persistent_workers` is set, dropping their caches. """
 
     feature_extractor: Union[Wav2Vec2FeatureExtractor, Speech2TextFeatureExtractor]
     tokenizer: Optional[PreTrainedTokenizer] = None
@@ -709,10 +730,71 @@ class FisherContextCollatorLeftPadding:
     mode: Optional[str] = "default" # available modes: default, turns,
     max_context: Optional[int] = 5
     context_trunc_to_shortest: Optional[bool] = False
+    turn_table: Optional[ConversationTurnTable] = None # resolves context of examples referencing their conversation
+    max_context_tokens: Optional[int] = None # token budget of the context turns, the most recent tokens are kept
+    token_cache_size: Optional[int] = 1_000_000 # number of cached turns, the oldest entries are evicted first
+    _token_cache: Dict[str, List[int]] = field(default_factory=dict, init=False, repr=False)
+    _prefix_ids: Dict[str, List[int]] = field(default_factory=dict, init=False, repr=False)
+    _prompt_cache: Dict[str, BatchEncoding] = field(default_factory=dict, init=False, repr=False)
+
+    def encode_turn(self, text: str) -> List[int]:
+        """ Token ids of the text following the context prefix, cached across batches and epochs. The text is encoded
+        after the prefix and the prefix ids are dropped, so the ids match the tokenization of the joined string. """
+        ids = self._token_cache.get(text)
+        if ids is None:
+            if len(self._token_cache) >= self.token_cache_size:
+                self._token_cache.pop(next(iter(self._token_cache)))
+            anchor = self.context_prefix.rstrip()
+            ids = self.tokenizer(anchor + text, add_special_tokens=False)['input_ids'][len(self._prefix_ids['anchor']):]
+            self._token_cache[text] = ids
+        return ids
+
+    def encode_context(self, context_turns: List[List[str]]) -> BatchEncoding:
+        """ Left padded ids of the context prefix followed by the space separated turns, assembled from the cached ids
+        of the individual turns. Only the most recent `max_context_tokens` tokens of the turns are kept. """
+        prefix = self.context_prefix.rstrip()
+        separator = self.context_prefix[len(prefix):]
+        if not self._prefix_ids:
+            # leading special tokens (BOS) are kept, EOS is never added to the context
+            with nadd_eos(self.tokenizer):
+                self._prefix_ids['empty'] = self.tokenizer(self.context_prefix)['input_ids']
+                self._prefix_ids['leading'] = self.tokenizer(prefix)['input_ids']
+            self._prefix_ids['anchor'] = self.tokenizer(prefix, add_special_tokens=False)['input_ids']
+
+        context_ids = []
+        for turns in context_turns:
+            if not turns:
+                context_ids.append(self._prefix_ids['empty'])
+                continue
+            turn_ids = [
+                token for i, turn in enumerate(turns) for token in self.encode_turn((' ' if i else separator) + turn)
+            ]
+            if self.max_context_tokens is not None and len(turn_ids) > self.max_context_tokens:
+                turn_ids = turn_ids[len(turn_ids) - self.max_context_tokens:]
+            context_ids.append(self._prefix_ids['leading'] + turn_ids)
+
+        with left_padding(self.tokenizer):
+            return self.tokenizer.pad(
+                {'input_ids': context_ids},
+                padding="longest",
+                return_attention_mask=True,
+                return_tensors="pt",
+            )
+
+    def encode_prompt(self, prompt: str, batch_size: int) -> BatchEncoding:
+        """ Ids of a constant prompt without special tokens repeated for the batch, the prompt is encoded once. """
+        if prompt not in self._prompt_cache:
+            with nadd_bos(self.tokenizer), nadd_eos(self.tokenizer):
+                self._prompt_cache[prompt] = self.tokenizer(prompt, return_attention_mask=True, return_tensors="pt")
+        encoded = self._prompt_cache[prompt]
+        return BatchEncoding({key: encoded[key].repeat(batch_size, 1) for key in ['input_ids', 'attention_mask']})
 
     def __call__(
         self, features: List[Dict[str, Union[List[int], torch.Tensor, Dict[str, BatchFeature]]]]
     ) -> BatchFeature:
+        if self.turn_table is not None:
+            features = self.turn_table.resolve(features, self.max_context)
+
         # split inputs and labels since they have to be of different lengths and need
         # different padding methods
         input_features = [
@@ -762,21 +844,22 @@ class FisherContextCollatorLeftPadding:
             # NOTE: for now, I'm leaving the 1 here, but it should probably have a better solution..
             max_context = min(min(list(map(lambda x: len(x['context']) if x['context'] else 1, features))), self.max_context)
 
+        # the turns are joined after the context prefix, their token ids are cached
         if self.mode == 'default':
             # the most monstrous list comprehension I've ever written..
-            context_words = []
+            context_turns = []
             for feature in features:
                 # FIXME: context zero lengt
                 if feature['context']:
-                    context_words.append(self.context_prefix + ' '.join([ ' '.join(turn['labels']) for turn in feature['context'][-max_context:]]))
+                    context_turns.append([ ' '.join(turn['labels']) for turn in feature['context'][-max_context:]])
                 else:
-                    context_words.append(self.context_prefix)
+                    context_turns.append([])
 
         elif self.mode == 'turns': # FIXME: zero context kinda makes even less sense in this scenario...
-            context_words = []
+            context_turns = []
             for feature in features:
+                tmp = []
                 if feature['context']:
-                    tmp = []
                     last_spk = None
                     for turn in feature['context'][-max_context:]:
                         for utt, spk in zip(turn['labels'], turn['speakers']): 
@@ -786,41 +869,21 @@ class FisherContextCollatorLeftPadding:
                                 last_spk = spk
                                 tmp.append(spk + ': ' + utt.strip())
 
-                    context_words.append(self.context_prefix + ' '.join(tmp))
-                else:
-                    context_words.append(self.context_prefix)
+                context_turns.append(tmp)
 
-        with left_padding(self.tokenizer), nadd_eos(self.tokenizer):
-            context = self.tokenizer.batch_encode_plus(
-                context_words,
-                return_attention_mask=True,
-                padding="longest",
-                return_tensors="pt",
-            )
+        context = self.encode_context(context_turns)
 
         # 3) Tokenize the embedding prefix
         if self.prompt_prefix not in [None, '']:
-            with nadd_bos(self.tokenizer), nadd_eos(self.tokenizer):
-                prompt_prefix_ids = self.tokenizer.batch_encode_plus(
-                    [self.prompt_prefix for _ in features],
-                    return_attention_mask=True,
-                    padding="longest",
-                    return_tensors="pt",
-                )
+            prompt_prefix_ids = self.encode_prompt(self.prompt_prefix, len(features))
         else:
             prompt_prefix_ids = None
 
         # 3) Tokenize the embedding suffix
         if self.prompt_suffix not in [None, '']:
-            with nadd_eos(self.tokenizer), nadd_bos(self.tokenizer):
-                #if self.mode == 'turns': FIXME: so, the initial speaker tag should probably be
-                # added to the suffix..
-                prompt_suffix_ids = self.tokenizer.batch_encode_plus(
-                    [self.prompt_suffix for _ in features],
-                    return_attention_mask=True,
-                    padding="longest",
-                    return_tensors="pt",
-                )
+            #if self.mode == 'turns': FIXME: so, the initial speaker tag should probably be
+            # added to the suffix..
+            prompt_suffix_ids = self.encode_prompt(self.prompt_suffix, len(features))
         else:
             prompt_suffix_ids = None
 
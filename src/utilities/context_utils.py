@@ -0,0 +1,110 @@
+"""Conversation history stored by reference: examples carry only their conversation id and turn position, the text of
+the previous turns is looked up in a per-conversation turn table when a batch is collated."""
+from typing import Any, Dict, List, Optional, Union
+
+import numpy as np
+from datasets import ClassLabel, Dataset, DatasetDict, concatenate_datasets, load_from_disk
+from transformers.utils import logging
+
+logger = logging.get_logger("transformers")
+
+CONVERSATION_ID_COLUMN = "conversation_id"
+CONVERSATION_TURN_COLUMN = "conversation_turn"
+CONTEXT_REFERENCE_COLUMNS = [CONVERSATION_ID_COLUMN, CONVERSATION_TURN_COLUMN]
+
+
+class ConversationTurnTable:
+    """Turns of all the conversations, one row per turn ordered by conversation and turn position.
+
+    Rows hold `conversation_id`, `conversation_turn` and the text columns of the turn (`labels`, `speakers`, ...),
+    contexts are returned in the format of the inline `context` column, i.e. a list of turn dicts.
+    """
+
+    def __init__(self, turns: Dataset):
+        turns = turns.with_format(None).sort(CONTEXT_REFERENCE_COLUMNS)
+        meta = turns.select_columns(CONTEXT_REFERENCE_COLUMNS).to_pandas()
+        conversation_ids = meta[CONVERSATION_ID_COLUMN].to_numpy()
+        turn_positions = meta[CONVERSATION_TURN_COLUMN].to_numpy()
+        is_start = np.r_[True, conversation_ids[1:] != conversation_ids[:-1]]
+        if np.any(~is_start[1:] & (turn_positions[1:] == turn_positions[:-1])):
+            raise ValueError("Conversation turns are not unique, conversation ids must not repeat across the splits.")
+        starts = np.flatnonzero(is_start)
+        ends = np.r_[starts[1:], len(conversation_ids)]
+        self.bounds = {conversation_ids[start]: (start, end) for start, end in zip(starts, ends)}
+        self.turn_positions = turn_positions
+        self.turns = turns.remove_columns(CONTEXT_REFERENCE_COLUMNS)
+
+    @classmethod
+    def from_disk(cls, path: str) -> "ConversationTurnTable":
+        """Loads a table saved by `save_to_disk`, splits of a `DatasetDict` are merged into a single table."""
+        turns = load_from_disk(path, keep_in_memory=False)
+        if isinstance(turns, DatasetDict):
+            turns = concatenate_datasets(list(turns.values()))
+        logger.info(f"Loaded conversation turn table with {len(turns)} turns from {path}")
+        return cls(turns)
+
+    def __len__(self) -> int:
+        return len(self.turns)
+
+    def get_context(
+        self, conversation_id: str, conversation_turn: int, max_context: Optional[int] = None
+    ) -> List[Dict[str, Any]]:
+        """Returns up to `max_context` turns of the conversation preceding `conversation_turn`."""
+        if conversation_id not in self.bounds:
+            return []
+        start, end = self.bounds[conversation_id]
+        position = start + int(np.searchsorted(self.turn_positions[start:end], conversation_turn))
+        if max_context is not None:
+            start = max(start, position - max_context)
+        if position <= start:
+            return []
+        columns = self.turns[start:position]
+        return [dict(zip(columns, values)) for values in zip(*columns.values())]
+
+    def resolve(self, features: List[Dict[str, Any]], max_context: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Fills the `context` of the features referencing their conversation, other features are kept as they are."""
+        for feature in features:
+            if feature.get(CONVERSATION_ID_COLUMN) is not None:
+                feature["context"] = self.get_context(
+                    feature[CONVERSATION_ID_COLUMN], feature[CONVERSATION_TURN_COLUMN], max_context
+                )
+        return features
+
+
+def labels_to_turn(batch: Dict[str, List], label_column: str, speaker_column: Optional[str], speaker_names=None):
+    labels = [label if isinstance(label, list) else [label] for label in batch[label_column]]
+    if speaker_column is None:
+        speakers = [[] for _ in labels]
+    else:
+        if speaker_names is not None:
+            speakers = [[speaker_names[speaker]] for speaker in batch[speaker_column]]
+        else:
+            speakers = [speaker if isinstance(speaker, list) else [speaker] for speaker in batch[speaker_column]]
+    return {"labels": labels, "speakers": speakers}
+
+
+def build_turn_table(
+    dataset: Union[Dataset, DatasetDict],
+    conversation_column: str,
+    turn_column: str,
+    label_column: str,
+    speaker_column: Optional[str] = None,
+    num_proc: Optional[int] = None,
+) -> Dataset:
+    """Builds the turn table of a dataset whose examples are single conversation turns, so it is done before any
+    filtering. Labels and speakers are stored as lists of strings, the same as in the fisher context turns."""
+    if isinstance(dataset, DatasetDict):
+        dataset = concatenate_datasets(list(dataset.values()))
+    speaker_feature = dataset.features.get(speaker_column) if speaker_column is not None else None
+    speaker_names = speaker_feature.names if isinstance(speaker_feature, ClassLabel) else None
+    columns = [conversation_column, turn_column, label_column] + ([speaker_column] if speaker_column else [])
+    turns = dataset.select_columns(columns).map(
+        labels_to_turn,
+        batched=True,
+        fn_kwargs={"label_column": label_column, "speaker_column": speaker_column, "speaker_names": speaker_names},
+        remove_columns=[column for column in columns[2:] if column not in ["labels", "speakers"]],
+        num_proc=num_proc,
+        desc="Building conversation turn table",
+    )
+    renames = {conversation_column: CONVERSATION_ID_COLUMN, turn_column: CONVERSATION_TURN_COLUMN}
+    return turns.rename_columns({column: name for column, name in renames.items() if column != name})
@@ -3,6 +3,8 @@ import json
 import os
 import re
 import string
+from functools import lru_cache
+from itertools import groupby
 from typing import Dict, List, Optional, Tuple, Union
 
 import numpy as np
@@ -16,8 +18,10 @@ from datasets import (
     load_dataset,
     load_from_disk,
 )
+from datasets.fingerprint import Hasher
 from transformers.utils import logging
 
+from utilities.context_utils import CONTEXT_REFERENCE_COLUMNS, ConversationTurnTable
 from utilities.english_normalizer import EnglishNormalizer
 
 logger = logging.get_logger("transformers")
@@ -147,6 +151,51 @@ def fix_tedlium_apostrophes(example: str, label_column: str) -> Dict[str, str]:
     return {label_column: example.replace(r"\s+ '", r" '")}
 
 
+def apply_text_transformations(batch: List[str], transformations: List[str], label_column: str) -> Dict[str, List[str]]:
+    """Applies map transformations one after another to each label of the batch."""
+    functions = [globals()[transformation_name] for transformation_name in transformations]
+    labels = []
+    for label in batch:
+        for function in functions:
+            label = function(label, label_column)[label_column]
+        labels.append(label)
+    return {label_column: labels}
+
+
+def filter_by_text_transformations(batch: List[str], transformations: List[str]) -> List[bool]:
+    """Keeps labels passing all the filter transformations."""
+    functions = [globals()[transformation_name] for transformation_name in transformations]
+    return [all(function(label) for function in functions) for label in batch]
+
+
+def map_text_column(dataset: Dataset, text_column_name: str, **kwargs) -> Dataset:
+    """Maps only the text column, the other columns are joined back to it without being rewritten to the cache.
+
+    Joining datasets with an indices mapping (from a shuffle or filter) would flatten all their columns, so the text of
+    the whole underlying table is mapped and the indices mapping is attached to the joined table afterwards."""
+    column_names = dataset.column_names
+    table = Dataset(
+        dataset.data,
+        info=dataset.info.copy(),
+        split=dataset.split,
+        fingerprint=Hasher.hash([dataset._fingerprint, "without_indices"]),
+    )
+    texts = distributed_process(
+        table.select_columns([text_column_name]), process_by="map", input_columns=[text_column_name], **kwargs
+    )
+    mapped = concatenate_datasets([table.remove_columns(text_column_name), texts], axis=1)
+    mapped = mapped.select_columns(column_names)
+    if dataset._indices is None:
+        return mapped
+    return Dataset(
+        mapped.data,
+        info=mapped.info,
+        split=mapped.split,
+        indices_table=dataset._indices,
+        fingerprint=Hasher.hash([mapped._fingerprint, dataset._fingerprint]),
+    )
+
+
 def filter_empty_transcriptions(example: str) -> bool:
     """Filters out empty transcriptions."""
     return example != ""
@@ -176,8 +225,22 @@ Audio manipulation functions.
 """
 
 
+@lru_cache(maxsize=128)
+def open_pcm_shard(path: str) -> np.memmap:
+    """Memory maps int16 PCM shard, maps are reused by the dataloader worker."""
+    return np.memmap(path, dtype="<i2", mode="r")
+
+
+def load_pcm_segment(audio: Dict) -> np.ndarray:
+    """Zero-copy int16 view of the segment referenced by (shard, offset, length)."""
+    return open_pcm_shard(audio["shard"])[audio["offset"] : audio["offset"] + audio["length"]]
+
+
 def audio_object_stripper(audio: Union[Dict, np.ndarray, List[float]], key="array"):
     """Strips audio object to numpy array."""
+    if isinstance(audio, dict) and "shard" in audio:
+        # int16 samples are trimmed before the conversion to float to copy only the trimmed segment
+        return np.trim_zeros(load_pcm_segment(audio)).astype(np.float32) / 32768
     audio_array = audio[key] if isinstance(audio, dict) and key in audio else audio
     trimmed = np.trim_zeros(audio_array)
     return trimmed
@@ -195,8 +258,9 @@ def split_long_segments_to_chunks_fun(
     chunks = []
     lens_new = []
     for index, example_len in enumerate(lens):
-        for i in range(0, len(audios[index]["array"]), int(max_input_len * sampling_rate)):
-            new_chunk = audio_object_stripper(audios[index])[i : i + int(max_input_len * sampling_rate)]
+        audio = audio_object_stripper(audios[index])
+        for i in range(0, len(audio), int(max_input_len * sampling_rate)):
+            new_chunk = audio[i : i + int(max_input_len * sampling_rate)]
             chunks.append(audio_encoder.encode_example({"array": new_chunk, "sampling_rate": sampling_rate}))
             lens_new.append(len(new_chunk) / sampling_rate)
     return {audio_column: chunks, length_column_name: lens_new}
@@ -328,40 +392,41 @@ def prepare_dataset(
                 desc="Filter samples that the model is not able to process due to the conv subsampling.",
             )
 
-    # 2. Preprocess label columns
+    # 2. Preprocess label columns, consecutive maps (or filters) are fused into a single pass over the text column
     if text_column_name is not None and text_transformations is not None:
-        for transformation_name in text_transformations:
-            if transformation_name.startswith("filter_"):
-                process_by = "filter"
-                fn_kwargs = {}
-            else:
-                process_by = "map"
-                fn_kwargs = {"label_column": text_column_name}
-            if transformation_name.endswith("_train"):
-                if train_split is not None:
-                    transformation = globals()[re.sub("_train", "", transformation_name)]
-                    dataset[train_split] = distributed_process(
-                        dataset[train_split],
-                        process_by=process_by,
-                        function=transformation,
+        for split in list(dataset.keys()):
+            split_transformations = [
+                re.sub("_train", "", transformation_name)
+                for transformation_name in text_transformations
+                if not transformation_name.endswith("_train") or split == train_split
+            ]
+            for process_by, transformations in groupby(
+                split_transformations, key=lambda name: "filter" if name.startswith("filter_") else "map"
+            ):
+                transformations = list(transformations)
+                if process_by == "filter":
+                    dataset[split] = distributed_process(
+                        dataset[split],
+                        process_by="filter",
+                        function=filter_by_text_transformations,
                         input_columns=[text_column_name],
+                        batched=True,
                         num_proc=preprocessing_num_workers,
                         writer_batch_size=writer_batch_size,
-                        fn_kwargs=fn_kwargs,
-                        desc=f"Applying {transformation_name} transformation",
+                        fn_kwargs={"transformations": transformations},
+                        desc=f"Applying {', '.join(transformations)} transformations to {split}",
+                    )
+                else:
+                    dataset[split] = map_text_column(
+                        dataset[split],
+                        text_column_name,
+                        function=apply_text_transformations,
+                        batched=True,
+                        num_proc=preprocessing_num_workers,
+                        writer_batch_size=writer_batch_size,
+                        fn_kwargs={"transformations": transformations, "label_column": text_column_name},
+                        desc=f"Applying {', '.join(transformations)} transformations to {split}",
                     )
-            else:
-                transformation = globals()[transformation_name]
-                dataset = distributed_process(
-                    dataset,
-                    process_by=process_by,
-                    function=transformation,
-                    input_columns=[text_column_name],
-                    num_proc=preprocessing_num_workers,
-                    writer_batch_size=writer_batch_size,
-                    fn_kwargs=fn_kwargs,
-                    desc=f"Applying {transformation_name} transformation",
-                )
 
     do_not_cast = True
     if not skip_audio_processing and not do_not_cast:
@@ -397,6 +462,22 @@ def merge_splits(dataset: DatasetDict, splits_to_merge: List[str], new_name: str
     return dataset
 
 
+def is_pcm_audio_feature(feature) -> bool:
+    """Whether the column holds references to the PCM shards of the kaldi builder (`audio_storage="pcm_memmap"`)."""
+    return isinstance(feature, dict) and "shard" in feature
+
+
+def concatenate_splits(split1: Dataset, split2: Dataset, split_name: str, local_dataset_prefix: str) -> Dataset:
+    for column in set(split1.column_names).intersection(split2.column_names):
+        if is_pcm_audio_feature(split1.features[column]) != is_pcm_audio_feature(split2.features[column]):
+            raise ValueError(
+                f"Column {column} of {local_dataset_prefix} {split_name} split cannot be concatenated with the other "
+                "datasets, audio stored as PCM shard references (`audio_storage=pcm_memmap`) cannot be mixed with "
+                "`Audio` columns. Build all the merged datasets with the same audio storage."
+            )
+    return concatenate_datasets([split1, split2])
+
+
 def join_datasets(
     dataset1: DatasetDict,
     dataset2: DatasetDict,
@@ -405,15 +486,19 @@ def join_datasets(
     train_split: str,
     validation_split: str,
 ) -> DatasetDict:
-    """Add local datasets to the global dataset."""
+    """Add local datasets to the global dataset, audio columns of the concatenated splits must have the same storage."""
     if train_split is not None:
         if train_split in dataset1:
-            dataset1[train_split] = concatenate_datasets([dataset1[train_split], dataset2[train_split]])
+            dataset1[train_split] = concatenate_splits(
+                dataset1[train_split], dataset2[train_split], train_split, local_dataset_prefix
+            )
         else:
             dataset1[train_split] = dataset2[train_split]
     if validation_split is not None:
         if validation_split in dataset1:
-            dataset1[validation_split] = concatenate_datasets([dataset1[validation_split], dataset2[validation_split]])
+            dataset1[validation_split] = concatenate_splits(
+                dataset1[validation_split], dataset2[validation_split], validation_split, local_dataset_prefix
+            )
         else:
             dataset1[validation_split] = dataset2[validation_split]
     for split in test_splits:
@@ -438,7 +523,10 @@ def load_multiple_datasets(
     add_context_column: bool = True,
     flatten_fisher: bool = False,
 ) -> DatasetDict:
-    """Loads multiple datasets, preprocess them and join to single dataset instance."""
+    """Loads multiple datasets, preprocess them and join to single dataset instance.
+
+    Train and validation splits of the datasets are concatenated, so kaldi datasets built with
+    `audio_storage="pcm_memmap"` can be merged only with each other, not with datasets of `Audio` columns."""
     with open(config_path) as config_handle:
         config_dict = json.load(config_handle)
     dataset_merged = DatasetDict()
@@ -524,13 +612,17 @@ def load_multiple_datasets(
                         set()
                         .union(*dataset_processed.column_names.values())
                         .difference([global_len_column, global_text_column, global_audio_column, 'context'])
+                        .difference(CONTEXT_REFERENCE_COLUMNS)
                     )
                 )
 
-                # Add an empty context column if necessary so that it is possible to merge datasets
+                # Add empty context columns if necessary so that it is possible to merge datasets
                 for split in dataset_local.keys():
-                    if not 'context' in dataset_local[split].column_names:
-                        dataset_local[split] = dataset_local[split].add_column('context', [None] * len(dataset_local[split]))
+                    for column in ['context'] + CONTEXT_REFERENCE_COLUMNS:
+                        if not column in dataset_local[split].column_names:
+                            dataset_local[split] = dataset_local[split].add_column(
+                                column, [None] * len(dataset_local[split])
+                            )
 
             else:
                 dataset_local = dataset_processed.remove_columns(
@@ -705,3 +797,45 @@ def extract_num_samples(dataset: Dataset, data_slice: str) -> int:
         else:
             raise ValueError(f"Invalid slice value: {data_slice}, must be number or percentage")
     return data_slice
+
+
+def estimate_decoder_lengths(
+    dataset: Dataset,
+    tokenizer,
+    text_column: str,
+    connector_lengths: List[int],
+    max_context: Optional[int] = None,
+    prompts: Optional[List[str]] = None,
+    batch_size: int = 1000,
+    turn_table: Optional[ConversationTurnTable] = None,
+) -> List[int]:
+    """Estimates the decoder sequence length of each example for the encoder-connector-LM models, i.e. the number of
+    context (last `max_context` turns of the `context` column, or of the `turn_table` for examples referencing their
+    conversation), prompt and label tokens plus the connector outputs."""
+    prompt_length = sum(len(ids) for ids in tokenizer([prompt for prompt in prompts or [] if prompt])["input_ids"])
+    has_references = turn_table is not None and set(CONTEXT_REFERENCE_COLUMNS).issubset(dataset.column_names)
+    has_context = ("context" in dataset.column_names or has_references) and max_context != 0
+    # only the text columns are read, slicing the whole dataset would decode the audio of every example
+    text_columns = [text_column]
+    if has_context:
+        text_columns += [column for column in ["context"] + CONTEXT_REFERENCE_COLUMNS if column in dataset.column_names]
+    dataset = dataset.select_columns(text_columns)
+    lengths = []
+    for start in range(0, len(dataset), batch_size):
+        batch = dataset[start : start + batch_size]
+        texts = [" ".join(text) if isinstance(text, list) else text for text in batch[text_column]]
+        if has_context:
+            contexts = batch.get("context", [None] * len(texts))
+            if has_references:
+                references = zip(*(batch[column] for column in CONTEXT_REFERENCE_COLUMNS))
+                contexts = [
+                    context if conversation_id is None else turn_table.get_context(conversation_id, turn, max_context)
+                    for (conversation_id, turn), context in zip(references, contexts)
+                ]
+            # turns are joined the same way as by the context collators
+            texts = [
+                text + " " + " ".join(" ".join(turn["labels"]) for turn in (context or [])[-max_context:])
+                for text, context in zip(texts, contexts)
+            ]
+        lengths.extend(len(ids) + prompt_length for ids in tokenizer(texts)["input_ids"])
+    return [length + connector_length for length, connector_length in zip(lengths, connector_lengths)]
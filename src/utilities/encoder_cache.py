@@ -0,0 +1,201 @@
+"""Precomputed outputs of frozen speech encoders for connector training."""
+import hashlib
+import json
+import os
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from datasets import Dataset
+from torch.utils.data import DataLoader
+from transformers.utils import logging
+
+logger = logging.get_logger("transformers")
+
+ENCODER_CACHE_INDEX_COLUMN = "encoder_cache_index"
+
+
+class EncoderOutputsCache:
+    """Memory-mapped store of per-example encoder outputs, frames of all the examples are concatenated in a single
+    (N_frames, D) array and `offsets` delimit the examples."""
+
+    FEATURES_FILE = "features.bin"
+    OFFSETS_FILE = "offsets.npy"
+    META_FILE = "meta.json"
+
+    def __init__(self, cache_dir: str):
+        with open(os.path.join(cache_dir, self.META_FILE)) as meta_handle:
+            meta = json.load(meta_handle)
+        self.offsets = np.load(os.path.join(cache_dir, self.OFFSETS_FILE))
+        self.features = np.memmap(
+            os.path.join(cache_dir, self.FEATURES_FILE),
+            dtype=meta["dtype"],
+            mode="r",
+            shape=(int(self.offsets[-1]), meta["hidden_size"]),
+        )
+
+    @classmethod
+    def exists(cls, cache_dir: str) -> bool:
+        return os.path.exists(os.path.join(cache_dir, cls.META_FILE))
+
+    @classmethod
+    def read_fingerprint(cls, cache_dir: str) -> Optional[Dict[str, Any]]:
+        with open(os.path.join(cache_dir, cls.META_FILE)) as meta_handle:
+            return json.load(meta_handle).get("fingerprint")
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> np.ndarray:
+        return self.features[self.offsets[index] : self.offsets[index + 1]]
+
+
+def encoder_cache_fingerprint(model, dataset: Dataset, data_collator, fp16: bool) -> Dict[str, Any]:
+    """Identifies everything the cached outputs depend on. The connector is applied on top of the cached outputs, so it
+    is not a part of the fingerprint."""
+    encoder_hash = hashlib.sha1()
+    for name, tensor in model.encoder.state_dict().items():
+        encoder_hash.update(name.encode())
+        encoder_hash.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+    feature_extractor = getattr(data_collator, "feature_extractor", None)
+    return {
+        # pylint: disable=protected-access
+        "dataset": dataset._fingerprint,
+        "encoder": model.encoder.config._name_or_path,
+        "encoder_state": encoder_hash.hexdigest(),
+        "feature_extractor": (
+            hashlib.sha1(feature_extractor.to_json_string().encode()).hexdigest()
+            if feature_extractor is not None
+            else None
+        ),
+        "hidden_size": getattr(model.encoder.config, "hidden_size", None),
+        "dtype": np.dtype(np.float16 if fp16 else np.float32).name,
+    }
+
+
+@torch.no_grad()
+def precompute_encoder_outputs(
+    model,
+    dataset: Dataset,
+    data_collator,
+    cache_dir: str,
+    batch_size: int = 8,
+    num_workers: int = 0,
+    fp16: bool = True,
+) -> EncoderOutputsCache:
+    """Runs the frozen encoder of `SpeechEncoderConnectorLMDecoder` once over the dataset and stores the encoder outputs
+    of the non-padded frames. Audio augmentations of the dataset transform are frozen into the cache.
+
+    An existing cache is reused only if it was computed for the same dataset, encoder weights and feature extraction,
+    otherwise it is recomputed."""
+    fingerprint = encoder_cache_fingerprint(model, dataset, data_collator, fp16)
+    if EncoderOutputsCache.exists(cache_dir):
+        if EncoderOutputsCache.read_fingerprint(cache_dir) == fingerprint:
+            logger.info(f"Loading precomputed encoder outputs from {cache_dir}")
+            return EncoderOutputsCache(cache_dir)
+        logger.warning(
+            f"Encoder outputs in {cache_dir} were computed for a different dataset, encoder or feature extraction, "
+            "recomputing them."
+        )
+        # the cache is incomplete until the new meta is written
+        os.remove(os.path.join(cache_dir, EncoderOutputsCache.META_FILE))
+
+    os.makedirs(cache_dir, exist_ok=True)
+    dtype = np.float16 if fp16 else np.float32
+    dataloader = DataLoader(dataset, batch_size=batch_size, collate_fn=data_collator, num_workers=num_workers)
+    offsets = [0]
+    hidden_size = None
+    model.eval()
+    with open(os.path.join(cache_dir, EncoderOutputsCache.FEATURES_FILE), "wb") as features_handle:
+        for batch in dataloader:
+            input_features = batch[model.main_input_name].to(model.device, dtype=model.encoder.dtype)
+            attention_mask = batch.get("attention_mask")
+            if attention_mask is not None:
+                attention_mask = attention_mask.to(model.device)
+            encoder_outputs, audio_attention_mask = model.encode_audio(input_features, attention_mask)
+            audio_embeds = encoder_outputs.last_hidden_state.float().cpu().numpy().astype(dtype)
+            hidden_size = audio_embeds.shape[-1]
+            if audio_attention_mask is None:
+                lengths = [audio_embeds.shape[1]] * audio_embeds.shape[0]
+            else:
+                lengths = audio_attention_mask.sum(dim=-1).tolist()
+            for example_embeds, length in zip(audio_embeds, lengths):
+                features_handle.write(np.ascontiguousarray(example_embeds[:length]).tobytes())
+                offsets.append(offsets[-1] + length)
+
+    np.save(os.path.join(cache_dir, EncoderOutputsCache.OFFSETS_FILE), np.array(offsets, dtype=np.int64))
+    # meta is written last, it marks the cache as complete
+    with open(os.path.join(cache_dir, EncoderOutputsCache.META_FILE), "w") as meta_handle:
+        json.dump({"dtype": np.dtype(dtype).name, "hidden_size": hidden_size, "fingerprint": fingerprint}, meta_handle)
+    logger.info(f"Stored encoder outputs of {len(offsets) - 1} examples to {cache_dir}")
+    return EncoderOutputsCache(cache_dir)
+
+
+def with_encoder_cache_index(dataset: Dataset, audio_column: str) -> Dataset:
+    """Drops the audio and its transform from the dataset, examples are linked to the cache by their position."""
+    dataset = dataset.with_format(None).remove_columns([audio_column])
+    return dataset.add_column(ENCODER_CACHE_INDEX_COLUMN, list(range(len(dataset))))
+
+
+class CachedEncoderOutputsCollator:
+    """Wraps a collator of the encoder-connector-LM models to feed the cached encoder outputs instead of the audio.
+
+    The wrapped collator receives a short silent dummy input, its padded audio features are replaced
+    by `encoder_hidden_states` and `encoder_attention_mask`. Examples without the cache index are passed through.
+    """
+
+    def __init__(self, collator, cache: EncoderOutputsCache, sampling_rate: int = 16_000):
+        self.collator = collator
+        self.cache = cache
+        feature_extractor = collator.feature_extractor
+        self.dummy_input = feature_extractor(
+            np.zeros(sampling_rate // 10, dtype=np.float32), sampling_rate=sampling_rate, return_tensors="pt"
+        )[feature_extractor.model_input_names[0]][0]
+
+    def __call__(self, features: List[Dict[str, Any]]) -> Dict[str, Any]:
+        if ENCODER_CACHE_INDEX_COLUMN not in features[0]:
+            # evaluation data are not cached
+            return self.collator(features)
+        indices = [feature.pop(ENCODER_CACHE_INDEX_COLUMN) for feature in features]
+        for feature in features:
+            feature[self.collator.audio_path] = self.dummy_input
+        batch = self.collator(features)
+        batch.pop(self.collator.model_input_name or self.collator.feature_extractor.model_input_names[0], None)
+        batch.pop("attention_mask", None)
+
+        encoder_outputs = [self.cache[index] for index in indices]
+        max_length = max(len(example_outputs) for example_outputs in encoder_outputs)
+        hidden_states = np.zeros(
+            (len(indices), max_length, self.cache.features.shape[-1]), dtype=self.cache.features.dtype
+        )
+        attention_mask = torch.zeros((len(indices), max_length), dtype=torch.long)
+        for i, example_outputs in enumerate(encoder_outputs):
+            hidden_states[i, : len(example_outputs)] = example_outputs
+            attention_mask[i, : len(example_outputs)] = 1
+        batch["encoder_hidden_states"] = torch.from_numpy(hidden_states)
+        batch["encoder_attention_mask"] = attention_mask
+        return batch
+
+
+def get_cached_encoder_outputs(
+    model,
+    dataset: Dataset,
+    data_collator,
+    cache_dir: str,
+    audio_column: str,
+    sampling_rate: int,
+    batch_size: int = 8,
+    num_workers: int = 0,
+    fp16: bool = True,
+):
+    """Builds (or loads) the cache and returns the matching audio-free dataset and collator."""
+    if not model.config.freeze_encoder:
+        raise ValueError("Encoder outputs can be precomputed only for a frozen encoder.")
+    cache = precompute_encoder_outputs(
+        model, dataset, data_collator, cache_dir, batch_size=batch_size, num_workers=num_workers, fp16=fp16
+    )
+    if len(cache) != len(dataset):
+        raise ValueError(f"Encoder outputs cache in {cache_dir} holds {len(cache)} examples, expected {len(dataset)}.")
+    return with_encoder_cache_index(dataset, audio_column), CachedEncoderOutputsCollator(
+        data_collator, cache, sampling_rate=sampling_rate
+    )
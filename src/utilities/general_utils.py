@@ -199,6 +199,8 @@ def do_generate(
         labels = []
         outputs_agg = []
         for sample in tqdm.tqdm(dataloader):
+            if getattr(trainer, "batch_preprocessor", None) is not None:
+                sample = trainer.preprocess_batch(sample)
             outputs = model.generate(generation_config=gen_config, **sample)
             if gen_args.save_output_states:
                 outputs_agg.append(postprocess_beam_outputs(outputs))
@@ -0,0 +1,69 @@
+"""Batch samplers grouping examples of similar length into batches bounded by a padded size budget."""
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+from torch.utils.data import Sampler
+
+
+class LengthBucketingBatchSampler(Sampler[List[int]]):
+    """Groups examples of similar length and forms batches by a budget instead of a fixed batch size.
+
+    Examples are sorted by length and greedily packed while the padded size of the batch, i.e. the longest example
+    times the number of examples, fits into `max_batch_length`. Batches are formed once, so the number of batches is
+    fixed, and only their order is shuffled each epoch.
+
+    :param lengths: length of each example, e.g. duration in seconds or number of tokens
+    :param max_batch_length: budget of the padded batch size in the units of `lengths`
+    :param max_batch_size: optional upper bound on the number of examples in a batch
+    :param shuffle: whether to shuffle the order of batches every epoch
+    :param seed: seed of the batch order shuffling
+    """
+
+    def __init__(
+        self,
+        lengths: Sequence[float],
+        max_batch_length: float,
+        max_batch_size: Optional[int] = None,
+        shuffle: bool = True,
+        seed: int = 0,
+    ):
+        self.max_batch_length = max_batch_length
+        self.max_batch_size = max_batch_size
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+        self.batches = self.create_batches(np.asarray(lengths, dtype=np.float64))
+
+    def create_batches(self, lengths: np.ndarray) -> List[List[int]]:
+        """Packs indices sorted by decreasing length, the first example of each batch is its longest one."""
+        batches = []
+        batch = []
+        batch_max_length = 0.0
+        for index in np.argsort(-lengths, kind="stable").tolist():
+            length = lengths[index]
+            batch_max_length = max(batch_max_length, length)
+            is_full = self.max_batch_size is not None and len(batch) >= self.max_batch_size
+            if batch and (is_full or batch_max_length * (len(batch) + 1) > self.max_batch_length):
+                batches.append(batch)
+                batch = []
+                batch_max_length = length
+            batch.append(index)
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def set_epoch(self, epoch: int):
+        self.epoch = epoch
+
+    def __iter__(self) -> Iterator[List[int]]:
+        if self.shuffle:
+            # identical across processes, as long as they share the seed and epoch
+            order = np.random.default_rng(self.seed + self.epoch).permutation(len(self.batches))
+        else:
+            order = np.arange(len(self.batches))
+        self.epoch += 1
+        for batch_index in order:
+            yield self.batches[batch_index]
+
+    def __len__(self) -> int:
+        return len(self.batches)
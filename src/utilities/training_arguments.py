@@ -106,6 +106,23 @@ class GeneralTrainingArguments(Seq2SeqTrainingArguments):
     mask_unks: Optional[bool] = field(
         default=False, metadata={"help": "Whether to mask unknown tokens for cross entropy."}
     )
+    max_batch_duration: Optional[float] = field(
+        default=None,
+        metadata={
+            "help": "Budget of padded audio seconds per training batch, enables length-bucketed dynamic batching "
+            "by the `length_column_name` column instead of a fixed batch size."
+        },
+    )
+    max_batch_size: Optional[int] = field(
+        default=None, metadata={"help": "Maximal number of examples in a dynamically formed training batch."}
+    )
+    max_batch_tokens: Optional[int] = field(
+        default=None,
+        metadata={
+            "help": "Budget of padded decoder tokens (context, prompts, connector outputs and labels) per training "
+            "batch of the encoder-connector-LM models."
+        },
+    )
     use_start_method_spawn: Optional[bool] = field(
         default=False, metadata={"help": "Whether multiprocessing should be started by spawn"}
     )
@@ -144,9 +161,18 @@ class GenerationArguments:
     )
     """Joint decoding related arguments."""
     decoding_ctc_weight: Optional[float] = field(default=0.0, metadata={"help": "CTC weight to bias hypothesis."})
-    ctc_margin: Optional[float] = field(default=0, metadata={"help": "Margin to stop generation."})
+    ctc_margin: Optional[float] = field(
+        default=0, metadata={"help": "Frame margin of the CTC prefix scoring window, 0 disables windowing."}
+    )
+    ctc_pre_beam_size: Optional[int] = field(
+        default=0,
+        metadata={"help": "Number of best attention candidates per hypothesis to be CTC scored, 0 scores all tokens."},
+    )
     lm_model: Optional[str] = field(default=None, metadata={"help": "Path to external LM."})
     lm_weight: Optional[float] = field(default=0.0, metadata={"help": "Weight of external LM."})
+    lm_use_cache: Optional[bool] = field(
+        default=True, metadata={"help": "Whether to keep the external LM key/value cache between decoding steps."}
+    )
     """Generation logging related arguments."""
     wandb_predictions_to_save: Optional[int] = field(
         default=100, metadata={"help": "Number of predictions to save to wandb."}
@@ -188,6 +214,20 @@ class DataTrainingArguments:
     data_preprocessing_config: Optional[str] = field(
         default=None, metadata={"help": "Path to the data preprocessing config."}
     )
+    batch_preprocessing_config: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Path to the config of the batched on-device preprocessing of raw waveforms (speed perturbation, "
+            "log-mel features and SpecAug), replaces the feature extraction in the dataloader workers."
+        },
+    )
+    precompute_features: Optional[bool] = field(
+        default=False,
+        metadata={
+            "help": "Whether to precompute outputs of the leading deterministic preprocessing transforms (e.g. feature "
+            "extractor) once into the dataset instead of applying them on the fly every epoch."
+        },
+    )
     max_duration_in_seconds: Optional[float] = field(
         default=20.0,
         metadata={
@@ -265,6 +305,16 @@ class DataTrainingArguments:
     fisher_context_trunc_to_shortest: Optional[bool] = field(
         default=False, metadata={"help": "Whether to truncate the fisher context to the shortest context length in the batch."}
     )
+    fisher_max_context_tokens: Optional[int] = field(
+        default=None, metadata={"help": "Token budget of the fisher conversation context, the most recent tokens are kept."}
+    )
+    context_turn_table: Optional[str] = field(
+        default=None,
+        metadata={
+            "help": "Path to the conversation turn table, used to resolve the context of examples that store only their "
+            "conversation id and turn position."
+        },
+    )
     slurp_use_slots: Optional[bool] = field(
         default=False, metadata={"help": "Whether to train for SLURP slot filling."}
     )
@@ -272,6 +322,20 @@ class DataTrainingArguments:
         default=False, metadata={"help": "Whether to dump all predictions into the wandb file.."}
     )
 
+    def __post_init__(self):
+        if self.batch_preprocessing_config:
+            # the batched preprocessing expects raw waveforms, per-sample features would be processed as waveforms
+            if self.data_preprocessing_config:
+                raise ValueError(
+                    "batch_preprocessing_config cannot be combined with data_preprocessing_config, the per-sample "
+                    "preprocessing would pass features instead of raw waveforms to the batched preprocessing."
+                )
+            if self.precompute_features:
+                raise ValueError(
+                    "batch_preprocessing_config cannot be combined with precompute_features, features are computed "
+                    "on device from raw waveforms."
+                )
+
 
 
 @dataclass
@@ -330,6 +394,8 @@ class ConnectorArguments:
     prompt_prefix: Optional[str] = field(default=None, metadata={"help": "Text prompt prefix to the connector output soft prompt."})
     prompt_suffix: Optional[str] = field(default=None, metadata={"help": "Text prompt suffix to the connector output soft prompt."})
     decoder_lora: Optional[bool] = field(default=False, metadata={"help": "Whether to use LoRA for the decoder LM."})
+    encoder_outputs_cache_dir: Optional[str] = field(default=None, metadata={"help": "Directory with precomputed outputs of the frozen encoder, they are computed once if missing and fed directly to the connector during training."})
+    encoder_outputs_cache_fp16: Optional[bool] = field(default=True, metadata={"help": "Whether to store the precomputed encoder outputs in fp16."})
     quantize_decoder: Optional[int] = field(default=None, metadata={"help": "Which BnB decoder quantization config to use (8bit, 4bit). FIXME: quant. order not working yet"})
     n_queries: Optional[int] = field(default=80, metadata={"help": "Number of qformer queries."})
     downsampling_factor: Optional[int] = field(default=4, metadata={"help": "When using the stacking downsampling method, concatenate 'N' consecutive embeddings."})
@@ -1,5 +1,6 @@
 from typing import Callable, List
 
+import datasets
 import numpy as np
 from packaging import version
 from torch import Tensor, nn
@@ -31,6 +32,7 @@ from transformers.trainer_utils import (
     EvalPrediction,
     denumpify_detensorize,
     has_length,
+    seed_worker,
 )
 from transformers.training_args import TrainingArguments
 from transformers.utils import (
@@ -47,6 +49,7 @@ from models.ctc_encoder_plus_autoregressive_decoder import (
     JointCTCAttentionEncoderDecoder,
 )
 from utilities.callbacks import GumbelTemperatureCallback
+from utilities.samplers import LengthBucketingBatchSampler
 
 # Integrations must be imported before ML frameworks:
 # isort: off
@@ -219,7 +222,99 @@ class MetadataTensor(torch.Tensor):
                 return _convert(ret, cls)
 
 
-class AdditionalLossTrackerTrainer(Seq2SeqTrainer):
+class DynamicBatchingTrainerMixin:
+    """Forms training batches by a total padded audio duration budget (`max_batch_duration`) instead of a fixed batch
+    size, utterances are bucketed by the `length_column_name` column. Without the budget, the default sampling is used."""
+
+    def get_train_lengths(self, train_dataset: datasets.Dataset) -> List[float]:
+        return train_dataset[self.args.length_column_name]
+
+    def get_train_batch_sampler(self, train_dataset: Dataset) -> Optional[LengthBucketingBatchSampler]:
+        if not self.args.max_batch_duration or not isinstance(train_dataset, datasets.Dataset):
+            return None
+        return LengthBucketingBatchSampler(
+            lengths=self.get_train_lengths(train_dataset),
+            max_batch_length=self.args.max_batch_duration,
+            max_batch_size=self.args.max_batch_size,
+            seed=self.args.seed,
+        )
+
+    def get_train_dataloader(self) -> DataLoader:
+        if self.train_dataset is None:
+            raise ValueError("Trainer: training requires a train_dataset.")
+        # lengths have to be collected before the unused columns are removed
+        batch_sampler = self.get_train_batch_sampler(self.train_dataset)
+        if batch_sampler is None:
+            return super().get_train_dataloader()
+
+        train_dataset = self._remove_unused_columns(self.train_dataset, description="training")
+        dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=batch_sampler,
+            collate_fn=self.data_collator,
+            num_workers=self.args.dataloader_num_workers,
+            pin_memory=self.args.dataloader_pin_memory,
+            persistent_workers=self.args.dataloader_persistent_workers,
+            worker_init_fn=seed_worker,
+            prefetch_factor=self.args.dataloader_prefetch_factor,
+        )
+        # accelerate shards whole batches across processes
+        return self.accelerator.prepare(dataloader)
+
+
+class BatchedPreprocessingTrainerMixin:
+    """Computes input features of padded raw waveforms from the collator on device by `BatchedSpeechPreprocessor`,
+    augmentations are applied only to the training batches. Without the preprocessor, inputs are left untouched."""
+
+    def __init__(self, *args, batch_preprocessor: Optional[nn.Module] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.batch_preprocessor = batch_preprocessor.to(self.args.device) if batch_preprocessor is not None else None
+
+    def preprocess_batch(self, inputs: Dict[str, Union[torch.Tensor, Any]], augment: bool = False):
+        input_name = self.model.main_input_name
+        self.batch_preprocessor.train(augment)
+        inputs[input_name], inputs["attention_mask"] = self.batch_preprocessor(
+            inputs[input_name].to(self.args.device),
+            inputs["attention_mask"].to(self.args.device),
+            global_step=self.state.global_step,
+        )
+        return inputs
+
+    def _prepare_inputs(self, inputs: Dict[str, Union[torch.Tensor, Any]]) -> Dict[str, Union[torch.Tensor, Any]]:
+        inputs = super()._prepare_inputs(inputs)
+        if self.batch_preprocessor is not None:
+            inputs = self.preprocess_batch(inputs, augment=self.model.training)
+        return inputs
+
+
+class DynamicBatchingTrainer(BatchedPreprocessingTrainerMixin, DynamicBatchingTrainerMixin, Trainer):
+    pass
+
+
+class DynamicBatchingSeq2SeqTrainer(BatchedPreprocessingTrainerMixin, DynamicBatchingTrainerMixin, Seq2SeqTrainer):
+    pass
+
+
+class TokenBudgetSeq2SeqTrainer(DynamicBatchingSeq2SeqTrainer):
+    """Forms training batches by a budget of estimated decoder tokens (`max_batch_tokens`), the decoder lengths of the
+    training examples are supplied by `estimate_decoder_lengths`."""
+
+    def __init__(self, *args, decoder_lengths: Optional[List[int]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.decoder_lengths = decoder_lengths
+
+    def get_train_batch_sampler(self, train_dataset: Dataset) -> Optional[LengthBucketingBatchSampler]:
+        if not self.args.max_batch_tokens or self.decoder_lengths is None:
+            return super().get_train_batch_sampler(train_dataset)
+        return LengthBucketingBatchSampler(
+            lengths=self.decoder_lengths,
+            max_batch_length=self.args.max_batch_tokens,
+            max_batch_size=self.args.max_batch_size,
+            seed=self.args.seed,
+        )
+
+
+class AdditionalLossTrackerTrainer(BatchedPreprocessingTrainerMixin, DynamicBatchingTrainerMixin, Seq2SeqTrainer):
     """Custom trainer to log both losses"""
 
     def compute_loss(
@@ -256,7 +351,7 @@ class AdditionalLossTrackerTrainer(Seq2SeqTrainer):
         return (loss, outputs) if return_outputs else loss
 
 
-class SSLTrainer(Trainer):
+class SSLTrainer(DynamicBatchingTrainerMixin, Trainer):
     def __init__(
         self,
         model: Union[PreTrainedModel, nn.Module] = None,
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# modules of the repository are imported relative to the src directory, the same as in the training scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
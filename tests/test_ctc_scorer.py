@@ -0,0 +1,89 @@
+import pytest
+import torch
+from ctc_scorer_reference import CTCPrefixScoreTH as ReferenceCTCPrefixScoreTH
+
+from decoding.ctc_scorer import CTCPrefixScoreTH, CTCRescorerLogitsProcessor
+
+BLANK = 0
+EOS = 1
+NUM_BEAMS = 3
+VOCAB_SIZE = 9
+
+
+def run_beam_search(xlens, margin=0, pre_beam_size=0, num_steps=6, seed=0):
+    """Runs both scorers side by side on random posteriors, hypotheses are selected by random scores so that the beams
+    are reordered and pruned the same way as in the beam search."""
+    generator = torch.Generator().manual_seed(seed)
+    batch_size, max_len = len(xlens), max(xlens)
+    x = torch.randn(batch_size, max_len, VOCAB_SIZE, generator=generator).log_softmax(dim=-1)
+    xlens = torch.tensor(xlens)
+    scorer = CTCPrefixScoreTH(x.clone(), xlens, BLANK, EOS, margin)
+    reference = ReferenceCTCPrefixScoreTH(x.clone(), xlens, BLANK, EOS, margin)
+
+    # attention weights are a function of the prefix as in the decoder, identical prefixes are scored only once
+    attention_logits = torch.randn(VOCAB_SIZE, max_len, generator=generator) * 3
+
+    n_bh = batch_size * NUM_BEAMS
+    y = torch.full((n_bh, 1), EOS, dtype=torch.long)
+    state = reference_state = None
+    num_reordered_steps = 0
+    for _ in range(num_steps):
+        scoring_ids = None
+        if pre_beam_size > 0:
+            scoring_ids = torch.rand(n_bh, VOCAB_SIZE, generator=generator).topk(pre_beam_size, dim=-1).indices
+        att_w = None
+        if margin > 0:
+            att_w = attention_logits[y].sum(dim=1).softmax(dim=-1)
+
+        scores, state = scorer(y, state, scoring_ids, att_w)
+        reference_scores, reference_state = reference(y, reference_state, scoring_ids, att_w)
+        torch.testing.assert_close(scores, reference_scores, rtol=1e-5, atol=1e-4)
+
+        # random selection of W hypothesis x label pairs of each utterance among the scored labels
+        selection_scores = torch.rand(n_bh, VOCAB_SIZE, generator=generator)
+        selection_scores[scores <= scorer.logzero / 2] = -1
+        selection_scores[:, BLANK] = -1
+        best_ids = selection_scores.view(batch_size, -1).topk(NUM_BEAMS, dim=-1).indices
+        state = scorer.index_select_state(state, best_ids)
+        reference_state = reference.index_select_state(reference_state, best_ids)
+
+        hyp_ids = (best_ids // VOCAB_SIZE + torch.arange(batch_size).unsqueeze(1) * NUM_BEAMS).view(-1)
+        y = torch.cat((y[hyp_ids], (best_ids % VOCAB_SIZE).view(-1, 1)), dim=1)
+        num_reordered_steps += int(not torch.equal(hyp_ids, torch.arange(n_bh)))
+    return num_reordered_steps
+
+
+@pytest.mark.parametrize("pre_beam_size", [0, 4])
+@pytest.mark.parametrize("margin", [0, 3])
+@pytest.mark.parametrize("xlens", [[14], [14, 14], [14, 9, 11]])
+def test_prefix_scores_match_reference(xlens, margin, pre_beam_size):
+    num_reordered_steps = run_beam_search(xlens, margin=margin, pre_beam_size=pre_beam_size)
+    # hypotheses have to move between the beams, otherwise the state selection is not exercised
+    assert num_reordered_steps > 0
+
+
+@pytest.mark.parametrize("pre_beam_size", [0, 4])
+def test_unmatched_hypotheses_recompute_ctc_states(pre_beam_size):
+    generator = torch.Generator().manual_seed(0)
+    batch_size, n_bh = 2, 2 * NUM_BEAMS
+    logits = torch.randn(batch_size, 14, VOCAB_SIZE, generator=generator)
+
+    def make_processor():
+        return CTCRescorerLogitsProcessor(
+            logits, torch.tensor([14, 10]), BLANK, EOS, 0, 0.5, NUM_BEAMS, 2, False, 1.0, pre_beam_size=pre_beam_size
+        )
+
+    processor, reference = make_processor(), make_processor()
+    input_ids = torch.full((n_bh, 1), EOS, dtype=torch.long)
+    for step in range(5):
+        scores = torch.randn(n_bh, VOCAB_SIZE, generator=generator).log_softmax(dim=-1)
+        if step == 3:
+            # the hypotheses cannot be matched to the previous step, the states have to be computed from scratch
+            processor.prev_input_ids = None
+        next_token_scores = processor(input_ids, scores.clone())
+        torch.testing.assert_close(next_token_scores, reference(input_ids, scores.clone()), rtol=1e-5, atol=1e-4)
+
+        next_token_scores[:, BLANK] = -float("inf")
+        best_ids = next_token_scores.view(batch_size, -1).topk(NUM_BEAMS, dim=-1).indices
+        hyp_ids = (best_ids // VOCAB_SIZE + torch.arange(batch_size).unsqueeze(1) * NUM_BEAMS).view(-1)
+        input_ids = torch.cat((input_ids[hyp_ids], (best_ids % VOCAB_SIZE).view(-1, 1)), dim=1)
@@ -0,0 +1,86 @@
+import numpy as np
+import pyarrow as pa
+from datasets import Audio, Dataset, DatasetDict, load_from_disk
+
+from utilities.data_utils import estimate_decoder_lengths, prepare_dataset
+
+
+def audio_cache_files(dataset: Dataset, audio_column: str):
+    files = set()
+    for cache_file in dataset.cache_files:
+        with pa.memory_map(cache_file["filename"]) as source:
+            if audio_column in pa.ipc.open_stream(source).schema.names:
+                files.add(cache_file["filename"])
+    return files
+
+
+def test_text_transformations_do_not_rewrite_audio(tmp_path):
+    rng = np.random.default_rng(0)
+    lengths = [0.05, 0.5, 1.0, 30.0, 0.8, 0.3]
+    labels = ["Hello  World ", "ignore", "", "Too Long", " A  B ", "Last One"]
+    audio = [{"array": rng.standard_normal(160).astype(np.float32), "sampling_rate": 16000} for _ in lengths]
+
+    def make_split():
+        return Dataset.from_dict({"audio": audio, "labels": labels, "input_len": lengths}).cast_column(
+            "audio", Audio(sampling_rate=16000)
+        )
+
+    DatasetDict(train=make_split(), validation=make_split()).save_to_disk(str(tmp_path / "dataset"))
+    dataset = load_from_disk(str(tmp_path / "dataset"))
+    original_files = {split: audio_cache_files(dataset[split], "audio") for split in dataset}
+
+    dataset = prepare_dataset(
+        dataset=dataset,
+        dataset_name="test_dataset",
+        length_column_name="input_len",
+        text_column_name="labels",
+        audio_column_name="audio",
+        preprocessing_num_workers=1,
+        writer_batch_size=2,
+        train_split="train",
+        text_transformations=[
+            "do_lower_case",
+            "remove_multiple_whitespaces_and_strip",
+            "filter_empty_transcriptions",
+            "remove_punctuation",
+        ],
+        split_long_segments_to_chunks=False,
+        sampling_rate=16000,
+        max_input_len=20.0,
+        min_input_len=0.1,
+        reshuffle_at_start=False,
+        skip_audio_processing=False,
+    )
+
+    assert dataset["train"]["labels"] == ["ignore", "a b", "last one"]
+    assert dataset["train"]["input_len"] == [0.5, 0.8, 0.3]
+    assert dataset["validation"]["labels"] == ["ignore", "too long", "a b", "last one"]
+    assert dataset["train"].column_names == ["audio", "labels", "input_len"]
+    for split in dataset:
+        assert audio_cache_files(dataset[split], "audio") == original_files[split]
+        decoded = dataset[split][0]["audio"]["array"]
+        assert decoded.shape == (160,)
+
+
+class WhitespaceTokenizer:
+    def __call__(self, texts):
+        return {"input_ids": [text.split() for text in texts]}
+
+
+def test_decoder_lengths_do_not_decode_audio(monkeypatch):
+    dataset = Dataset.from_dict(
+        {
+            "audio": [{"array": np.zeros(160, dtype=np.float32), "sampling_rate": 16000}] * 4,
+            "labels": ["a b", "c", "d e f", "g"],
+            "context": [None, [{"labels": ["x y"]}], [{"labels": ["z"]}, {"labels": ["u v w"]}], []],
+        }
+    ).cast_column("audio", Audio(sampling_rate=16000))
+
+    def fail_decode(*args, **kwargs):
+        raise AssertionError("audio was decoded")
+
+    monkeypatch.setattr(Audio, "decode_example", fail_decode)
+    lengths = estimate_decoder_lengths(
+        dataset, WhitespaceTokenizer(), "labels", [10, 10, 10, 10], max_context=1, prompts=["p q"], batch_size=3
+    )
+    assert lengths == [2 + 2 + 10, 1 + 2 + 2 + 10, 3 + 3 + 2 + 10, 1 + 2 + 10]
@@ -0,0 +1,101 @@
+import pytest
+import torch
+
+from decoding.streaming_ctc import StreamingCTCGreedyDecoder
+from models.encoders.e_branchformer import (
+    Wav2Vec2EBranchformerConfig,
+    Wav2Vec2EBranchformerForCTC,
+    Wav2Vec2EBranchformerModel,
+)
+from models.extractors import Conv2dFeatureExtractor
+
+NUM_MEL_BINS = 20
+NUM_FRAMES = 101
+
+
+def build_config(position_embeddings_type, attention_chunk_size, attention_num_left_chunks):
+    return Wav2Vec2EBranchformerConfig(
+        num_hidden_layers=2,
+        hidden_size=32,
+        output_hidden_size=32,
+        num_attention_heads=4,
+        intermediate_size=64,
+        num_feat_extract_layers=2,
+        conv_dim=[8, 32],
+        conv_stride=[2, 2],
+        conv_kernel=[3, 3],
+        csgu_kernel_size=7,
+        merge_conv_kernel=5,
+        use_macaron_ff=True,
+        max_source_positions=512,
+        position_embeddings_type=position_embeddings_type,
+        is_causal=True,
+        causal_conv_fusion=True,
+        attention_chunk_size=attention_chunk_size,
+        attention_num_left_chunks=attention_num_left_chunks,
+        apply_spec_augment=False,
+        expect_2d_input=True,
+        second_dim_input_size=NUM_MEL_BINS,
+        vocab_size=6,
+        pad_token_id=0,
+    )
+
+
+def build_model(position_embeddings_type, attention_chunk_size, attention_num_left_chunks):
+    torch.manual_seed(0)
+    config = build_config(position_embeddings_type, attention_chunk_size, attention_num_left_chunks)
+    model = Wav2Vec2EBranchformerModel(config)
+    # 2d inputs are handled by the convolutional front-end set up by the auto model wrappers
+    model.feature_extractor = Conv2dFeatureExtractor(config)
+    return model.eval()
+
+
+@pytest.mark.parametrize("input_chunk_size", [1, 3, 8, 13, 32])
+@pytest.mark.parametrize("attention_chunk_size, attention_num_left_chunks", [(0, -1), (4, -1), (4, 2)])
+@pytest.mark.parametrize("position_embeddings_type", ["relative", "rotary", None])
+def test_streaming_matches_full_forward(
+    position_embeddings_type, attention_chunk_size, attention_num_left_chunks, input_chunk_size
+):
+    model = build_model(position_embeddings_type, attention_chunk_size, attention_num_left_chunks)
+    input_features = torch.randn(2, NUM_FRAMES, NUM_MEL_BINS)
+    with torch.no_grad():
+        full_output = model(input_features).last_hidden_state
+
+    outputs, streaming_state = [], None
+    for start in range(0, NUM_FRAMES, input_chunk_size):
+        output, streaming_state = model.forward_streaming(
+            input_features[:, start : start + input_chunk_size], streaming_state
+        )
+        outputs.append(output)
+    outputs.append(model.flush_streaming(streaming_state))
+    streaming_output = torch.cat(outputs, dim=1)
+
+    assert streaming_output.shape == full_output.shape
+    torch.testing.assert_close(streaming_output, full_output, rtol=1e-4, atol=1e-4)
+
+
+def test_streaming_requires_causal_conv_fusion():
+    model = build_model("rotary", 0, -1)
+    model.config.causal_conv_fusion = False
+    with pytest.raises(ValueError):
+        model.forward_streaming(torch.randn(1, 16, NUM_MEL_BINS))
+
+
+@pytest.mark.parametrize("input_chunk_size", [7, 16])
+def test_streaming_ctc_decoder_matches_full_greedy_decoding(input_chunk_size):
+    torch.manual_seed(0)
+    model = Wav2Vec2EBranchformerForCTC(build_config("rotary", 4, 2))
+    model.wav2vec2.feature_extractor = Conv2dFeatureExtractor(model.config)
+    model.eval()
+    input_features = torch.randn(2, NUM_FRAMES, NUM_MEL_BINS)
+    with torch.no_grad():
+        frame_ids = model(input_features).logits.argmax(dim=-1)
+    expected_ids = [
+        [token_id for token_id in torch.unique_consecutive(stream_ids).tolist() if token_id != model.config.pad_token_id]
+        for stream_ids in frame_ids
+    ]
+
+    decoder = StreamingCTCGreedyDecoder(model)
+    for start in range(0, NUM_FRAMES, input_chunk_size):
+        decoder(input_features[:, start : start + input_chunk_size])
+    assert decoder.flush().token_ids == expected_ids